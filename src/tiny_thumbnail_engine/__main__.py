@@ -0,0 +1,242 @@
+"""Command-line interface."""
+
+import argparse
+import time
+import typing
+from pathlib import Path
+
+from tiny_thumbnail_engine.bloom import DEFAULT_CAPACITY
+from tiny_thumbnail_engine.bloom import DEFAULT_FALSE_POSITIVE_RATE
+
+
+def _loadtest(args: argparse.Namespace) -> None:
+    from tiny_thumbnail_engine import loadtest
+
+    loadtest.main(
+        access_log=args.access_log,
+        source_dir=args.source_dir,
+        synthetic=args.synthetic,
+        specs=args.spec or ["200x200c", "800", "1200x900"],
+        formats=args.format or [".webp", ".jpg"],
+        rate=args.rate,
+        concurrency=args.concurrency,
+        storage_latency=args.storage_latency,
+        seed=args.seed,
+    )
+
+
+def _sweep(args: argparse.Namespace) -> None:
+    from tiny_thumbnail_engine import App
+    from tiny_thumbnail_engine.sweep import sweep
+
+    result = sweep(App(), args.prefix, concurrency=args.concurrency)
+
+    print(
+        f"checked: {result.checked}, stale: {result.stale}, "
+        f"regenerated: {result.regenerated}, deleted: {result.deleted}, "
+        f"failed: {result.failed}"
+    )
+
+
+def _prune(args: argparse.Namespace) -> None:
+    from tiny_thumbnail_engine import App
+    from tiny_thumbnail_engine.prune import prune
+
+    result = prune(
+        App(),
+        max_age=args.max_age_days * 24 * 60 * 60,
+        per_source=args.per_source,
+        prefix=args.prefix,
+        dry_run=args.dry_run,
+    )
+
+    print(
+        f"scanned: {result.scanned}, evicted (age): {result.evicted_by_age}, "
+        f"evicted (budget): {result.evicted_by_budget}"
+    )
+
+
+def _pregenerate(args: argparse.Namespace) -> None:
+    from tiny_thumbnail_engine import App
+    from tiny_thumbnail_engine.pregenerate import pregenerate_existing
+
+    result = pregenerate_existing(App(), args.prefix, concurrency=args.concurrency)
+
+    print(
+        f"generated: {result.generated}, skipped: {result.skipped}, "
+        f"failed: {result.failed}"
+    )
+
+
+def _build_filter(args: argparse.Namespace) -> None:
+    from tiny_thumbnail_engine import App
+    from tiny_thumbnail_engine.bloom import build_target_filter
+    from tiny_thumbnail_engine.bloom import delete_filter_deltas
+    from tiny_thumbnail_engine.bloom import write_target_filter
+
+    app = App()
+    started = time.time()
+    bloom = build_target_filter(
+        app.storage_backend,
+        capacity=args.capacity,
+        false_positive_rate=args.false_positive_rate,
+    )
+    deleted = 0
+
+    if not args.dry_run:
+        write_target_filter(app.storage_backend, bloom)
+        app.flush()
+        deleted = delete_filter_deltas(app.storage_backend, before=started)
+
+    print(
+        f"keys: {bloom.count}, size: {bloom.nbytes / 1024:.1f} KiB, "
+        f"hashes: {bloom.hash_count}, "
+        f"false positive rate: {bloom.false_positive_rate():.4%}, "
+        f"deltas deleted: {deleted}"
+    )
+
+
+def _migrate_shards(args: argparse.Namespace) -> None:
+    from tiny_thumbnail_engine import App
+    from tiny_thumbnail_engine.sharding import migrate
+
+    result = migrate(
+        App(), args.prefix, delete=args.delete, concurrency=args.concurrency
+    )
+
+    print(
+        f"copied: {result.copied}, skipped: {result.skipped}, "
+        f"deleted: {result.deleted}, failed: {result.failed}"
+    )
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="tiny-thumbnail-engine", description="Tiny Thumbnail Engine."
+    )
+    subparsers = parser.add_subparsers(required=True)
+
+    loadtest = subparsers.add_parser(
+        "loadtest",
+        help="Replay thumbnail requests against the lambda handler in-process.",
+    )
+    loadtest.add_argument(
+        "--access-log",
+        type=Path,
+        help="File with one URL per line, or an access log in common log format.",
+    )
+    loadtest.add_argument(
+        "--source-dir",
+        type=Path,
+        help="Directory of source images to load into the in-memory backend.",
+    )
+    loadtest.add_argument(
+        "--synthetic",
+        type=int,
+        default=1000,
+        help="Number of requests to generate when no access log is given.",
+    )
+    loadtest.add_argument(
+        "--spec", action="append", help="Spec for synthetic requests, repeatable."
+    )
+    loadtest.add_argument(
+        "--format",
+        action="append",
+        choices=[".webp", ".jpg"],
+        help="Format for synthetic requests, repeatable.",
+    )
+    loadtest.add_argument(
+        "--rate", type=float, help="Requests per second. Default is unthrottled."
+    )
+    loadtest.add_argument("--concurrency", type=int, default=4)
+    loadtest.add_argument(
+        "--storage-latency",
+        type=float,
+        default=0.02,
+        help="Simulated storage round trip in seconds (in-memory backend only).",
+    )
+    loadtest.add_argument("--seed", type=int)
+    loadtest.set_defaults(func=_loadtest)
+
+    sweep = subparsers.add_parser(
+        "sweep",
+        help="Regenerate thumbnails whose source has changed since they were made.",
+    )
+    sweep.add_argument("--prefix", default="", help="Only sweep sources under this.")
+    sweep.add_argument("--concurrency", type=int, default=8)
+    sweep.set_defaults(func=_sweep)
+
+    prune = subparsers.add_parser(
+        "prune",
+        help="Delete thumbnails which haven't been requested recently.",
+    )
+    prune.add_argument(
+        "--max-age-days",
+        type=float,
+        default=90,
+        help="Delete thumbnails not accessed (or generated) within this window.",
+    )
+    prune.add_argument(
+        "--per-source",
+        type=int,
+        help="Keep at most this many of the most recently used renditions.",
+    )
+    prune.add_argument("--prefix", default="", help="Only prune targets under this.")
+    prune.add_argument("--dry-run", action="store_true")
+    prune.set_defaults(func=_prune)
+
+    pregenerate = subparsers.add_parser(
+        "pregenerate",
+        help="Generate the configured renditions of existing sources.",
+    )
+    pregenerate.add_argument(
+        "--prefix", default="", help="Only generate for sources under this."
+    )
+    pregenerate.add_argument("--concurrency", type=int, default=4)
+    pregenerate.set_defaults(func=_pregenerate)
+
+    build_filter = subparsers.add_parser(
+        "build-filter",
+        help="Build the filter used to skip lookups of missing thumbnails.",
+    )
+    build_filter.add_argument(
+        "--capacity",
+        type=int,
+        default=DEFAULT_CAPACITY,
+        help="Number of thumbnails to size the filter for.",
+    )
+    build_filter.add_argument(
+        "--false-positive-rate",
+        type=float,
+        default=DEFAULT_FALSE_POSITIVE_RATE,
+        help="False positive rate at capacity.",
+    )
+    build_filter.add_argument("--dry-run", action="store_true")
+    build_filter.set_defaults(func=_build_filter)
+
+    migrate_shards = subparsers.add_parser(
+        "migrate-shards",
+        help="Copy thumbnails stored under their source path to sharded keys.",
+    )
+    migrate_shards.add_argument(
+        "--prefix", default="", help="Only migrate thumbnails under this."
+    )
+    migrate_shards.add_argument(
+        "--delete",
+        action="store_true",
+        help="Delete the old keys once the copies exist.",
+    )
+    migrate_shards.add_argument("--concurrency", type=int, default=8)
+    migrate_shards.set_defaults(func=_migrate_shards)
+
+    return parser
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> None:
+    """Tiny Thumbnail Engine."""
+    args = get_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
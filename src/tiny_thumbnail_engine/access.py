@@ -0,0 +1,164 @@
+"""Lightweight record of which thumbnails are being served.
+
+A sample of requests is recorded in memory and written to target storage
+in batches on a background thread, so serving a thumbnail never waits for
+a storage write. The prune command uses these records to find cold
+thumbnails.
+
+A batch is written once it is big enough or old enough, and whatever is
+left when the process exits (on lambda, when the execution environment
+gets SIGTERM). Lambda can freeze an execution environment as soon as a
+request returns, a write in progress carries on with the next request.
+An environment which is thrown away without a SIGTERM loses its last
+partial batch.
+
+Because only a sample is recorded, a thumbnail requested a handful of times
+within the pruning window can look cold. That's fine, pruned thumbnails
+are generated again on the next request.
+"""
+
+import atexit
+import dataclasses
+import json
+import logging
+import random
+import threading
+import time
+import typing
+import uuid
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from pathlib import PurePath
+from pathlib import PurePosixPath
+
+from tiny_thumbnail_engine.environ import environ_float
+from tiny_thumbnail_engine.environ import environ_int
+from tiny_thumbnail_engine.storage.protocol import StorageProtocol
+
+
+logger = logging.getLogger(__name__)
+
+
+ACCESS_LOG_PREFIX: typing.Final[PurePosixPath] = PurePosixPath("_access")
+
+DEFAULT_FLUSH_INTERVAL: typing.Final[float] = 5 * 60
+DEFAULT_MAX_BATCH: typing.Final[int] = 10_000
+
+
+def read_access_log(data: bytes) -> dict[str, float]:
+    """Target key to unix timestamp of the last recorded access"""
+    log: dict[str, float] = json.loads(data)
+
+    return log
+
+
+@dataclasses.dataclass
+class AccessRecorder:
+    storage_backend: StorageProtocol
+
+    _: dataclasses.KW_ONLY
+
+    # Fraction of requests which are recorded
+    sample_rate: float = 0.01
+    # Seconds between writes, and the most keys held in memory between writes
+    flush_interval: float = DEFAULT_FLUSH_INTERVAL
+    max_batch: int = DEFAULT_MAX_BATCH
+
+    _batch: dict[str, float] = dataclasses.field(init=False, default_factory=dict)
+    _last_flush: float = dataclasses.field(init=False, default_factory=time.monotonic)
+    _lock: threading.Lock = dataclasses.field(
+        init=False, default_factory=threading.Lock
+    )
+    # Lazily started, one thread is plenty for a write every few minutes
+    _executor: typing.Optional[ThreadPoolExecutor] = dataclasses.field(
+        init=False, default=None
+    )
+    # Writes which haven't finished yet, waited on by flush
+    _writes: set["Future[None]"] = dataclasses.field(init=False, default_factory=set)
+
+    def record(self, path: PurePath) -> None:
+        if random.random() >= self.sample_rate:  # noqa: S311
+            return
+
+        with self._lock:
+            self._batch[path.as_posix()] = time.time()
+
+            due = (
+                len(self._batch) >= self.max_batch
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+
+            if not due:
+                return
+
+            batch = self._take_batch()
+
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="tiny-thumbnail-engine-access"
+                )
+
+            write = self._executor.submit(self._write, batch)
+            self._writes.add(write)
+
+        write.add_done_callback(self._write_done)
+
+    def _take_batch(self) -> dict[str, float]:
+        # Must hold the lock
+        batch, self._batch = self._batch, {}
+        self._last_flush = time.monotonic()
+        return batch
+
+    def _write_done(self, write: "Future[None]") -> None:
+        with self._lock:
+            self._writes.discard(write)
+
+    def _write(self, batch: dict[str, float]) -> None:
+        if not batch:
+            return
+
+        # One object per batch, never appended to, so there's no contention
+        # between workers
+        name = f"{time.strftime('%Y-%m-%d', time.gmtime())}/{uuid.uuid4().hex}.json"
+
+        try:
+            self.storage_backend._write_target(
+                ACCESS_LOG_PREFIX / name,
+                json.dumps(batch).encode(),
+                content_type="application/json",
+            )
+        # Only costs some samples, the thumbnails might look colder than they are
+        except Exception:
+            logger.exception("Could not write %d access records", len(batch))
+
+    def flush(self) -> None:
+        """Write what has been recorded and wait for background writes
+
+        Call on shutdown, writing a partial batch per request would mean a
+        lot of tiny objects for prune to read
+        """
+        with self._lock:
+            batch = self._take_batch()
+            writes = list(self._writes)
+
+        self._write(batch)
+        wait(writes)
+
+
+def get_access_recorder(
+    storage_backend: StorageProtocol, sample_rate: float
+) -> typing.Optional[AccessRecorder]:
+    """Build the recorder, None if disabled"""
+    if sample_rate <= 0:
+        return None
+
+    recorder = AccessRecorder(
+        storage_backend,
+        sample_rate=sample_rate,
+        flush_interval=environ_float("ACCESS_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL),
+        max_batch=environ_int("ACCESS_MAX_BATCH", DEFAULT_MAX_BATCH),
+    )
+    atexit.register(recorder.flush)
+
+    return recorder
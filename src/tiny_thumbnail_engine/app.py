@@ -1,16 +1,32 @@
 """Main module."""
 
+import atexit
 import dataclasses
 import os
 import typing
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from importlib import import_module
+from pathlib import PurePath
 
 from tiny_thumbnail_engine import signing
+from tiny_thumbnail_engine.access import AccessRecorder
+from tiny_thumbnail_engine.access import get_access_recorder
+from tiny_thumbnail_engine.deadline import Deadline
 from tiny_thumbnail_engine.environ import ENVIRON_PREFIX
 from tiny_thumbnail_engine.environ import EnvironFactory
+from tiny_thumbnail_engine.environ import environ_flag
+from tiny_thumbnail_engine.environ import environ_float
+from tiny_thumbnail_engine.environ import environ_int
 from tiny_thumbnail_engine.model import Thumbnail
+from tiny_thumbnail_engine.pregenerate import get_pregenerate_config
+from tiny_thumbnail_engine.profiling import PROFILE_SIGNING_SALT
+from tiny_thumbnail_engine.sources import DEFAULT_CACHE_TTL
+from tiny_thumbnail_engine.sources import SourceInfoCache
+from tiny_thumbnail_engine.sources import read_source_info
 from tiny_thumbnail_engine.storage.protocol import StorageProtocol
+from tiny_thumbnail_engine.vips import VipsConfig
+from tiny_thumbnail_engine.vips import get_vips_config
 
 
 def get_storage_backend() -> StorageProtocol:
@@ -32,27 +48,209 @@ def get_storage_backend() -> StorageProtocol:
     # TODO Consider a run-time check that this class actually
     # implements the storage protocol
 
-    return cls()
+    backend = cls()
+
+    # Return the response as soon as the thumbnail is encoded and upload it
+    # afterwards
+    if environ_flag("BACKGROUND_WRITES"):
+        from tiny_thumbnail_engine.storage.background import DEFAULT_QUEUE_SIZE
+        from tiny_thumbnail_engine.storage.background import BackgroundBackend
+
+        background = BackgroundBackend(
+            backend,
+            queue_size=environ_int("BACKGROUND_WRITE_QUEUE_SIZE", DEFAULT_QUEUE_SIZE),
+        )
+        atexit.register(background.flush)
+        backend = background
+
+    # Don't make thumbnails which definitely don't exist wait for the lookup
+    if environ_flag("TARGET_FILTER"):
+        from tiny_thumbnail_engine.storage.filtered import DEFAULT_REFRESH_INTERVAL
+        from tiny_thumbnail_engine.storage.filtered import FilteredBackend
+
+        backend = FilteredBackend(
+            backend,
+            refresh_interval=environ_float(
+                "TARGET_FILTER_REFRESH", DEFAULT_REFRESH_INTERVAL
+            ),
+        )
+
+    return backend
 
 
 # Some of these are needed for the client and some for the server
 @dataclasses.dataclass
 class App:
     secret_key: str = dataclasses.field(
-        factory=EnvironFactory("SECRET_KEY", "tiny_thumbnail_engine.App")
+        default_factory=EnvironFactory("SECRET_KEY", "tiny_thumbnail_engine.App")
     )
 
     _: dataclasses.KW_ONLY
 
     # This could just be a factory?
-    storage_backend: StorageProtocol = dataclasses.field(factory=get_storage_backend)
+    storage_backend: StorageProtocol = dataclasses.field(
+        default_factory=get_storage_backend
+    )
+
+    # None leaves libvips with its own defaults
+    vips_config: typing.Optional[VipsConfig] = dataclasses.field(
+        default_factory=get_vips_config
+    )
+
+    # Store thumbnails by a hash of the source contents instead of the source
+    # path, so duplicate uploads share renditions. URLs don't change
+    content_addressed: bool = dataclasses.field(
+        default_factory=partial(environ_flag, "CONTENT_ADDRESSED")
+    )
+
+    # Record a tiny placeholder image for each source while generating
+    # thumbnails, see get_placeholders
+    placeholders: bool = dataclasses.field(
+        default_factory=partial(environ_flag, "PLACEHOLDERS")
+    )
+
+    # Fraction of served thumbnails to record for pruning, 0 disables
+    access_sample_rate: float = dataclasses.field(
+        default_factory=partial(environ_float, "ACCESS_SAMPLE_RATE", 0.0)
+    )
+
+    # Seconds allowed for generating a thumbnail outside of lambda, where the
+    # remaining time of the invocation is used instead. 0 disables
+    generation_timeout: float = dataclasses.field(
+        default_factory=partial(environ_float, "GENERATION_TIMEOUT", 0.0)
+    )
+
+    # Store thumbnails under a hash of their path, to spread the load over
+    # many prefixes. URLs don't change. See tiny_thumbnail_engine.sharding
+    sharded_targets: bool = dataclasses.field(
+        default_factory=partial(environ_flag, "SHARDED_TARGETS")
+    )
+    # Look for (and copy) thumbnails stored before sharding was turned on
+    # Turn off once migrate-shards has moved everything, it costs an extra
+    # lookup on every miss
+    sharded_fallback: bool = dataclasses.field(
+        default_factory=partial(environ_flag, "SHARDED_FALLBACK", True)
+    )
+
+    # Store specs which give the same thumbnail (like 800 and 800x600 for a
+    # 4:3 source) once, under the simplest of them. Uses the dimensions of the
+    # source recorded in its sidecar
+    canonical_specs: bool = dataclasses.field(
+        default_factory=partial(environ_flag, "CANONICAL_SPECS")
+    )
+    # Look for (and copy) thumbnails stored under the requested spec before
+    # canonical specs were turned on. Costs an extra lookup on every miss
+    canonical_fallback: bool = dataclasses.field(
+        default_factory=partial(environ_flag, "CANONICAL_FALLBACK", True)
+    )
+
+    # Seconds to keep sidecars in memory, 0 reads them on every request
+    # Used whenever a sidecar is read while serving a thumbnail, so it also
+    # applies to content addressed thumbnails and placeholders. A source
+    # replaced elsewhere can get its old thumbnails for this long
+    # None is SOURCE_INFO_CACHE_TTL, which defaults to off unless
+    # canonical_specs is on (every hit reads the sidecar then)
+    source_info_cache_ttl: typing.Optional[float] = None
+
+    # Renditions to generate when a source is uploaded, by key prefix
+    # See tiny_thumbnail_engine.pregenerate
+    pregenerate: dict[str, list[str]] = dataclasses.field(
+        default_factory=get_pregenerate_config
+    )
 
     _sign: typing.Any = dataclasses.field(init=False)
     _unsign: typing.Any = dataclasses.field(init=False)
+    _sign_profile: typing.Any = dataclasses.field(init=False)
+    _unsign_profile: typing.Any = dataclasses.field(init=False)
+    _access_recorder: typing.Optional[AccessRecorder] = dataclasses.field(init=False)
+    _source_info_cache: typing.Optional[SourceInfoCache] = dataclasses.field(init=False)
 
     def __post_init__(self):
         self._sign = partial(signing.sign, secret_key=self.secret_key)
         self._unsign = partial(signing.unsign, secret_key=self.secret_key)
+        self._sign_profile = partial(
+            signing.sign, secret_key=self.secret_key, salt=PROFILE_SIGNING_SALT
+        )
+        self._unsign_profile = partial(
+            signing.unsign, secret_key=self.secret_key, salt=PROFILE_SIGNING_SALT
+        )
+
+        if self.vips_config is not None:
+            self.vips_config.apply()
+
+        self._access_recorder = get_access_recorder(
+            self.storage_backend, self.access_sample_rate
+        )
+
+        if self.source_info_cache_ttl is None:
+            self.source_info_cache_ttl = environ_float(
+                "SOURCE_INFO_CACHE_TTL",
+                DEFAULT_CACHE_TTL if self.canonical_specs else 0.0,
+            )
+
+        self._source_info_cache = (
+            SourceInfoCache(self.source_info_cache_ttl)
+            if self.source_info_cache_ttl > 0
+            else None
+        )
 
     def get_thumbnail(self, path: str) -> Thumbnail:
         return Thumbnail.from_path(path, app=self)
+
+    def get_deadline(
+        self, remaining: typing.Optional[float] = None
+    ) -> typing.Optional[Deadline]:
+        """Deadline for generating a thumbnail in this request
+
+        remaining is the time left to respond in seconds, if the server
+        knows it
+        """
+        timeouts = [
+            timeout
+            for timeout in (remaining, self.generation_timeout or None)
+            if timeout is not None
+        ]
+
+        if not timeouts:
+            return None
+
+        return Deadline.after(min(timeouts))
+
+    def get_placeholders(
+        self, paths: typing.Iterable[str], *, concurrency: int = 16
+    ) -> dict[str, typing.Optional[str]]:
+        """Placeholder data URIs for many source paths at once
+
+        None for sources which haven't had a (full frame) thumbnail generated
+        yet. Sidecars are fetched in parallel so a whole page of images
+        costs roughly one round trip.
+        """
+        unique_paths = list(dict.fromkeys(paths))
+
+        def get_placeholder(path: str) -> typing.Optional[str]:
+            info = read_source_info(self, path)
+            return info.placeholder if info is not None else None
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return dict(zip(unique_paths, executor.map(get_placeholder, unique_paths)))
+
+    def _record_access(self, path: PurePath) -> None:
+        if self._access_recorder is not None:
+            self._access_recorder.record(path)
+
+    def flush(self) -> None:
+        """Wait for any background work (like uploads) to finish
+
+        Access records are written in batches, see shutdown
+        """
+        flush = getattr(self.storage_backend, "flush", None)
+
+        if flush is not None:
+            flush()
+
+    def shutdown(self) -> None:
+        """Write everything kept in memory, before the process exits"""
+        if self._access_recorder is not None:
+            self._access_recorder.flush()
+
+        self.flush()
@@ -0,0 +1,221 @@
+"""Bloom filter of the thumbnails in target storage.
+
+Lets a request for a thumbnail which definitely doesn't exist skip the
+storage lookup and go straight to generation. False positives just mean a
+normal lookup.
+
+Built from a listing of the target storage (see build_target_filter) and
+kept in target storage so new execution environments don't have to list
+everything again. Only the build-filter command writes it.
+
+Thumbnails written since the build are published by each execution
+environment as small "delta" objects of their own, which are never
+rewritten, so environments can't overwrite each other's additions. See
+storage.filtered.FilteredBackend for how they're merged.
+"""
+
+import dataclasses
+import hashlib
+import json
+import math
+import struct
+import time
+import typing
+import uuid
+from pathlib import PurePath
+from pathlib import PurePosixPath
+
+from tiny_thumbnail_engine.sharding import is_sharded
+from tiny_thumbnail_engine.sources import CONTENT_ADDRESSED_PREFIX
+from tiny_thumbnail_engine.storage.protocol import StorageObject
+from tiny_thumbnail_engine.storage.protocol import StorageProtocol
+
+
+TARGET_FILTER_PATH: typing.Final[PurePosixPath] = PurePosixPath(
+    "_filters/targets.bloom"
+)
+# Keys added since the filter was built, one object per publish
+FILTER_DELTA_PREFIX: typing.Final[PurePosixPath] = PurePosixPath(
+    "_filters/targets.delta"
+)
+
+DEFAULT_CAPACITY: typing.Final[int] = 1_000_000
+DEFAULT_FALSE_POSITIVE_RATE: typing.Final[float] = 0.01
+
+# Magic, size in bits, number of hashes, number of keys added
+_HEADER: typing.Final[struct.Struct] = struct.Struct(">4sQBQ")
+_MAGIC: typing.Final[bytes] = b"TTB1"
+
+
+@dataclasses.dataclass
+class BloomFilter:
+    # In bits
+    size: int
+    hash_count: int
+    bits: bytearray
+    # Number of keys added, including duplicates
+    count: int = 0
+
+    @classmethod
+    def with_capacity(
+        cls,
+        capacity: int,
+        false_positive_rate: float = DEFAULT_FALSE_POSITIVE_RATE,
+    ) -> "BloomFilter":
+        """Empty filter sized for capacity keys at the given false positive rate"""
+        capacity = max(capacity, 1)
+        size = math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+        # Round up to whole bytes
+        size = (size + 7) // 8 * 8
+        hash_count = max(round(size / capacity * math.log(2)), 1)
+
+        return cls(size, hash_count, bytearray(size // 8))
+
+    def _indexes(self, key: str) -> typing.Iterator[int]:
+        # Double hashing, k hashes from two halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "big")
+        second = int.from_bytes(digest[8:], "big") | 1
+
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size
+
+    def add(self, key: str) -> None:
+        for index in self._indexes(key):
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self.bits[index >> 3] & (1 << (index & 7)) for index in self._indexes(key)
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.bits)
+
+    def false_positive_rate(self) -> float:
+        """Estimated from how many bits are set"""
+        bits_set = bin(int.from_bytes(self.bits, "big")).count("1")
+        return float((bits_set / self.size) ** self.hash_count)
+
+    def to_bytes(self) -> bytes:
+        header = _HEADER.pack(_MAGIC, self.size, self.hash_count, self.count)
+        return header + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "BloomFilter":
+        try:
+            magic, size, hash_count, count = _HEADER.unpack_from(data)
+        except struct.error as e:
+            raise ValueError("Truncated filter") from e
+
+        bits = bytearray(data[_HEADER.size :])
+
+        if magic != _MAGIC or len(bits) * 8 != size:
+            raise ValueError("Not a filter")
+
+        return cls(size, hash_count, bits, count)
+
+
+def is_filtered(path: PurePath) -> bool:
+    """Whether a target key is tracked by the filter
+
+    Thumbnails only, sidecars and other internal files are always looked up
+    """
+    if path.parts[0] == CONTENT_ADDRESSED_PREFIX.name or is_sharded(path):
+        return True
+
+    return not path.parts[0].startswith("_")
+
+
+def build_target_filter(
+    storage_backend: StorageProtocol,
+    *,
+    capacity: int = DEFAULT_CAPACITY,
+    false_positive_rate: float = DEFAULT_FALSE_POSITIVE_RATE,
+) -> BloomFilter:
+    """Filter of every thumbnail currently in target storage"""
+    paths = [
+        target.path
+        for target in storage_backend._list_targets("")
+        if is_filtered(target.path)
+    ]
+
+    # Leave room to grow, the filter gets worse quickly past its capacity
+    bloom = BloomFilter.with_capacity(
+        max(capacity, 2 * len(paths)), false_positive_rate
+    )
+
+    for path in paths:
+        bloom.add(path.as_posix())
+
+    return bloom
+
+
+def read_target_filter(
+    storage_backend: StorageProtocol,
+) -> typing.Optional[BloomFilter]:
+    data = storage_backend._read_target(TARGET_FILTER_PATH)
+
+    if data is None:
+        return None
+
+    return BloomFilter.from_bytes(data)
+
+
+def write_target_filter(storage_backend: StorageProtocol, bloom: BloomFilter) -> None:
+    storage_backend._write_target(
+        TARGET_FILTER_PATH,
+        bloom.to_bytes(),
+        content_type="application/octet-stream",
+    )
+
+
+def write_filter_delta(
+    storage_backend: StorageProtocol, keys: typing.Iterable[str]
+) -> PurePosixPath:
+    """Publish keys added since the filter was built, returns the path"""
+    timestamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+    path = FILTER_DELTA_PREFIX / f"{timestamp}-{uuid.uuid4().hex}.json"
+
+    storage_backend._write_target(
+        path,
+        json.dumps(sorted(keys)).encode(),
+        content_type="application/json",
+    )
+
+    return path
+
+
+def read_filter_delta(
+    storage_backend: StorageProtocol, path: PurePath
+) -> typing.Optional[list[str]]:
+    data = storage_backend._read_target(path)
+
+    if data is None:
+        return None
+
+    keys: list[str] = json.loads(data)
+
+    return keys
+
+
+def list_filter_deltas(storage_backend: StorageProtocol) -> list[StorageObject]:
+    return list(storage_backend._list_targets(f"{FILTER_DELTA_PREFIX}/"))
+
+
+def delete_filter_deltas(storage_backend: StorageProtocol, before: float) -> int:
+    """Delete deltas published before a build started, returns how many
+
+    Their keys were in the listing the build started with
+    """
+    paths = [
+        delta.path
+        for delta in list_filter_deltas(storage_backend)
+        if delta.last_modified is not None and delta.last_modified < before
+    ]
+
+    storage_backend._delete_targets(paths)
+
+    return len(paths)
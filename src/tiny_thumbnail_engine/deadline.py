@@ -0,0 +1,79 @@
+"""Time limits for generating a thumbnail.
+
+When lambda runs out of time it kills the invocation. The client gets a
+generic error after waiting for the whole timeout and the work is lost.
+Instead, the deadline is checked between the stages of a render and libvips
+is asked to stop evaluating once it has passed, so a slow render fails
+quickly with DeadlineExceededError.
+"""
+
+import contextlib
+import dataclasses
+import time
+import typing
+
+
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+from tiny_thumbnail_engine.exceptions import DeadlineExceededError
+
+
+@dataclasses.dataclass(frozen=True)
+class Deadline:
+    # In terms of time.monotonic()
+    expires_at: float
+
+    @classmethod
+    def after(cls, seconds: float) -> "Deadline":
+        return cls(time.monotonic() + seconds)
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, stage: str) -> None:
+        if self.expired():
+            raise DeadlineExceededError(f"Deadline passed before {stage}")
+
+    def watch(self, image: "pyvips.Image") -> None:
+        """Kill the evaluation of image once the deadline has passed
+
+        libvips emits "eval" as it works through the image, so this
+        interrupts a long encode instead of waiting for it to finish
+        """
+
+        def on_eval(image: "pyvips.Image", progress: typing.Any) -> None:
+            if self.expired():
+                image.set_kill(True)
+
+        image.set_progress(True)
+        image.signal_connect("eval", on_eval)
+
+
+# Helpers which do nothing without a deadline, see profiling.stage
+
+
+def check_deadline(deadline: typing.Optional[Deadline], stage: str) -> None:
+    if deadline is not None:
+        deadline.check(stage)
+
+
+def watch_deadline(deadline: typing.Optional[Deadline], image: "pyvips.Image") -> None:
+    if deadline is not None:
+        deadline.watch(image)
+
+
+@contextlib.contextmanager
+def cancellable(deadline: typing.Optional[Deadline]) -> typing.Iterator[None]:
+    """Report a killed evaluation as DeadlineExceededError"""
+    try:
+        yield
+    except pyvips.Error as e:
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceededError("Deadline passed while rendering") from e
+        raise
@@ -33,3 +33,45 @@ def EnvironFactory(key: str, class_name: str) -> typing.Callable[[], str]:
         return value
 
     return inner
+
+
+# Optional settings, these fall back to a default instead of raising
+
+
+def environ_flag(key: str, default: bool = False) -> bool:
+    value = os.environ.get(f"{ENVIRON_PREFIX}_{key}", "")
+
+    if not value:
+        return default
+
+    return value.lower() not in {"0", "false", "no", "off"}
+
+
+def environ_int(key: str, default: int) -> int:
+    value = os.environ.get(f"{ENVIRON_PREFIX}_{key}", "")
+
+    if not value:
+        return default
+
+    try:
+        return int(value)
+    except ValueError as e:
+        raise ImproperlyConfiguredError(
+            f"The environmental variable {ENVIRON_PREFIX}_{key} "
+            f"must be an integer, got {value!r}."
+        ) from e
+
+
+def environ_float(key: str, default: float) -> float:
+    value = os.environ.get(f"{ENVIRON_PREFIX}_{key}", "")
+
+    if not value:
+        return default
+
+    try:
+        return float(value)
+    except ValueError as e:
+        raise ImproperlyConfiguredError(
+            f"The environmental variable {ENVIRON_PREFIX}_{key} "
+            f"must be a number, got {value!r}."
+        ) from e
@@ -5,3 +5,7 @@ class ImproperlyConfiguredError(Exception):
 # Wrap "not enough values to unpack"
 class UrlError(ValueError):
     pass
+
+
+class DeadlineExceededError(Exception):
+    """Ran out of time generating a thumbnail"""
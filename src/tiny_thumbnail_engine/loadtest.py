@@ -0,0 +1,344 @@
+"""Load testing harness for the lambda handler.
+
+Runs server.aws.lambda_handler in-process against a list of signed
+thumbnail URLs, either replayed from an access log or generated
+synthetically, and reports hit ratio, latency percentiles, throughput and
+peak memory.
+
+By default the storage backend is the in-process MemoryBackend, seeded
+from a local directory of source images. Any other backend (for instance
+S3Backend pointed at a local S3-compatible server) can be used instead.
+"""
+
+import collections
+import dataclasses
+import os
+import random
+import re
+import resource
+import statistics
+import sys
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from pathlib import PurePath
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+from tiny_thumbnail_engine.bloom import is_filtered
+from tiny_thumbnail_engine.environ import ENVIRON_PREFIX
+
+
+if typing.TYPE_CHECKING:
+    from tiny_thumbnail_engine.app import App
+    from tiny_thumbnail_engine.storage.protocol import StorageProtocol
+
+
+# Handles common/combined log format as well as one URL per line
+_REQUEST_PATTERN: typing.Final[typing.Pattern[str]] = re.compile(
+    r'"GET (?P<url>\S+) HTTP/[\d.]+"'
+)
+
+
+def load_access_log(path: Path) -> list[str]:
+    """Read thumbnail URLs (path and query string) from an access log"""
+    urls = []
+
+    with path.open() as f:
+        for line in f:
+            line = line.strip()
+
+            if not line or line.startswith("#"):
+                continue
+
+            match = _REQUEST_PATTERN.search(line)
+            urls.append(match.group("url") if match else line)
+
+    return urls
+
+
+def synthetic_access_log(
+    app: "App",
+    sources: typing.Sequence[str],
+    specs: typing.Sequence[str],
+    formats: typing.Sequence[str],
+    *,
+    count: int,
+    skew: float = 1.0,
+    seed: typing.Optional[int] = None,
+) -> list[str]:
+    """Generate signed URLs with a zipf-like popularity distribution
+
+    A handful of thumbnails get most of the traffic and there is a long tail,
+    which is roughly what a CDN origin sees
+    """
+    # Avoid circular import
+    from tiny_thumbnail_engine.model import Thumbnail
+    from tiny_thumbnail_engine.model import ThumbnailSpec
+
+    rng = random.Random(seed)  # noqa: S311
+
+    urls = [
+        Thumbnail(
+            source,
+            ThumbnailSpec.from_string(spec),
+            typing.cast(typing.Any, output_format),
+            app=app,
+        ).url
+        for source in sources
+        for spec in specs
+        for output_format in formats
+    ]
+    rng.shuffle(urls)
+
+    weights = [1 / rank**skew for rank in range(1, len(urls) + 1)]
+
+    return rng.choices(urls, weights=weights, k=count)
+
+
+def _to_event(url: str) -> dict[str, typing.Any]:
+    parts = urlsplit(url)
+
+    return {
+        "httpMethod": "GET",
+        "path": "/" + parts.path.lstrip("/"),
+        "multiValueQueryStringParameters": parse_qs(parts.query),
+        "multiValueHeaders": {},
+        "body": "",
+        "isBase64Encoded": False,
+    }
+
+
+class _CountingBackend:
+    """Wrap a storage backend to count requests served from target storage
+
+    A request is a hit if a thumbnail it looked up was found (at any of its
+    keys), a miss if it only looked up thumbnails which weren't there.
+    Sidecars, the target filter, etc. aren't counted
+    """
+
+    def __init__(self, backend: "StorageProtocol") -> None:
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Handlers run on the thread which sent the request
+        self._request = threading.local()
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self.backend, name)
+
+    def start_request(self) -> None:
+        # None until a thumbnail is looked up
+        self._request.found = None
+
+    def finish_request(self) -> None:
+        found = self._request.found
+
+        if found is None:
+            return
+
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _read_target(self, path: PurePath) -> typing.Optional[bytes]:
+        data = self.backend._read_target(path)
+
+        if is_filtered(path):
+            self._request.found = bool(self._request.found) or data is not None
+
+        return data
+
+
+def _peak_rss() -> int:
+    """Peak resident set size of this process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS reports bytes
+    if sys.platform == "darwin":
+        return peak
+
+    return peak * 1024
+
+
+@dataclasses.dataclass
+class LoadTestResult:
+    duration: float
+    # Seconds, measured from when the request was scheduled to be sent so
+    # that time spent queued behind other requests is included
+    latencies: list[float]
+    status_codes: collections.Counter[int]
+    target_hits: int
+    target_misses: int
+    peak_rss: int
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.target_hits + self.target_misses
+        return self.target_hits / lookups if lookups else 0.0
+
+    @property
+    def throughput(self) -> float:
+        return len(self.latencies) / self.duration if self.duration else 0.0
+
+    def percentile(self, percent: int) -> float:
+        if len(self.latencies) < 2:
+            return self.latencies[0] if self.latencies else 0.0
+
+        return statistics.quantiles(self.latencies, n=100)[percent - 1]
+
+    def report(self) -> str:
+        status_codes = ", ".join(
+            f"{code}: {count}" for code, count in sorted(self.status_codes.items())
+        )
+
+        return "\n".join(
+            [
+                f"requests:     {len(self.latencies)}",
+                f"status codes: {status_codes}",
+                f"hit ratio:    {self.hit_ratio:.1%}",
+                f"throughput:   {self.throughput:.1f} req/s",
+                f"p50 latency:  {self.percentile(50) * 1000:.1f} ms",
+                f"p95 latency:  {self.percentile(95) * 1000:.1f} ms",
+                f"p99 latency:  {self.percentile(99) * 1000:.1f} ms",
+                f"peak rss:     {self.peak_rss / 1024 / 1024:.1f} MiB",
+            ]
+        )
+
+
+def run_load_test(
+    handler: typing.Callable[[dict[str, typing.Any], typing.Any], typing.Any],
+    app: "App",
+    urls: typing.Sequence[str],
+    *,
+    rate: typing.Optional[float] = None,
+    concurrency: int = 1,
+) -> LoadTestResult:
+    """Send every URL through the handler
+
+    With a rate, requests are scheduled at fixed intervals regardless of
+    how long earlier requests took (open loop). Without, they are sent as fast
+    as the workers allow.
+    """
+    counting_backend = _CountingBackend(app.storage_backend)
+    app.storage_backend = typing.cast("StorageProtocol", counting_backend)
+
+    latencies: list[float] = []
+    status_codes: collections.Counter[int] = collections.Counter()
+    lock = threading.Lock()
+
+    start = time.perf_counter()
+
+    def send(index: int, url: str) -> None:
+        if rate:
+            scheduled = start + index / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            scheduled = time.perf_counter()
+
+        counting_backend.start_request()
+
+        try:
+            response = handler(_to_event(url), None)
+            status_code = response["statusCode"]
+        # Report it like lambda would
+        except Exception:
+            status_code = 500
+        finally:
+            counting_backend.finish_request()
+
+        latency = time.perf_counter() - scheduled
+
+        with lock:
+            latencies.append(latency)
+            status_codes[status_code] += 1
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for index, url in enumerate(urls):
+                executor.submit(send, index, url)
+
+        duration = time.perf_counter() - start
+    finally:
+        app.storage_backend = counting_backend.backend
+
+    return LoadTestResult(
+        duration=duration,
+        latencies=latencies,
+        status_codes=status_codes,
+        target_hits=counting_backend.hits,
+        target_misses=counting_backend.misses,
+        peak_rss=_peak_rss(),
+    )
+
+
+def main(
+    *,
+    access_log: typing.Optional[Path],
+    source_dir: typing.Optional[Path],
+    synthetic: int,
+    specs: typing.Sequence[str],
+    formats: typing.Sequence[str],
+    rate: typing.Optional[float],
+    concurrency: int,
+    storage_latency: float,
+    seed: typing.Optional[int],
+) -> None:
+    # The handler reads its configuration when it is imported
+    os.environ.setdefault("CLOUDFRONT_VERIFY", "")
+    os.environ.setdefault(
+        f"{ENVIRON_PREFIX}_STORAGE_BACKEND",
+        "tiny_thumbnail_engine.storage.memory.MemoryBackend",
+    )
+
+    from tiny_thumbnail_engine.server import aws
+    from tiny_thumbnail_engine.storage.memory import MemoryBackend
+
+    backend = aws.app.storage_backend
+    # Might be wrapped for background writes, the target filter, etc.
+    while hasattr(backend, "backend"):
+        backend = backend.backend
+
+    if isinstance(backend, MemoryBackend):
+        backend.latency = storage_latency
+
+        if source_dir is not None:
+            for file in sorted(source_dir.rglob("*")):
+                if file.is_file():
+                    backend.add_source(
+                        file.relative_to(source_dir).as_posix(), file.read_bytes()
+                    )
+
+    if access_log is not None:
+        urls = load_access_log(access_log)
+    elif isinstance(backend, MemoryBackend) and backend.sources:
+        urls = synthetic_access_log(
+            aws.app,
+            list(backend.sources),
+            specs,
+            formats,
+            count=synthetic,
+            seed=seed,
+        )
+    else:
+        raise SystemExit("Provide an access log or a directory of source images.")
+
+    result = run_load_test(
+        aws.lambda_handler,
+        aws.app,
+        urls,
+        rate=rate,
+        concurrency=concurrency,
+    )
+
+    # Wait for background uploads, otherwise they skew the next run
+    aws.app.flush()
+
+    print(result.report())
@@ -7,10 +7,15 @@ Not responsible for fetching/upload data to filesystem(s) or s3
 Not responsible directly for generating or validating signatures or auth tokens
 """
 
+import base64
 import dataclasses
+import logging
+import queue
 import re
+import time
 import typing
 import posixpath
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
 from pathlib import PurePosixPath
 
@@ -20,11 +25,34 @@ try:
 except ImportError:
     pyvips = None
 
+from .deadline import Deadline
+from .deadline import cancellable
+from .deadline import check_deadline
+from .deadline import watch_deadline
 from .exceptions import UrlError
+from .profiling import PROFILE_MAX_AGE
+from .profiling import RequestProfile
+from .profiling import get_profile_value
+from .profiling import split_profile_signature
+from .profiling import stage
+from .sharding import is_sharded
+from .sharding import shard_path
+from .sharding import unshard_path
+from .signing import BadSignatureError
+from .sources import CONTENT_ADDRESSED_PREFIX
+from .sources import SOURCE_VERSION_METADATA
+from .sources import SourceInfo
+from .sources import read_source_info
+from .sources import source_digest
+from .sources import write_source_info
 
 # Avoid circular dependency unless type checkgin
 if typing.TYPE_CHECKING:
     from .app import App
+    from .vips import AccessMode
+
+
+logger = logging.getLogger(__name__)
 
 
 # TODO Move to exceptions
@@ -33,26 +61,112 @@ class ServerMissingDependancyError(RuntimeError):
     Did you install tiny-thumbnail-engine[server]"""
 
 
+# Size of the chunks handed to the client when streaming a thumbnail which
+# already exists in target storage
+STREAM_CHUNK_SIZE: typing.Final[int] = 64 * 1024
+
+# Maximum number of encoded chunks waiting to be uploaded while streaming
+STREAM_QUEUE_SIZE: typing.Final[int] = 16
+
+DEFAULT_QUALITY: typing.Final[int] = 80
+
+# Byte budget encoding won't go any lower than this
+MIN_QUALITY: typing.Final[int] = 30
+
+# Stop searching once the image uses this much of the budget
+# Squeezing out the last few percent isn't worth another encode
+BUDGET_TOLERANCE: typing.Final[float] = 0.1
+
+# Longest side of the placeholder in pixels, it's blown up (and blurred)
+# by the browser so it really doesn't need to be any bigger
+PLACEHOLDER_SIZE: typing.Final[int] = 16
+PLACEHOLDER_QUALITY: typing.Final[int] = 30
+
+# Target metadata for byte budget renders
+QUALITY_METADATA: typing.Final[str] = "quality"
+ENCODE_ATTEMPTS_METADATA: typing.Final[str] = "encode-attempts"
+
+
 def _convert_int(value: typing.Any) -> typing.Optional[int]:
     if value in {"", None}:
         return None
     return int(value)
 
 
-def _clamped_int(value: int) -> int:
+def _clamped_int(value: float) -> int:
     return max(int(round(value)), 1)
 
 
+def _write_chunks(data: bytes, write: typing.Callable[[bytes], typing.Any]) -> None:
+    for offset in range(0, len(data), STREAM_CHUNK_SIZE):
+        write(data[offset : offset + STREAM_CHUNK_SIZE])
+
+
+def _make_placeholder(image: "pyvips.Image") -> str:
+    placeholder = image.thumbnail_image(PLACEHOLDER_SIZE, height=PLACEHOLDER_SIZE)
+    # Transparency would need its own handling in the browser, flatten it
+    if placeholder.hasalpha():
+        placeholder = placeholder.flatten(background=[255, 255, 255])
+
+    data = placeholder.write_to_buffer(".webp", Q=PLACEHOLDER_QUALITY, strip=True)
+
+    return f"data:image/webp;base64,{base64.b64encode(data).decode()}"
+
+
+def _needs_rotation(image: "pyvips.Image") -> bool:
+    # 0 means the field doesn't exist
+    if not image.get_typeof("orientation"):
+        return False
+
+    return bool(image.get("orientation") != 1)
+
+
+def _probe_dimensions(buffer: bytes) -> tuple[int, int]:
+    """Width and height of the source once it's rotated, from the header"""
+    image = pyvips.Image.new_from_buffer(buffer, "", access="sequential")
+
+    dimensions = image.width, image.height
+
+    # 5 to 8 are rotated by 90 or 270 degrees
+    if image.get_typeof("orientation") and image.get("orientation") in {5, 6, 7, 8}:
+        dimensions = image.height, image.width
+
+    return typing.cast(tuple[int, int], dimensions)
+
+
 class ThumbnailSpecMatch(typing.TypedDict):
     width: str
     height: typing.Optional[str]
     padding: typing.Literal["p", ""]
     upscale: typing.Literal["u", ""]
     crop: typing.Literal["c", ""]
+    crop_strategy: typing.Optional[typing.Literal["c", "e", "a"]]
+    focal_x: typing.Optional[str]
+    focal_y: typing.Optional[str]
+    max_bytes: typing.Optional[str]
 
 
 ThumbnailFormat: typing.TypeAlias = typing.Literal[".webp", ".jpg"]
 
+# How to pick the part of the image to keep when cropping
+# Centre is the cheapest, entropy and attention analyse the image
+CropStrategy: typing.TypeAlias = typing.Literal["centre", "entropy", "attention"]
+
+# Entropy is the default, so it isn't included in the spec string
+_CROP_STRATEGY_CODES: typing.Final[dict[str, CropStrategy]] = {
+    "c": "centre",
+    "e": "entropy",
+    "a": "attention",
+}
+
+
+if pyvips is not None:
+    _INTERESTING: typing.Final[dict[CropStrategy, typing.Any]] = {
+        "centre": pyvips.enums.Interesting.CENTRE,
+        "entropy": pyvips.enums.Interesting.ENTROPY,
+        "attention": pyvips.enums.Interesting.ATTENTION,
+    }
+
 
 @dataclasses.dataclass
 class ThumbnailSpec:
@@ -89,6 +203,24 @@ class ThumbnailSpec:
     200 - Scale image so that the width is at most 200 pixels. Height is unconstrained
 
     x300 - Scale image so that the height is at most 300 pixels. Width is unconstrained
+
+    The crop strategy can follow the "c"
+
+    200x300cc - Crop around the centre of the image. Cheapest option.
+
+    200x300ce - Crop around the most "interesting" part of the image as
+      determined by entropy. Same as 200x300c
+
+    200x300ca - Crop around the most "interesting" part of the image as
+      determined by the attention strategy (looks for skin tones, edges, etc.)
+
+    200x300cf25,40 - Crop around a known focal point. The coordinates are
+      percentages of the width and height of the source image. No saliency
+      analysis is done at all. Because the focal point is part of the spec,
+      it is covered by the signature
+
+    800b50000 - Any of the above, encoded at the highest quality which keeps
+      the file under 50000 bytes
     """
 
     # I'm not sure if some combinations of padding/upscale/crop are nonsense?
@@ -101,6 +233,12 @@ class ThumbnailSpec:
             (?P<padding>p?)
             (?P<upscale>u?)
             (?P<crop>c?)
+            (?:
+                (?P<crop_strategy>[cea])
+                |
+                f(?P<focal_x>\d{1,3}),(?P<focal_y>\d{1,3})
+            )?
+            (?:b(?P<max_bytes>\d+))?
         $
     """,
         flags=re.VERBOSE,
@@ -120,6 +258,13 @@ class ThumbnailSpec:
     upscale: bool
     crop: bool
 
+    crop_strategy: CropStrategy = "entropy"
+    # Percentages of the width and height of the source image
+    focal_point: typing.Optional[tuple[int, int]] = None
+
+    # Byte budget for the encoded image, quality is lowered to fit
+    max_bytes: typing.Optional[int] = None
+
     @classmethod
     def from_string(cls, spec: str) -> "ThumbnailSpec":
         match = cls.SPEC_PATTERN.search(spec)
@@ -129,12 +274,32 @@ class ThumbnailSpec:
 
         d: ThumbnailSpecMatch = match.groupdict()
 
+        focal_point: typing.Optional[tuple[int, int]] = None
+
+        if d["focal_x"] is not None and d["focal_y"] is not None:
+            focal_point = (int(d["focal_x"]), int(d["focal_y"]))
+
+            if not all(0 <= value <= 100 for value in focal_point):
+                raise ValueError(f"Invalid focal point: {spec!r}")
+
+        # Strategy without the crop flag is nonsense
+        if not d["crop"] and (d["crop_strategy"] or focal_point):
+            raise ValueError(f"Invalid spec: {spec!r}")
+
+        # So is a strategy with a single dimension, to_string drops it so the
+        # signature wouldn't cover it
+        if not (d["width"] and d["height"]) and (d["crop_strategy"] or focal_point):
+            raise ValueError(f"Invalid spec: {spec!r}")
+
         return cls(
             width=_convert_int(d["width"]),
             height=_convert_int(d["height"]),
             padding=bool(d["padding"]),
             upscale=bool(d["upscale"]),
             crop=bool(d["crop"]),
+            crop_strategy=_CROP_STRATEGY_CODES[d["crop_strategy"] or "e"],
+            focal_point=focal_point,
+            max_bytes=_convert_int(d["max_bytes"]),
         )
 
     def to_string(self) -> str:
@@ -160,14 +325,73 @@ class ThumbnailSpec:
         if self.width and self.height and self.crop:
             spec += "c"
 
+            # Entropy is implied
+            if self.focal_point is not None:
+                spec += f"f{self.focal_point[0]},{self.focal_point[1]}"
+            elif self.crop_strategy != "entropy":
+                spec += self.crop_strategy[0]
+
         # It's not recommended to try and create a thumbnail without specifying
         # at least width and height
         # TODO Subclass this error?
         if not spec:
             raise ValueError("Not actually transforming thumbnail")
 
+        if self.max_bytes:
+            spec += f"b{self.max_bytes}"
+
         return spec
 
+    def canonicalize(self, source_width: int, source_height: int) -> "ThumbnailSpec":
+        """Simplest spec which gives the same thumbnail of a source this size
+
+        Only rewrites specs where libvips ends up doing exactly the same
+        thing, so the output is identical
+
+        800 -> 800x600 for a 4:3 source
+        1200x900u -> 1200x900 for a source which doesn't need upscaling
+        1200x900 -> 1000x750 for a 1000x750 source, nothing is resized
+        """
+        # Padding depends on whether the height was given
+        if self.padding:
+            return self
+
+        # Same as in Thumbnail._process
+        aspect_ratio = source_width / source_height
+
+        if self.width:
+            width = self.width
+            height = self.height or _clamped_int(width / aspect_ratio)
+        elif self.height:
+            width = _clamped_int(self.height * aspect_ratio)
+            height = self.height
+        else:
+            raise ValueError("Spec has neither a width nor a height")
+
+        # Scaled to cover the box when cropping, to fit inside it otherwise
+        if self.crop:
+            shrinks = width <= source_width and height <= source_height
+        else:
+            shrinks = width <= source_width or height <= source_height
+
+        # Upscaling never kicks in
+        upscale = self.upscale and not shrinks
+
+        fits = source_width <= width and source_height <= height
+
+        # Left as it is, focal point crops skip the thumbnail operation
+        if fits and not upscale and self.focal_point is None:
+            return ThumbnailSpec(
+                source_width,
+                source_height,
+                padding=False,
+                upscale=False,
+                crop=False,
+                max_bytes=self.max_bytes,
+            )
+
+        return dataclasses.replace(self, width=width, height=height, upscale=upscale)
+
 
 @dataclasses.dataclass
 class Thumbnail:
@@ -181,12 +405,39 @@ class Thumbnail:
     # retrieve files and persist the final image
     app: "App"
 
+    # Sidecar for the source, only read when needed and at most once
+    _source_info: typing.Optional[SourceInfo] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _source_info_loaded: bool = dataclasses.field(
+        default=False, init=False, repr=False, compare=False
+    )
+    # Changed since it was read, see _save_source_info
+    _source_info_changed: bool = dataclasses.field(
+        default=False, init=False, repr=False, compare=False
+    )
+
+    # Only set while profiling, see generate_profiled
+    _profile: typing.Optional[RequestProfile] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
+    # Time limit for the current request, see get_or_generate
+    _deadline: typing.Optional[Deadline] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
+    # Source read while looking the thumbnail up, see _lookup
+    _prefetched_source: typing.Optional[tuple[bytes, str]] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
+
     def _get_thumbnail_path(self) -> PurePosixPath:
         """Relative path to the final thumbnail"""
+        return self._get_spec_path(self.spec)
 
+    def _get_spec_path(self, spec: ThumbnailSpec) -> PurePosixPath:
         path = PurePosixPath(self.path)
 
-        return path / self.spec.to_string() / path.with_suffix(self.format).name
+        return path / spec.to_string() / path.with_suffix(self.format).name
 
     # Should this just be __str__ ?
     @cached_property
@@ -198,21 +449,327 @@ class Thumbnail:
         # Used urlencode before, but we know signature is already urlsafe
         return f"{thumbnail_path}?signature={signature}"
 
-    def get_or_generate(self, *, signature: str) -> bytes:
-        thumbnail_path = self._get_thumbnail_path()
+    def _get_content_addressed_path(
+        self, digest: str, spec: ThumbnailSpec
+    ) -> PurePosixPath:
+        """Path to the thumbnail shared by all sources with the same contents"""
+        return (
+            CONTENT_ADDRESSED_PREFIX
+            / digest[:2]
+            / digest
+            / f"{spec.to_string()}{self.format}"
+        )
 
-        data = self.app.storage_backend._read_target(thumbnail_path)
+    def _get_path_keyed_target(self, spec: ThumbnailSpec) -> PurePosixPath:
+        """Where the thumbnail is stored when not content addressed"""
+        if self.app.sharded_targets:
+            return shard_path(self._get_spec_path(spec))
 
-        if data is not None:
-            return data
+        return self._get_spec_path(spec)
+
+    def _get_stored_spec(
+        self, info: typing.Optional[SourceInfo]
+    ) -> typing.Optional[ThumbnailSpec]:
+        """Spec the thumbnail is stored under
+
+        None if it depends on the dimensions of the source, and those
+        aren't known yet
+        """
+        if not self.app.canonical_specs:
+            return self.spec
+
+        if info is None or info.width is None or info.height is None:
+            return None
+
+        return self.spec.canonicalize(info.width, info.height)
+
+    def _get_target_path(self) -> typing.Optional[PurePosixPath]:
+        """Where the thumbnail is stored if it has been generated already
+
+        None if that can't be known without reading the source
+        """
+        uses_source_info = self.app.content_addressed or self.app.canonical_specs
+        info = self._load_source_info() if uses_source_info else None
+
+        # Dimensions not known yet, it could still be stored under the
+        # requested spec. If not, the canonical key is checked once the
+        # source has been read
+        spec = self._get_stored_spec(info) or self.spec
+
+        return self._get_spec_target(spec, info)
+
+    def _get_spec_target(
+        self, spec: ThumbnailSpec, info: typing.Optional[SourceInfo]
+    ) -> typing.Optional[PurePosixPath]:
+        if not self.app.content_addressed:
+            return self._get_path_keyed_target(spec)
+
+        if info is None:
+            return None
+
+        return self._get_content_addressed_path(info.digest, spec)
+
+    def _load_source_info(self) -> typing.Optional[SourceInfo]:
+        if not self._source_info_loaded:
+            cache = self.app._source_info_cache
+            info = cache.get(self.path) if cache is not None else None
+
+            if info is None:
+                info = read_source_info(self.app, self.path)
+
+                # Missing sidecars aren't cached, they're written on the
+                # first render
+                if info is not None and cache is not None:
+                    cache.set(self.path, info)
+
+            self._source_info = info
+            self._source_info_loaded = True
+
+        return self._source_info
+
+    def _sync_source_info(self, buffer: bytes, version: str) -> SourceInfo:
+        """Sidecar matching the source as it was just read
+
+        Only changed in memory, see _save_source_info
+        """
+        info = self._load_source_info()
+
+        # Same version, same contents, no need to hash it again
+        if info is not None and info.version == version:
+            updated = info
+        else:
+            digest = source_digest(buffer)
+
+            # First time this source has been read, or it has been replaced
+            # Anything derived from the old contents is dropped
+            if info is None or info.digest != digest:
+                updated = SourceInfo(digest=digest, version=version)
+            else:
+                updated = dataclasses.replace(info, version=version)
+
+        if self.app.canonical_specs and (
+            updated.width is None or updated.height is None
+        ):
+            width, height = _probe_dimensions(buffer)
+            updated = dataclasses.replace(updated, width=width, height=height)
+
+        if updated != info:
+            self._source_info = updated
+            self._source_info_changed = True
+
+        return updated
+
+    def _save_source_info(self) -> None:
+        """Write the sidecar if it has changed
+
+        Called once the render has added what it's going to (the
+        placeholder), so a first render writes the sidecar only once
+        """
+        if not self._source_info_changed:
+            return
+
+        info = self._source_info
+        assert info is not None  # noqa: S101
+
+        write_source_info(self.app, self.path, info)
+        self._source_info_changed = False
+
+        if self.app._source_info_cache is not None:
+            self.app._source_info_cache.set(self.path, info)
+
+    def _get_source_target_path(self, buffer: bytes, version: str) -> PurePosixPath:
+        """Where to store the thumbnail, now that the source has been read"""
+        if not (self.app.content_addressed or self.app.canonical_specs):
+            return self._get_path_keyed_target(self.spec)
+
+        info = self._sync_source_info(buffer, version)
+        spec = self._get_stored_spec(info)
+
+        # Dimensions were just recorded
+        assert spec is not None  # noqa: S101
+
+        if not self.app.content_addressed:
+            return self._get_path_keyed_target(spec)
+
+        return self._get_content_addressed_path(info.digest, spec)
+
+    def get_or_generate(
+        self, *, signature: str, deadline: typing.Optional[Deadline] = None
+    ) -> bytes:
+        """Thumbnail from target storage, generated first if it's missing
+
+        With a deadline, raises DeadlineExceededError instead of finishing
+        a render which would run past it
+        """
+        self._deadline = deadline
+
+        target_path = self._get_target_path()
+
+        if target_path is not None:
+            data = self._lookup(target_path, signature)
+
+            if data is not None:
+                return data
 
         # raises if invalid
+        # Always checked against the URL, even if the thumbnail is stored
+        # somewhere else
+        self._check_signature(signature)
+
+        return self._generate(target_path)
+
+    def _check_signature(self, signature: str) -> None:
         self.app._unsign(
-            value=str(thumbnail_path),
+            value=str(self._get_thumbnail_path()),
             signature=signature,
         )
 
-        return self._generate(thumbnail_path)
+    def _lookup(
+        self, target_path: PurePosixPath, signature: str
+    ) -> typing.Optional[bytes]:
+        """Thumbnail from target storage, None if it has to be generated
+
+        If the target filter says it's missing, the source is read at the
+        same time, so a miss doesn't wait for the lookup before rendering
+        """
+        might_exist = getattr(self.app.storage_backend, "_might_exist", None)
+
+        if might_exist is None or might_exist(target_path):
+            return self._read_existing(target_path)
+
+        # Don't read sources for requests which would be turned away anyway
+        self._check_signature(signature)
+
+        # Still looked up, another execution environment could have stored it
+        # since the filter was loaded. Then the source read is wasted
+        executor = ThreadPoolExecutor(max_workers=1)
+        source = executor.submit(self._read_source)
+
+        try:
+            data = self._read_existing(target_path)
+        finally:
+            executor.shutdown(wait=False)
+
+        if data is None:
+            # Raises if the source can't be read, same as generating would
+            self._prefetched_source = source.result()
+
+        return data
+
+    def _read_existing(self, target_path: PurePosixPath) -> typing.Optional[bytes]:
+        data = self.app.storage_backend._read_target(target_path)
+
+        if data is None and self._has_legacy_path(target_path):
+            data = self._copy_legacy(target_path)
+
+        if data is None:
+            requested_path = self._get_requested_path(target_path)
+
+            if requested_path is not None:
+                data = self._copy_to(requested_path, target_path)
+
+        if data is not None:
+            self.app._record_access(target_path)
+
+        return data
+
+    def _has_legacy_path(self, target_path: PurePosixPath) -> bool:
+        """Whether the thumbnail could be under its unsharded key"""
+        return self.app.sharded_fallback and is_sharded(target_path)
+
+    def _copy_legacy(self, target_path: PurePosixPath) -> typing.Optional[bytes]:
+        """Thumbnail stored before sharding was turned on, copied to target_path"""
+        # The old key is left alone, migrate-shards cleans up
+        return self._copy_to(unshard_path(target_path), target_path)
+
+    def _get_requested_path(
+        self, target_path: PurePosixPath
+    ) -> typing.Optional[PurePosixPath]:
+        """Where the thumbnail was stored before canonical specs were turned on
+
+        None if that's target_path, or it isn't worth looking
+        """
+        if not (self.app.canonical_specs and self.app.canonical_fallback):
+            return None
+
+        requested_path = self._get_spec_target(self.spec, self._source_info)
+
+        if requested_path == target_path:
+            return None
+
+        return requested_path
+
+    def _copy_to(
+        self, stored_path: PurePosixPath, target_path: PurePosixPath
+    ) -> typing.Optional[bytes]:
+        """Thumbnail stored at stored_path, copied to target_path"""
+        storage_backend = self.app.storage_backend
+
+        data = storage_backend._read_target(stored_path)
+
+        if data is None:
+            return None
+
+        storage_backend._write_target(
+            target_path,
+            data,
+            content_type=self.content_type,
+            metadata=storage_backend._read_target_metadata(stored_path),
+        )
+
+        return data
+
+    def get_profile_signature(self, max_age: int = PROFILE_MAX_AGE) -> str:
+        """Value of the profiling header, keep it away from browsers
+
+        Only good for max_age seconds
+        """
+        expires = int(time.time()) + max_age
+        signature = self.app._sign_profile(
+            value=get_profile_value(self._get_thumbnail_path(), expires)
+        )
+
+        return f"{expires}.{signature}"
+
+    def generate_profiled(
+        self, *, signature: str, profile_signature: str
+    ) -> tuple[bytes, PurePosixPath]:
+        """Generate the thumbnail (even if it exists) and profile it
+
+        Returns the thumbnail and the path of the report in target storage
+        """
+        thumbnail_path = self._get_thumbnail_path()
+
+        # raises if invalid
+        self.app._unsign(value=str(thumbnail_path), signature=signature)
+        expires, profile_grant = split_profile_signature(profile_signature)
+        self.app._unsign_profile(
+            value=get_profile_value(thumbnail_path, expires), signature=profile_grant
+        )
+
+        if time.time() > expires:
+            raise BadSignatureError("Profile signature has expired")
+
+        self._profile = profile = RequestProfile(thumbnail_path)
+
+        profile.profiler.enable()
+        try:
+            with profile.stage("lookup"):
+                target_path = self._get_target_path()
+
+            data = self._generate(target_path, force=True, rerender=True)
+        finally:
+            profile.profiler.disable()
+            self._profile = None
+
+        return data, profile.save(self.app)
+
+    def _checkpoint(self, image: "pyvips.Image") -> "pyvips.Image":
+        """Run the pipeline so far if profiling, so the stage is timed"""
+        if self._profile is None:
+            return image
+
+        return image.copy_memory()
 
     @property
     def content_type(self) -> str:
@@ -227,41 +784,73 @@ class Thumbnail:
 
         raise ValueError(f"Unknown content_type: {self.format!r}")
 
-    def _generate(self, target_path: PurePosixPath) -> bytes:
+    def _read_source(self) -> tuple[bytes, str]:
+        """Source bytes and the version they were read at"""
         if pyvips is None:
             raise ServerMissingDependancyError
 
-        spec: ThumbnailSpec = self.spec
+        if self._prefetched_source is not None:
+            source, self._prefetched_source = self._prefetched_source, None
+            return source
 
         # Can create an error
         # Read data using storage backend
-        buffer: bytes = self.app.storage_backend._read_source(PurePosixPath(self.path))
+        return self.app.storage_backend._read_source_with_version(
+            PurePosixPath(self.path)
+        )
 
-        # "" means no options
-        # Not sure what options are available
-        image = pyvips.Image.new_from_buffer(buffer, "")
+    def _load_image(self, buffer: bytes) -> "pyvips.Image":
+        access = self._get_access()
+
+        # Only the header is read at this point
+        image = pyvips.Image.new_from_buffer(buffer, "", access=access)
+
+        # Rotating needs random access to the pixels
+        if access == "sequential" and _needs_rotation(image):
+            image = pyvips.Image.new_from_buffer(buffer, "", access="random")
 
         # We need to do this because we need to calculate image aspect
         # ratio in the next step
-        image = image.autorot()
+        return image.autorot()
+
+    def _get_access(self) -> "AccessMode":
+        vips_config = self.app.vips_config
+
+        if vips_config is None:
+            return "random"
+
+        # Smart cropping analyses the whole image before cutting it, which
+        # doesn't work with a single top-to-bottom pass
+        if self.spec.crop and self.spec.focal_point is None:
+            if self.spec.crop_strategy != "centre":
+                return "random"
+
+        return vips_config.access
+
+    def _process(self, image: "pyvips.Image") -> "pyvips.Image":
+        spec: ThumbnailSpec = self.spec
 
         aspect_ratio = image.width / image.height
 
         width = spec.width or _clamped_int(spec.height * aspect_ratio)
         height = spec.height or _clamped_int(width / aspect_ratio)
 
-        thumbnail_kwargs = {
-            "height": height,
-            "size": pyvips.enums.Size.BOTH if spec.upscale else pyvips.enums.Size.DOWN,
-            # There are ENTROPY and ATTENTION
-            # options which are probably useful here
-            # I tested ENTROPY and it actually worked pretty well as a sane default
-            "crop": pyvips.enums.Interesting.ENTROPY
-            if spec.crop
-            else pyvips.enums.Interesting.NONE,
-        }
-
-        image = image.thumbnail_image(width, **thumbnail_kwargs)
+        if spec.crop and spec.focal_point is not None:
+            image = self._crop_to_focal_point(image, width, height)
+        else:
+            thumbnail_kwargs = {
+                "height": height,
+                "size": pyvips.enums.Size.BOTH
+                if spec.upscale
+                else pyvips.enums.Size.DOWN,
+                # I tested ENTROPY and it actually worked pretty well as a sane
+                # default, but CENTRE is a lot cheaper
+                "crop": _INTERESTING[spec.crop_strategy]
+                if spec.crop
+                else pyvips.enums.Interesting.NONE,
+            }
+
+            image = image.thumbnail_image(width, **thumbnail_kwargs)
 
         # TODO Add more explict handling for RGBA
 
@@ -275,9 +864,99 @@ class Thumbnail:
                 background=[255, 255, 255],
             )
 
-        write_kwargs = {
+        return image
+
+    def _process_source(
+        self,
+        buffer: bytes,
+        version: str,
+        *,
+        decoded: typing.Optional["pyvips.Image"] = None,
+    ) -> "pyvips.Image":
+        """Resized image, decoded is the source when it's already been loaded"""
+        check_deadline(self._deadline, "decode")
+
+        if decoded is not None:
+            image = decoded
+        else:
+            with stage(self._profile, "decode"):
+                image = self._checkpoint(self._load_image(buffer))
+
+        if self._profile is not None:
+            self._profile.describe_image("source", image)
+
+        with stage(self._profile, "resize"):
+            image = self._checkpoint(self._process(image))
+
+        # Most of the work happens lazily when the result is evaluated
+        watch_deadline(self._deadline, image)
+
+        if self.app.placeholders and self._is_full_frame():
+            info = self._sync_source_info(buffer, version)
+
+            if info.placeholder is None:
+                # The pipeline can't run twice on a sequential source, and the
+                # thumbnail is small, so just keep it in memory
+                # Evaluates the (watched) pipeline, the copy is encoded next
+                image = image.copy_memory()
+                watch_deadline(self._deadline, image)
+                check_deadline(self._deadline, "placeholder")
+
+                with stage(self._profile, "placeholder"):
+                    placeholder = _make_placeholder(image)
+
+                self._source_info = dataclasses.replace(info, placeholder=placeholder)
+                self._source_info_changed = True
+
+        self._save_source_info()
+
+        return image
+
+    def _is_full_frame(self) -> bool:
+        """Whether the thumbnail shows the whole source image"""
+        if self.spec.padding:
+            return False
+
+        # Crop does nothing without both width and height
+        return not (self.spec.crop and self.spec.width and self.spec.height)
+
+    def _crop_to_focal_point(
+        self, image: "pyvips.Image", width: int, height: int
+    ) -> "pyvips.Image":
+        # Same as the "crop" option of thumbnail_image, but the window is
+        # positioned around the focal point instead of being found by analysis
+        assert self.spec.focal_point is not None  # noqa: S101
+        focal_x, focal_y = self.spec.focal_point
+
+        # Scale so the image covers the box
+        scale = max(width / image.width, height / image.height)
+
+        if not self.spec.upscale:
+            scale = min(scale, 1.0)
+
+        if scale != 1.0:
+            image = image.thumbnail_image(
+                _clamped_int(image.width * scale),
+                height=_clamped_int(image.height * scale),
+                size=pyvips.enums.Size.FORCE,
+            )
+
+        crop_width = min(width, image.width)
+        crop_height = min(height, image.height)
+
+        left = round(image.width * focal_x / 100 - crop_width / 2)
+        top = round(image.height * focal_y / 100 - crop_height / 2)
+
+        # Keep the window inside the image
+        left = min(max(left, 0), image.width - crop_width)
+        top = min(max(top, 0), image.height - crop_height)
+
+        return image.crop(left, top, crop_width, crop_height)
+
+    def _get_write_kwargs(self) -> dict[str, typing.Any]:
+        write_kwargs: dict[str, typing.Any] = {
             # TODO make quality configurable
-            "Q": 80,
+            "Q": DEFAULT_QUALITY,
             "strip": True,
         }
 
@@ -306,22 +985,305 @@ class Thumbnail:
         else:
             raise ValueError(f"Unhandled format format: {self.format!r}")
 
-        finished_image: bytes = image.write_to_buffer(self.format, **write_kwargs)
+        return write_kwargs
+
+    def _generate(
+        self,
+        checked_path: typing.Optional[PurePosixPath],
+        *,
+        force: bool = False,
+        rerender: bool = False,
+    ) -> bytes:
+        """Read the source and render the thumbnail
+
+        force renders even if another source with the same contents already
+        has. rerender is for replacing the thumbnail at checked_path, which
+        can tell us the quality that fit the byte budget last time
+        """
+        check_deadline(self._deadline, "reading the source")
+
+        quality_hint = None
+
+        # Only worth a lookup when it's known to exist, on a normal miss it
+        # would be one more round trip for nothing
+        if rerender and checked_path is not None and self.spec.max_bytes:
+            metadata = self.app.storage_backend._read_target_metadata(checked_path)
+            quality_hint = _convert_int((metadata or {}).get(QUALITY_METADATA))
+
+        with stage(self._profile, "read source"):
+            buffer, version = self._read_source()
+
+        target_path = self._get_source_target_path(buffer, version)
+
+        # Another source with the same contents may have been rendered already
+        if target_path != checked_path and not force:
+            data = self.app.storage_backend._read_target(target_path)
+
+            if data is not None:
+                self._save_source_info()
+                return data
+
+        return self._render(buffer, target_path, version, quality_hint=quality_hint)
+
+    def _render(
+        self,
+        buffer: bytes,
+        target_path: PurePosixPath,
+        version: str,
+        *,
+        decoded: typing.Optional["pyvips.Image"] = None,
+        quality_hint: typing.Optional[int] = None,
+    ) -> bytes:
+        metadata = {SOURCE_VERSION_METADATA: version}
+
+        with cancellable(self._deadline):
+            image = self._process_source(buffer, version, decoded=decoded)
+
+            check_deadline(self._deadline, "encode")
+
+            with stage(self._profile, "encode"):
+                if self.spec.max_bytes:
+                    finished_image, quality, attempts = self._encode_within_budget(
+                        image, self.spec.max_bytes, target_path, quality_hint
+                    )
+                    metadata[QUALITY_METADATA] = str(quality)
+                    metadata[ENCODE_ATTEMPTS_METADATA] = str(attempts)
+                else:
+                    finished_image = image.write_to_buffer(
+                        self.format, **self._get_write_kwargs()
+                    )
+
+        # Not checked from here on, the thumbnail is done and storing it
+        # means the next request is a hit
+
+        if self._profile is not None:
+            self._profile.describe_image("output", image)
+            self._profile.details["output bytes"] = len(finished_image)
 
         # Persist to bucket
-        self.app.storage_backend._write_target(
-            target_path, finished_image, content_type=self.content_type
-        )
+        with stage(self._profile, "write target"):
+            self.app.storage_backend._write_target(
+                target_path,
+                finished_image,
+                content_type=self.content_type,
+                metadata=metadata,
+            )
 
         return finished_image
 
+    def _encode_within_budget(
+        self,
+        image: "pyvips.Image",
+        max_bytes: int,
+        target_path: PurePosixPath,
+        hint: typing.Optional[int] = None,
+    ) -> tuple[bytes, int, int]:
+        """Highest quality which fits in max_bytes
+
+        hint is the quality chosen last time this thumbnail was rendered, if
+        known. Usually right (or close) when the source changed slightly
+
+        Returns the encoded image, the quality and the number of encodes it took
+        """
+        # Otherwise every attempt would run the whole resize pipeline again
+        image = image.copy_memory()
+        write_kwargs = self._get_write_kwargs()
+
+        # Quality to encoded image, the fallback can repeat an earlier attempt
+        encoded: dict[int, bytes] = {}
+
+        def encode(quality: int) -> bytes:
+            if quality not in encoded:
+                # Each attempt is a full encode, give up between them
+                check_deadline(self._deadline, f"encoding at Q={quality}")
+                encoded[quality] = image.write_to_buffer(
+                    self.format, **{**write_kwargs, "Q": quality}
+                )
+            return encoded[quality]
+
+        def good_enough(data: bytes) -> bool:
+            return len(data) >= max_bytes * (1 - BUDGET_TOLERANCE)
+
+        low, high = MIN_QUALITY, DEFAULT_QUALITY
+        best: typing.Optional[tuple[bytes, int]] = None
+
+        if hint is not None and low <= hint <= high:
+            data = encode(hint)
+
+            if len(data) <= max_bytes:
+                best = data, hint
+                # Skips the search if it's good enough
+                low = high + 1 if good_enough(data) else hint + 1
+            else:
+                high = hint - 1
+
+        # Binary search for the highest quality that fits, try the top first
+        # since most images fit without any reduction
+        quality = high
+
+        while low <= high:
+            data = encode(quality)
+
+            if len(data) <= max_bytes:
+                best = data, quality
+                if good_enough(data):
+                    break
+                low = quality + 1
+            else:
+                high = quality - 1
+
+            quality = (low + high) // 2
+
+        if best is None:
+            logger.warning(
+                "%s does not fit in %d bytes even at Q=%d",
+                target_path,
+                max_bytes,
+                MIN_QUALITY,
+            )
+            best = encode(MIN_QUALITY), MIN_QUALITY
+
+        data, quality = best
+        attempts = len(encoded)
+
+        logger.info(
+            "Encoded %s at Q=%d in %d attempts (%d bytes, budget %d)",
+            target_path,
+            quality,
+            attempts,
+            len(data),
+            max_bytes,
+        )
+
+        return data, quality, attempts
+
+    def get_or_generate_stream(
+        self,
+        *,
+        signature: str,
+        write: typing.Callable[[bytes], typing.Any],
+        deadline: typing.Optional[Deadline] = None,
+    ) -> None:
+        """Like get_or_generate, but hand the encoded bytes to 'write' in chunks
+
+        On a miss, chunks are passed along as the encoder produces them and
+        uploaded to the target storage at the same time, so the whole encoded
+        image never has to sit in memory (or in a base64 encoded response)
+
+        If the deadline passes after the first chunk was written, the response
+        is cut short and nothing is stored
+        """
+        self._deadline = deadline
+
+        target_path = self._get_target_path()
+
+        if target_path is not None:
+            data = self._lookup(target_path, signature)
+
+            if data is not None:
+                _write_chunks(data, write)
+                return
+
+        # raises if invalid
+        self._check_signature(signature)
+
+        self._generate_stream(target_path, write)
+
+    def _generate_stream(
+        self,
+        checked_path: typing.Optional[PurePosixPath],
+        write: typing.Callable[[bytes], typing.Any],
+    ) -> None:
+        check_deadline(self._deadline, "reading the source")
+
+        buffer, version = self._read_source()
+        target_path = self._get_source_target_path(buffer, version)
+
+        if target_path != checked_path:
+            data = self.app.storage_backend._read_target(target_path)
+
+            if data is not None:
+                self._save_source_info()
+                _write_chunks(data, write)
+                return
+
+        # Finding the quality takes several encodes, nothing to stream
+        # until it's done
+        if self.spec.max_bytes:
+            _write_chunks(self._render(buffer, target_path, version), write)
+            return
+
+        with cancellable(self._deadline):
+            image = self._process_source(buffer, version)
+
+        check_deadline(self._deadline, "encode")
+
+        # Bounded so that a slow upload applies back pressure to the encoder
+        # instead of buffering the whole image
+        chunks: "queue.Queue[typing.Union[bytes, None, Exception]]" = queue.Queue(
+            maxsize=STREAM_QUEUE_SIZE
+        )
+
+        def iter_chunks() -> typing.Iterator[bytes]:
+            while (chunk := chunks.get()) is not None:
+                # Encoding failed, raising aborts the upload so a truncated
+                # thumbnail isn't stored
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            upload = executor.submit(
+                self.app.storage_backend._write_target_stream,
+                target_path,
+                iter_chunks(),
+                content_type=self.content_type,
+                metadata={SOURCE_VERSION_METADATA: version},
+            )
+
+            def put(chunk: typing.Union[bytes, None, Exception]) -> None:
+                # If the upload died, nobody is reading from the queue anymore
+                # Don't block forever, the error is raised below
+                while not upload.done():
+                    try:
+                        chunks.put(chunk, timeout=0.1)
+                    except queue.Full:
+                        continue
+                    return
+
+            def on_write(buffer: typing.Any) -> int:
+                # pyvips hands us a cffi buffer which is only valid during
+                # the callback, so copy it
+                chunk = bytes(buffer)
+                write(chunk)
+                put(chunk)
+                return len(chunk)
+
+            target = pyvips.TargetCustom()
+            target.on_write(on_write)
+
+            try:
+                with cancellable(self._deadline):
+                    image.write_to_target(
+                        target, self.format, **self._get_write_kwargs()
+                    )
+            except Exception as e:
+                put(e)
+                raise
+
+            put(None)
+
+            # Raises if the upload failed
+            upload.result()
+
     @classmethod
     def from_path(cls, path: str, *, app: "App") -> "Thumbnail":
         # Example
         # "/path/to/filename.jpg/200x120ucp20/filename.webp"
 
+        # posixpath.split only splits off the last component
         try:
-            *path_parts, spec, desired_filename = posixpath.split(path)
+            *path_parts, spec, desired_filename = path.split("/")
         except ValueError as e:
             raise UrlError from e
 
@@ -332,6 +1294,9 @@ class Thumbnail:
 
         # Could use splitext here
         # I do like pathlib, but it's kind of hard to read
+        if not path_parts:
+            raise UrlError
+
         file_system_path = posixpath.join(*path_parts)
         __, output_format = posixpath.splitext(desired_filename)
 
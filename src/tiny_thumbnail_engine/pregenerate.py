@@ -0,0 +1,309 @@
+"""Generate thumbnails as soon as a source is uploaded.
+
+Handles S3 "ObjectCreated" notifications for the source bucket, so the first
+visitor doesn't pay for the render. Which renditions to generate is
+configured per key prefix, for example
+
+    TINY_THUMBNAIL_ENGINE_PREGENERATE='{"products/": ["200x200c.webp", "800.jpg"]}'
+
+The longest matching prefix wins, use "" to match everything.
+
+The source is decoded once and every rendition is made from the decoded
+image. Renditions already generated from this version of the source are
+skipped, so duplicate and retried notifications are cheap.
+"""
+
+import dataclasses
+import json
+import logging
+import os
+import posixpath
+import threading
+import typing
+from pathlib import PurePosixPath
+from urllib.parse import unquote_plus
+
+
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+from tiny_thumbnail_engine.deadline import Deadline
+from tiny_thumbnail_engine.environ import ENVIRON_PREFIX
+from tiny_thumbnail_engine.exceptions import ImproperlyConfiguredError
+from tiny_thumbnail_engine.exceptions import UrlError
+from tiny_thumbnail_engine.model import Thumbnail
+from tiny_thumbnail_engine.model import ThumbnailSpec
+from tiny_thumbnail_engine.sources import SOURCE_VERSION_METADATA
+from tiny_thumbnail_engine.storage.protocol import StorageObject
+from tiny_thumbnail_engine.sweep import run_bounded
+
+
+# Avoid circular dependency unless type checking
+if typing.TYPE_CHECKING:
+    from tiny_thumbnail_engine.app import App
+
+
+logger = logging.getLogger(__name__)
+
+
+class SourceUpload(typing.NamedTuple):
+    path: str
+    # ETag from the notification, None if unknown
+    version: typing.Optional[str] = None
+
+
+@dataclasses.dataclass
+class PregenerateResult:
+    generated: int = 0
+    # Already generated from this version of the source
+    skipped: int = 0
+    failed: int = 0
+
+
+def _parse_rendition(rendition: str) -> tuple[ThumbnailSpec, str]:
+    # Same as the names of content addressed renditions, e.g. 200x200c.webp
+    spec, output_format = posixpath.splitext(rendition)
+
+    if output_format not in {".jpg", ".webp"}:
+        raise ValueError(f"Unhandled format: {output_format!r}")
+
+    return ThumbnailSpec.from_string(spec), output_format
+
+
+def get_pregenerate_config() -> dict[str, list[str]]:
+    key = f"{ENVIRON_PREFIX}_PREGENERATE"
+    value = os.environ.get(key, "")
+
+    if not value:
+        return {}
+
+    try:
+        config = json.loads(value)
+
+        if not isinstance(config, dict):
+            raise ValueError
+
+        # Fail now rather than on the first upload
+        for renditions in config.values():
+            for rendition in renditions:
+                _parse_rendition(rendition)
+    except (ValueError, TypeError) as e:
+        raise ImproperlyConfiguredError(
+            f"The environmental variable {key} must be a JSON object of key "
+            'prefixes to lists of renditions like "200x200c.webp", '
+            f"got {value!r}."
+        ) from e
+
+    return config
+
+
+def get_renditions(app: "App", path: str) -> list[tuple[ThumbnailSpec, str]]:
+    """Specs and formats to generate for a newly uploaded source"""
+    prefixes = [prefix for prefix in app.pregenerate if path.startswith(prefix)]
+
+    if not prefixes:
+        return []
+
+    return [
+        _parse_rendition(rendition)
+        for rendition in app.pregenerate[max(prefixes, key=len)]
+    ]
+
+
+def _is_thumbnail_key(path: str) -> bool:
+    # If the source and target bucket are the same, we get notified about
+    # our own thumbnails. They look like <source>/<spec>/<source stem><format>
+    try:
+        thumbnail = Thumbnail.from_path(path, app=typing.cast("App", None))
+    except UrlError:
+        return False
+
+    source_path = PurePosixPath(thumbnail.path)
+
+    # Sources have an extension, otherwise ordinary keys like
+    # gallery/2024/gallery.jpg would look like thumbnails
+    return bool(source_path.suffix) and source_path.stem == PurePosixPath(path).stem
+
+
+def parse_s3_event(event: dict[str, typing.Any]) -> list[SourceUpload]:
+    """Uploads from an S3 notification, without duplicates"""
+    uploads: dict[SourceUpload, None] = {}
+
+    for record in event.get("Records", []):
+        if record.get("eventSource") != "aws:s3":
+            continue
+
+        if not record.get("eventName", "").startswith("ObjectCreated:"):
+            continue
+
+        s3_object = record["s3"]["object"]
+        # Keys are URL encoded, with spaces as "+"
+        path = unquote_plus(s3_object["key"])
+
+        # Sidecars, access logs, etc. when sharing a bucket
+        if path.startswith("_") or _is_thumbnail_key(path):
+            continue
+
+        uploads[SourceUpload(path, s3_object.get("eTag"))] = None
+
+    return list(uploads)
+
+
+def _is_generated(
+    thumbnail: Thumbnail, target_path: PurePosixPath, version: str
+) -> bool:
+    """Whether target_path has the thumbnail of this version of the source"""
+    metadata = thumbnail.app.storage_backend._read_target_metadata(target_path)
+
+    if metadata is None:
+        return False
+
+    if thumbnail.app.content_addressed:
+        # Renditions are shared by sources with the same contents, the
+        # sidecar records which contents this source had
+        info = thumbnail._load_source_info()
+        return info is not None and info.version == version
+
+    return metadata.get(SOURCE_VERSION_METADATA) == version
+
+
+def _source_exists(app: "App", path: str) -> bool:
+    # Backends fail differently on a missing source, so look for it
+    return any(
+        source.path.as_posix() == path
+        for source in app.storage_backend._list_sources(path)
+    )
+
+
+def _decode(buffer: bytes) -> "pyvips.Image":
+    # Every rendition reads the whole image, so keep it in memory instead of
+    # decoding again for each one
+    image = pyvips.Image.new_from_buffer(buffer, "", access="random")
+    return image.autorot().copy_memory()
+
+
+def pregenerate(
+    app: "App",
+    upload: SourceUpload,
+    *,
+    deadline: typing.Optional[Deadline] = None,
+    result: typing.Optional[PregenerateResult] = None,
+) -> PregenerateResult:
+    """Generate the configured renditions of an uploaded source"""
+    if result is None:
+        result = PregenerateResult()
+
+    thumbnails = [
+        Thumbnail(upload.path, spec, typing.cast(typing.Any, output_format), app=app)
+        for spec, output_format in get_renditions(app, upload.path)
+    ]
+
+    # Checked before reading the source, duplicate notifications stop here
+    if upload.version is not None:
+        stale = []
+
+        for thumbnail in thumbnails:
+            target_path = thumbnail._get_target_path()
+
+            if target_path is not None and _is_generated(
+                thumbnail, target_path, upload.version
+            ):
+                result.skipped += 1
+            else:
+                stale.append(thumbnail)
+
+        thumbnails = stale
+
+    if not thumbnails:
+        return result
+
+    try:
+        buffer, version = thumbnails[0]._read_source()
+    except Exception:
+        # Deleted since the notification was sent, there's nothing to
+        # generate and retrying won't change that
+        if not _source_exists(app, upload.path):
+            logger.info("Skipping %s, it no longer exists", upload.path)
+            result.skipped += len(thumbnails)
+            return result
+
+        logger.exception("Could not read %s", upload.path)
+        result.failed += len(thumbnails)
+        return result
+
+    decoded: typing.Optional["pyvips.Image"] = None
+    previous: typing.Optional[Thumbnail] = None
+
+    for thumbnail in thumbnails:
+        thumbnail._deadline = deadline
+
+        # Renditions add to the sidecar (placeholder, dimensions) as they go,
+        # pass it along so they don't overwrite each other's changes
+        if previous is not None and previous._source_info_loaded:
+            thumbnail._source_info = previous._source_info
+            thumbnail._source_info_loaded = True
+            thumbnail._source_info_changed = previous._source_info_changed
+
+        previous = thumbnail
+
+        try:
+            target_path = thumbnail._get_source_target_path(buffer, version)
+
+            # The source may have changed since the notification was sent, or
+            # another source had the same contents
+            if _is_generated(thumbnail, target_path, version):
+                thumbnail._save_source_info()
+                result.skipped += 1
+                continue
+
+            if decoded is None:
+                decoded = _decode(buffer)
+
+            thumbnail._render(buffer, target_path, version, decoded=decoded)
+        except Exception:
+            logger.exception("Could not generate %s", thumbnail._get_thumbnail_path())
+            result.failed += 1
+        else:
+            result.generated += 1
+
+    return result
+
+
+def pregenerate_existing(
+    app: "App", prefix: str = "", *, concurrency: int = 4
+) -> PregenerateResult:
+    """Generate the configured renditions of sources which already exist
+
+    For sources uploaded before pre-generation was set up
+    """
+    result = PregenerateResult()
+    lock = threading.Lock()
+
+    def run(source: StorageObject) -> None:
+        upload_result = pregenerate(
+            app, SourceUpload(source.path.as_posix(), source.version)
+        )
+
+        with lock:
+            for field in dataclasses.fields(result):
+                setattr(
+                    result,
+                    field.name,
+                    getattr(result, field.name) + getattr(upload_result, field.name),
+                )
+
+    failed = run_bounded(
+        run, app.storage_backend._list_sources(prefix), concurrency=concurrency
+    )
+
+    # pregenerate handles its own errors, this is something unexpected like
+    # the renditions being unreadable. Counted once per source
+    with lock:
+        result.failed += failed
+
+    # Background uploads
+    app.flush()
+
+    return result
@@ -0,0 +1,141 @@
+"""Profile a single thumbnail render.
+
+Captures a Python CPU profile and wall clock timings for each stage of the
+pipeline and writes a plain text report to target storage.
+
+libvips is lazy, normally all the work happens when the image is encoded.
+While profiling, the image is copied to memory after each stage so the time
+shows up where it belongs. That makes the render a bit slower and uses more
+memory than usual, compare stages with each other rather than with
+production timings.
+"""
+
+import contextlib
+import cProfile
+import dataclasses
+import io
+import pstats
+import time
+import typing
+import uuid
+from pathlib import PurePosixPath
+
+from .signing import BadSignatureError
+
+
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+
+# Avoid circular dependency unless type checking
+if typing.TYPE_CHECKING:
+    from .app import App
+
+
+PROFILE_PREFIX: typing.Final[PurePosixPath] = PurePosixPath("_debug/profiles")
+
+# Number of functions listed in the report
+PROFILE_LIMIT: typing.Final[int] = 40
+
+# Seconds a profile signature is good for by default
+# Every profiled request is a forced render, a leaked one shouldn't work forever
+PROFILE_MAX_AGE: typing.Final[int] = 60 * 60
+
+
+# Profile signatures are made with a key of their own, so being able to
+# request a thumbnail doesn't mean being able to profile it
+PROFILE_SIGNING_SALT: typing.Final[str] = "tiny_thumbnail_engine.profiling"
+
+
+def get_profile_value(thumbnail_path: PurePosixPath, expires: int) -> str:
+    """What gets signed to allow profiling a thumbnail until expires"""
+    return f"profile:{expires}:{thumbnail_path}"
+
+
+def split_profile_signature(profile_signature: str) -> tuple[int, str]:
+    """Expiry (unix timestamp) and signature from the profiling header
+
+    The header is <expires>.<signature>
+    """
+    expires, __, signature = profile_signature.partition(".")
+
+    try:
+        return int(expires), signature
+    except ValueError as e:
+        raise BadSignatureError from e
+
+
+@dataclasses.dataclass
+class RequestProfile:
+    thumbnail_path: PurePosixPath
+
+    stages: list[tuple[str, float]] = dataclasses.field(default_factory=list)
+    # Things like the dimensions and colour space of the source
+    details: dict[str, typing.Any] = dataclasses.field(default_factory=dict)
+
+    profiler: cProfile.Profile = dataclasses.field(default_factory=cProfile.Profile)
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> typing.Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - start))
+
+    def describe_image(self, prefix: str, image: "pyvips.Image") -> None:
+        self.details.update(
+            {
+                f"{prefix} size": f"{image.width}x{image.height}",
+                f"{prefix} bands": image.bands,
+                f"{prefix} interpretation": image.interpretation,
+                f"{prefix} format": image.format,
+            }
+        )
+
+    def report(self) -> str:
+        f = io.StringIO()
+
+        f.write(f"Profile of {self.thumbnail_path}\n\n")
+
+        f.write("Stages (wall clock)\n")
+        for name, duration in self.stages:
+            f.write(f"  {name:<16} {duration * 1000:10.1f} ms\n")
+        total = sum(duration for __, duration in self.stages)
+        f.write(f"  {'total':<16} {total * 1000:10.1f} ms\n\n")
+
+        f.write("Details\n")
+        for key, value in self.details.items():
+            f.write(f"  {key}: {value}\n")
+
+        if pyvips is not None:
+            f.write(f"  libvips: {pyvips.version(0)}.{pyvips.version(1)}\n")
+
+        f.write("\nPython profile (cumulative)\n")
+        stats = pstats.Stats(self.profiler, stream=f)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_LIMIT)
+
+        return f.getvalue()
+
+    def save(self, app: "App") -> PurePosixPath:
+        timestamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+        path = PROFILE_PREFIX / f"{timestamp}-{uuid.uuid4().hex}.txt"
+
+        app.storage_backend._write_target(
+            path, self.report().encode(), content_type="text/plain"
+        )
+
+        return path
+
+
+@contextlib.contextmanager
+def stage(profile: typing.Optional[RequestProfile], name: str) -> typing.Iterator[None]:
+    """Time a stage if profiling, otherwise do nothing"""
+    if profile is None:
+        yield
+        return
+
+    with profile.stage(name):
+        yield
@@ -0,0 +1,159 @@
+"""Delete thumbnails which haven't been requested recently.
+
+Uses the access records written by AccessRecorder. A thumbnail counts as
+accessed when it was generated, so new thumbnails aren't pruned before they
+have had a chance to be requested.
+
+Thumbnails are generated again on demand, so pruning is always safe, the
+worst case is paying for the render again.
+"""
+
+import collections
+import dataclasses
+import json
+import logging
+import time
+import typing
+from pathlib import PurePosixPath
+
+from tiny_thumbnail_engine.access import ACCESS_LOG_PREFIX
+from tiny_thumbnail_engine.access import read_access_log
+from tiny_thumbnail_engine.sharding import is_sharded
+from tiny_thumbnail_engine.sharding import unshard_path
+from tiny_thumbnail_engine.sources import CONTENT_ADDRESSED_PREFIX
+
+
+# Avoid circular dependency unless type checking
+if typing.TYPE_CHECKING:
+    from tiny_thumbnail_engine.app import App
+
+
+logger = logging.getLogger(__name__)
+
+
+# Access logs are merged into this on every prune
+COMPACTED_ACCESS_LOG: typing.Final[PurePosixPath] = ACCESS_LOG_PREFIX / "compacted.json"
+
+
+@dataclasses.dataclass
+class PruneResult:
+    scanned: int = 0
+    evicted_by_age: int = 0
+    evicted_by_budget: int = 0
+
+
+def _is_prunable(path: PurePosixPath) -> bool:
+    # Sidecars and access logs are internal, content addressed and sharded
+    # renditions are thumbnails like any other
+    if path.parts[0] == CONTENT_ADDRESSED_PREFIX.name or is_sharded(path):
+        return True
+
+    return not path.parts[0].startswith("_")
+
+
+def _get_group(path: PurePosixPath) -> PurePosixPath:
+    """Renditions which share a per-source budget"""
+    # _cas/ab/<digest>/<spec><format>
+    if path.parts[0] == CONTENT_ADDRESSED_PREFIX.name:
+        return path.parent
+
+    # <source path>/<spec>/<filename>, possibly under _shards/ab/
+    return unshard_path(path).parent.parent
+
+
+def _load_access_logs(app: "App") -> tuple[dict[str, float], list[PurePosixPath]]:
+    last_access: dict[str, float] = {}
+    logs: list[PurePosixPath] = []
+
+    for log in app.storage_backend._list_targets(f"{ACCESS_LOG_PREFIX}/"):
+        data = app.storage_backend._read_target(log.path)
+
+        if data is None:
+            continue
+
+        try:
+            entries = read_access_log(data)
+        except ValueError:
+            logger.warning("Skipping unreadable access log %s", log.path)
+            continue
+
+        for key, accessed in entries.items():
+            last_access[key] = max(last_access.get(key, 0.0), accessed)
+
+        if log.path != COMPACTED_ACCESS_LOG:
+            logs.append(log.path)
+
+    return last_access, logs
+
+
+def prune(
+    app: "App",
+    *,
+    max_age: float,
+    per_source: typing.Optional[int] = None,
+    prefix: str = "",
+    dry_run: bool = False,
+) -> PruneResult:
+    """Delete thumbnails not accessed within max_age seconds
+
+    With per_source, also keep at most that many (most recently accessed)
+    renditions of each source
+    """
+    now = time.time()
+    result = PruneResult()
+
+    last_access, logs = _load_access_logs(app)
+
+    groups: collections.defaultdict[
+        PurePosixPath, list[tuple[float, PurePosixPath]]
+    ] = collections.defaultdict(list)
+
+    for target in app.storage_backend._list_targets(prefix):
+        if not _is_prunable(target.path):
+            continue
+
+        result.scanned += 1
+
+        last_seen = max(
+            last_access.get(target.path.as_posix(), 0.0),
+            target.last_modified or now,
+        )
+        groups[_get_group(target.path)].append((last_seen, target.path))
+
+    evict: list[PurePosixPath] = []
+
+    for renditions in groups.values():
+        # Most recently accessed first
+        renditions.sort(reverse=True)
+
+        for index, (last_seen, path) in enumerate(renditions):
+            if now - last_seen > max_age:
+                result.evicted_by_age += 1
+                evict.append(path)
+            elif per_source is not None and index >= per_source:
+                result.evicted_by_budget += 1
+                evict.append(path)
+
+    if dry_run:
+        return result
+
+    app.storage_backend._delete_targets(evict)
+
+    # Keep the access logs from growing forever
+    # Drop anything old enough that it can't save a thumbnail anymore
+    evicted = {path.as_posix() for path in evict}
+    compacted = {
+        key: accessed
+        for key, accessed in last_access.items()
+        if key not in evicted and now - accessed <= max_age
+    }
+
+    # Written before the logs are deleted so nothing is lost if we crash
+    app.storage_backend._write_target(
+        COMPACTED_ACCESS_LOG,
+        json.dumps(compacted).encode(),
+        content_type="application/json",
+    )
+    app.storage_backend._delete_targets(logs)
+
+    return result
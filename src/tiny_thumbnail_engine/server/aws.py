@@ -1,13 +1,29 @@
 """Default handler to deploy tiny-thumbnail-engine on AWS Lambda."""
 
 import base64
+import dataclasses
+import functools
+import json
+import logging
 import os
 import secrets
+import signal
 import typing
 
 from tiny_thumbnail_engine import App
+from tiny_thumbnail_engine.deadline import Deadline
+from tiny_thumbnail_engine.environ import environ_flag
+from tiny_thumbnail_engine.environ import environ_float
 from tiny_thumbnail_engine.signing import BadSignatureError
+from tiny_thumbnail_engine.exceptions import DeadlineExceededError
 from tiny_thumbnail_engine.exceptions import UrlError
+from tiny_thumbnail_engine.model import Thumbnail
+from tiny_thumbnail_engine.pregenerate import PregenerateResult
+from tiny_thumbnail_engine.pregenerate import parse_s3_event
+from tiny_thumbnail_engine.pregenerate import pregenerate
+
+
+logger = logging.getLogger(__name__)
 
 
 app = App()
@@ -27,6 +43,35 @@ except KeyError as e:
     ) from e
 
 
+# Seconds kept back from the invocation's remaining time, to respond (and
+# hand off) after giving up on a render
+DEADLINE_MARGIN: typing.Final[float] = environ_float("DEADLINE_MARGIN", 1.0)
+
+# When a render runs out of time, finish it in an asynchronous invocation of
+# this function so the next request is a hit
+DEADLINE_HANDOFF: typing.Final[bool] = environ_flag("DEADLINE_HANDOFF")
+
+# Clients are told to come back after this many seconds
+RETRY_AFTER: typing.Final[int] = 5
+
+
+# Lambda sends SIGTERM before shutting down an execution environment
+# (when an extension is registered), last chance for background uploads
+# and access records
+_previous_sigterm_handler = signal.getsignal(signal.SIGTERM)
+
+
+def _flush_on_sigterm(signum, frame) -> None:
+    app.shutdown()
+
+    # Then shut down as we would have without this handler
+    signal.signal(signal.SIGTERM, _previous_sigterm_handler or signal.SIG_DFL)
+    signal.raise_signal(signum)
+
+
+signal.signal(signal.SIGTERM, _flush_on_sigterm)
+
+
 class LambdaHttpRequest(typing.TypedDict, total=False):
     httpMethod: str
     path: str
@@ -47,40 +92,57 @@ _HTTP_REQUEST_KEYS: typing.Final[list[str]] = [
     "isBase64Encoded",
 ]
 
+# Separates the JSON encoded status code and headers from the body
+# in a streamed response
+# See the "HttpResponseStream" helper in the Node.js lambda runtime
+_STREAM_PRELUDE_DELIMITER: typing.Final[bytes] = b"\x00" * 8
 
-def _http_request_handler(event: LambdaHttpRequest, context):
+# Signed with Thumbnail.get_profile_signature, asks for a profiled render
+PROFILE_HEADER: typing.Final[str] = "x-thumbnail-profile"
+
+# Key of the event sent to ourselves to generate a thumbnail in the background
+_GENERATE_EVENT_KEY: typing.Final[str] = "tinyThumbnailEngineGenerate"
+
+
+def _error_response(status_code: int, body: str) -> dict[str, typing.Any]:
+    return {
+        "statusCode": status_code,
+        "body": body,
+        "isBase64Encoded": False,
+        "headers": {
+            "Content-Type": "text/plain",
+        },
+    }
+
+
+def _get_header(event: LambdaHttpRequest, name: str) -> typing.Optional[str]:
+    try:
+        return event.get("multiValueHeaders", {}).get(name, [])[0]
+    except IndexError:
+        return None
+
+
+def _resolve_request(
+    event: LambdaHttpRequest,
+) -> typing.Union[dict[str, typing.Any], tuple[Thumbnail, str]]:
+    """Validate the request
+
+    Returns either an error response or the requested thumbnail and
+    the signature to check it against
+    """
     if event.get("httpMethod", "") != "GET":
-        return {
-            "statusCode": 405,
-            "body": "405 Method Not Allowed",
-            "isBase64Encoded": False,
-            "headers": {
-                "Content-Type": "text/plain",
-            },
-        }
+        return _error_response(405, "405 Method Not Allowed")
 
-    """Called by lambda to run application."""
     # TODO Consider factoring out into its own method
     if CLOUDFRONT_VERIFY:
-        try:
-            verification_header: str = event.get("multiValueHeaders", {}).get(
-                "x-cloudfront-verify", []
-            )[0]
-        except IndexError:
-            verification_header = ""
+        verification_header = _get_header(event, "x-cloudfront-verify") or ""
 
         if not secrets.compare_digest(CLOUDFRONT_VERIFY, verification_header):
-            return {
-                "statusCode": 403,
-                "body": (
-                    "403 Forbidden: "
-                    "Only access this service using the canonical domain names."
-                ),
-                "isBase64Encoded": False,
-                "headers": {
-                    "Content-Type": "text/plain",
-                },
-            }
+            return _error_response(
+                403,
+                "403 Forbidden: "
+                "Only access this service using the canonical domain names.",
+            )
 
     # Must slice leading /
     path = event["path"][1:]
@@ -90,55 +152,312 @@ def _http_request_handler(event: LambdaHttpRequest, context):
         thumbnail = app.get_thumbnail(path)
     # A garbage URL was passed
     except UrlError:
-        return {
-            "statusCode": 403,
-            "body": "403 Forbidden: Malformed URL.",
-            "isBase64Encoded": False,
-            "headers": {
-                "Content-Type": "text/plain",
-            },
-        }
+        return _error_response(403, "403 Forbidden: Malformed URL.")
 
     try:
         signature = event.get("multiValueQueryStringParameters", {}).get(
             "signature", []
         )[0]
     except IndexError:
+        return _error_response(403, "403 Forbidden: Signature is required.")
+
+    return thumbnail, signature
+
+
+def _get_deadline(context) -> typing.Optional[Deadline]:
+    # Not on lambda (e.g. the load test)
+    if context is None:
+        return app.get_deadline()
+
+    remaining = context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN
+
+    return app.get_deadline(max(remaining, 0.0))
+
+
+@functools.cache
+def _get_lambda_client() -> typing.Any:
+    import boto3
+
+    return boto3.client("lambda")
+
+
+def _hand_off(thumbnail: Thumbnail, signature: str, context) -> None:
+    """Generate the thumbnail in an asynchronous invocation of this function"""
+    payload = {
+        _GENERATE_EVENT_KEY: {
+            "path": str(thumbnail._get_thumbnail_path()),
+            "signature": signature,
+        }
+    }
+
+    # Best effort, the client gets the 503 either way
+    try:
+        _get_lambda_client().invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType="Event",
+            Payload=json.dumps(payload).encode(),
+        )
+    except Exception:
+        logger.exception("Could not hand off %s", thumbnail._get_thumbnail_path())
+
+
+def _deadline_exceeded_response(
+    thumbnail: Thumbnail, signature: str, context
+) -> dict[str, typing.Any]:
+    logger.warning("Ran out of time generating %s", thumbnail._get_thumbnail_path())
+
+    if DEADLINE_HANDOFF and context is not None:
+        _hand_off(thumbnail, signature, context)
+
+    response = _error_response(
+        503, "503 Service Unavailable: Thumbnail is taking too long, try again."
+    )
+    response["headers"].update(
+        {
+            "Retry-After": str(RETRY_AFTER),
+            # Don't let the CDN hold on to the error
+            "Cache-Control": "no-store",
+        }
+    )
+
+    return response
+
+
+def _get_success_headers(thumbnail: Thumbnail) -> dict[str, str]:
+    return {
+        "Cache-Control": f"public, max-age={DEFAULT_TIME_TO_LIVE}",
+        "Content-Type": thumbnail.content_type,
+    }
+
+
+def _profiled_response(
+    thumbnail: Thumbnail, signature: str, profile_signature: str
+) -> typing.Union[dict[str, typing.Any], tuple[bytes, dict[str, str]]]:
+    """Render with the profiler on, the report path is sent in a header
+
+    Returns either an error response or the thumbnail and its headers
+    """
+    try:
+        data, report_path = thumbnail.generate_profiled(
+            signature=signature, profile_signature=profile_signature
+        )
+    except BadSignatureError:
+        return _error_response(403, "403 Forbidden: Invalid signature.")
+
+    headers = _get_success_headers(thumbnail)
+    # Shouldn't end up in the CDN, it's a one-off render
+    headers["Cache-Control"] = "no-store"
+    headers["X-Thumbnail-Profile"] = str(report_path)
+
+    return data, headers
+
+
+def _http_request_handler(event: LambdaHttpRequest, context):
+    """Called by lambda to run application."""
+    resolved = _resolve_request(event)
+
+    if isinstance(resolved, dict):
+        return resolved
+
+    thumbnail, signature = resolved
+
+    profile_signature = _get_header(event, PROFILE_HEADER)
+
+    if profile_signature is not None:
+        profiled = _profiled_response(thumbnail, signature, profile_signature)
+
+        if isinstance(profiled, dict):
+            return profiled
+
+        data, headers = profiled
+
         return {
-            "statusCode": 403,
-            "body": "403 Forbidden: Signature is required.",
-            "isBase64Encoded": False,
-            "headers": {
-                "Content-Type": "text/plain",
-            },
+            "statusCode": 200,
+            "body": base64.b64encode(data),
+            "isBase64Encoded": True,
+            "headers": headers,
         }
 
     # TODO Make sure thumbnail doesn't exceed max size
+    # Use the streaming handler for large thumbnails
+
+    # Background uploads aren't flushed here, lambda may freeze the
+    # environment before they finish. They resume on the next invocation and
+    # anything that's lost is generated again on the next miss
     try:
-        data = thumbnail.get_or_generate(signature=signature)
+        data = thumbnail.get_or_generate(
+            signature=signature, deadline=_get_deadline(context)
+        )
 
     # TODO More helpful error messages
     except BadSignatureError:
-        return {
-            "statusCode": 403,
-            "body": "403 Forbidden: Invalid signature.",
-            "isBase64Encoded": False,
-            "headers": {
-                "Content-Type": "text/plain",
-            },
-        }
+        return _error_response(403, "403 Forbidden: Invalid signature.")
+    except DeadlineExceededError:
+        return _deadline_exceeded_response(thumbnail, signature, context)
 
     return {
         "statusCode": 200,
         "body": base64.b64encode(data),
         "isBase64Encoded": True,
-        "headers": {
-            "Cache-Control": f"public, max-age={DEFAULT_TIME_TO_LIVE}",
-            "Content-Type": thumbnail.content_type,
+        "headers": _get_success_headers(thumbnail),
+    }
+
+
+def _from_function_url_event(event: dict[str, typing.Any]) -> LambdaHttpRequest:
+    """Convert a (version 2.0) function URL event to the shape used above
+
+    Streamed responses are only available through function URLs, which
+    send single values instead of lists
+    """
+    query = event.get("queryStringParameters") or {}
+    headers = event.get("headers") or {}
+
+    return {
+        "httpMethod": event["requestContext"]["http"]["method"],
+        "path": event["rawPath"],
+        "multiValueQueryStringParameters": {
+            key: value.split(",") for key, value in query.items()
+        },
+        "multiValueHeaders": {
+            key.lower(): value.split(",") for key, value in headers.items()
         },
+        "body": event.get("body", ""),
+        "isBase64Encoded": event.get("isBase64Encoded", False),
     }
 
 
+def _write_prelude(
+    response_stream: typing.BinaryIO, status_code: int, headers: dict[str, str]
+) -> None:
+    prelude = {"statusCode": status_code, "headers": headers}
+    response_stream.write(json.dumps(prelude).encode())
+    response_stream.write(_STREAM_PRELUDE_DELIMITER)
+
+
+def _write_error_response(
+    response_stream: typing.BinaryIO, response: dict[str, typing.Any]
+) -> None:
+    _write_prelude(response_stream, response["statusCode"], response["headers"])
+    response_stream.write(response["body"].encode())
+
+
+def streaming_lambda_handler(
+    event: dict[str, typing.Any], response_stream: typing.BinaryIO, context
+) -> None:
+    """Called by lambda to run application with response streaming.
+
+    Raw bytes are written to the client as they are encoded while the
+    upload to the target bucket happens in parallel. Avoids the base64
+    overhead and the payload limit of buffered responses.
+
+    Python has no managed streaming runtime, so this is meant to be
+    called from a custom runtime (or adapter) which passes a writable
+    binary stream for the function URL response.
+    """
+    try:
+        _stream_response(event, response_stream, context)
+    finally:
+        # Otherwise the client waits for the rest of a response which is never
+        # coming, whatever went wrong
+        response_stream.close()
+
+        # The client has everything at this point, but lambda freezes the
+        # environment as soon as we return
+        app.flush()
+
+
+def _stream_response(
+    event: dict[str, typing.Any], response_stream: typing.BinaryIO, context
+) -> None:
+    request = _from_function_url_event(event)
+    resolved = _resolve_request(request)
+
+    if isinstance(resolved, dict):
+        _write_error_response(response_stream, resolved)
+        return
+
+    thumbnail, signature = resolved
+
+    profile_signature = _get_header(request, PROFILE_HEADER)
+
+    if profile_signature is not None:
+        # Not streamed, the stages are timed separately
+        profiled = _profiled_response(thumbnail, signature, profile_signature)
+
+        if isinstance(profiled, dict):
+            _write_error_response(response_stream, profiled)
+        else:
+            data, headers = profiled
+            _write_prelude(response_stream, 200, headers)
+            response_stream.write(data)
+
+        return
+
+    started = False
+
+    def write(chunk: bytes) -> None:
+        nonlocal started
+        # Headers can only be sent once we know the signature is fine,
+        # which is right before the first chunk
+        if not started:
+            _write_prelude(response_stream, 200, _get_success_headers(thumbnail))
+            started = True
+        response_stream.write(chunk)
+
+    try:
+        thumbnail.get_or_generate_stream(
+            signature=signature, write=write, deadline=_get_deadline(context)
+        )
+    except BadSignatureError:
+        # Nothing has been written yet, the signature is checked before encoding
+        _write_error_response(
+            response_stream, _error_response(403, "403 Forbidden: Invalid signature.")
+        )
+    except DeadlineExceededError:
+        response = _deadline_exceeded_response(thumbnail, signature, context)
+
+        # Too late for a status code if the encoder already started sending,
+        # the client sees a truncated response
+        if not started:
+            _write_error_response(response_stream, response)
+
+
+def _generate_handler(request: dict[str, str], context) -> dict[str, typing.Any]:
+    """Finish a render handed off by a request which ran out of time"""
+    thumbnail = app.get_thumbnail(request["path"])
+
+    # Not handed off again if it runs out of time, that would never end
+    try:
+        thumbnail.get_or_generate(
+            signature=request["signature"], deadline=_get_deadline(context)
+        )
+    except DeadlineExceededError:
+        logger.error("Ran out of time generating %s", request["path"])
+        return {"generated": False}
+    finally:
+        app.flush()
+
+    return {"generated": True}
+
+
+def _s3_event_handler(event: dict[str, typing.Any], context) -> dict[str, typing.Any]:
+    """Generate thumbnails for newly uploaded sources"""
+    result = PregenerateResult()
+    deadline = _get_deadline(context)
+
+    for upload in parse_s3_event(event):
+        pregenerate(app, upload, deadline=deadline, result=result)
+
+    app.flush()
+
+    # Lambda retries failed asynchronous invocations, anything that was
+    # generated is skipped the next time around
+    if result.failed:
+        raise RuntimeError(f"Could not generate {result.failed} thumbnails")
+
+    return dataclasses.asdict(result)
+
+
 # TODO Consider a class-based approach
 def lambda_handler(
     event: dict[typing.Any, typing.Any], context
@@ -148,3 +467,9 @@ def lambda_handler(
     # I believe this could be done with a set operation
     if all(key in event for key in _HTTP_REQUEST_KEYS):
         return _http_request_handler(event, context)
+
+    if _GENERATE_EVENT_KEY in event:
+        return _generate_handler(event[_GENERATE_EVENT_KEY], context)
+
+    if "Records" in event:
+        return _s3_event_handler(event, context)
@@ -0,0 +1,173 @@
+"""Spread thumbnails over many key prefixes.
+
+Normally thumbnails are stored under their source path, so all of the
+renditions in a popular gallery share one prefix. S3 limits the request rate
+per prefix and starts throttling during spikes.
+
+With sharding, the key starts with a hash of the thumbnail path instead:
+
+    a/one.jpg/200x200c/one.webp -> _shards/3f/a/one.jpg/200x200c/one.webp
+
+URLs don't change. Thumbnails stored before sharding was turned on are found
+at their old key (and copied over) until the migrate-shards command has moved
+them.
+"""
+
+import dataclasses
+import hashlib
+import threading
+import typing
+from pathlib import PurePath
+from pathlib import PurePosixPath
+
+from tiny_thumbnail_engine.environ import ENVIRON_PREFIX
+from tiny_thumbnail_engine.exceptions import ImproperlyConfiguredError
+from tiny_thumbnail_engine.exceptions import UrlError
+from tiny_thumbnail_engine.storage.protocol import StorageObject
+from tiny_thumbnail_engine.storage.protocol import StorageProtocol
+
+
+# Avoid circular dependency unless type checking
+if typing.TYPE_CHECKING:
+    from tiny_thumbnail_engine.app import App
+
+
+SHARDED_PREFIX: typing.Final[PurePosixPath] = PurePosixPath("_shards")
+
+# Hex digits of the hash in each key, 256 prefixes
+SHARD_WIDTH: typing.Final[int] = 2
+
+
+def shard_path(path: PurePosixPath) -> PurePosixPath:
+    digest = hashlib.sha256(path.as_posix().encode()).hexdigest()
+    return SHARDED_PREFIX / digest[:SHARD_WIDTH] / path
+
+
+def is_sharded(path: PurePath) -> bool:
+    return path.parts[0] == SHARDED_PREFIX.name
+
+
+def unshard_path(path: PurePosixPath) -> PurePosixPath:
+    """Thumbnail path of a target key, in either layout"""
+    if not is_sharded(path):
+        return path
+
+    return PurePosixPath(*path.parts[2:])
+
+
+def list_sharded_targets(
+    storage_backend: StorageProtocol, prefix: str = ""
+) -> typing.Iterator[StorageObject]:
+    """Sharded targets whose thumbnail path starts with prefix"""
+    if not prefix:
+        yield from storage_backend._list_targets(f"{SHARDED_PREFIX}/")
+        return
+
+    # The prefix could be in any shard, but one listing per shard beats
+    # listing everything
+    for shard in range(16**SHARD_WIDTH):
+        yield from storage_backend._list_targets(
+            f"{SHARDED_PREFIX}/{shard:0{SHARD_WIDTH}x}/{prefix}"
+        )
+
+
+@dataclasses.dataclass
+class MigrateResult:
+    copied: int = 0
+    # Already at the sharded key
+    skipped: int = 0
+    deleted: int = 0
+    # Couldn't be copied (or checked before deleting), left where they are
+    failed: int = 0
+
+    _lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock, repr=False, compare=False
+    )
+
+    def add(self, **counts: int) -> None:
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+
+def migrate(
+    app: "App",
+    prefix: str = "",
+    *,
+    delete: bool = False,
+    concurrency: int = 8,
+) -> MigrateResult:
+    """Copy thumbnails stored under their source path to their sharded key
+
+    With delete, old keys are removed once the copy is known to exist
+    """
+    # Without sharding the old keys are the ones being served, deleting them
+    # would throw every thumbnail away
+    if not app.sharded_targets:
+        raise ImproperlyConfiguredError(
+            f"Set {ENVIRON_PREFIX}_SHARDED_TARGETS=1 before migrating "
+            "thumbnails to sharded keys."
+        )
+
+    # Avoid circular import, the model uses this module
+    from tiny_thumbnail_engine.model import Thumbnail
+    from tiny_thumbnail_engine.sweep import run_bounded
+
+    storage_backend = app.storage_backend
+    result = MigrateResult()
+
+    def thumbnails() -> typing.Iterator[tuple[PurePosixPath, Thumbnail]]:
+        for target in storage_backend._list_targets(prefix):
+            # Sidecars, content addressed renditions, already sharded, etc.
+            if target.path.parts[0].startswith("_"):
+                continue
+
+            try:
+                yield target.path, Thumbnail.from_path(target.path.as_posix(), app=app)
+            except UrlError:
+                continue
+
+    def copy(item: tuple[PurePosixPath, Thumbnail]) -> None:
+        path, thumbnail = item
+        sharded = shard_path(path)
+
+        if storage_backend._read_target_metadata(sharded) is not None:
+            result.add(skipped=1)
+            return
+
+        data = storage_backend._read_target(path)
+
+        # Deleted since it was listed
+        if data is None:
+            return
+
+        storage_backend._write_target(
+            sharded,
+            data,
+            content_type=thumbnail.content_type,
+            metadata=storage_backend._read_target_metadata(path),
+        )
+        result.add(copied=1)
+
+    result.add(failed=run_bounded(copy, thumbnails(), concurrency=concurrency))
+
+    # Background uploads, the copies have to exist before deleting anything
+    app.flush()
+
+    if delete:
+        copied: list[PurePosixPath] = []
+        lock = threading.Lock()
+
+        def check(item: tuple[PurePosixPath, Thumbnail]) -> None:
+            path, __ = item
+
+            if storage_backend._read_target_metadata(shard_path(path)) is not None:
+                with lock:
+                    copied.append(path)
+
+        result.add(failed=run_bounded(check, thumbnails(), concurrency=concurrency))
+
+        storage_backend._delete_targets(copied)
+        result.add(deleted=len(copied))
+
+    return result
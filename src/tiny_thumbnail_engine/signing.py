@@ -64,8 +64,12 @@ class BadSignatureError(Exception):
     """Signature does not match."""
 
 
-def sign(*, secret_key: str, value: str) -> str:
-    """Create a base64 encoded cryptographic signature of 'value'"""
+def sign(*, secret_key: str, value: str, salt: str = "") -> str:
+    """Create a base64 encoded cryptographic signature of 'value'
+
+    Signatures made with different salts never match, give each kind of
+    signed value its own salt. Thumbnail URLs don't have one
+    """
 
     # We want to make sure that the key for HMAC has more than
     # 224 bytes of entropy
@@ -76,9 +80,13 @@ def sign(*, secret_key: str, value: str) -> str:
     if len(secret_key) <= 224:
         raise ValueError("secret_key does not have enough entropy")
 
-    signature = hmac.digest(
-        key=secret_key.encode(), msg=value.encode(), digest=DIGEST_MOD
-    )
+    key = secret_key.encode()
+
+    # Same idea as Django's salted signers, a separate key per salt
+    if salt:
+        key = hmac.digest(key=key, msg=salt.encode(), digest=DIGEST_MOD)
+
+    signature = hmac.digest(key=key, msg=value.encode(), digest=DIGEST_MOD)
 
     return base64.urlsafe_b64encode(signature).decode().rstrip("=")
 
@@ -88,8 +96,9 @@ def unsign(
     secret_key: str,
     value: str,
     signature: str,
+    salt: str = "",
 ) -> None:
-    compare = sign(secret_key=secret_key, value=value)
+    compare = sign(secret_key=secret_key, value=value, salt=salt)
 
     if not secrets.compare_digest(signature, compare):
         raise BadSignatureError
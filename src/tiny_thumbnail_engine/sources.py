@@ -0,0 +1,133 @@
+"""Information about source images, recorded in target storage.
+
+Small JSON sidecar per source, written the first time a source is read
+while generating a thumbnail. Lets us find renditions without reading
+(or hashing) the source again.
+"""
+
+import collections
+import dataclasses
+import hashlib
+import json
+import threading
+import time
+import typing
+from pathlib import PurePosixPath
+
+
+# Avoid circular dependency unless type checking
+if typing.TYPE_CHECKING:
+    from .app import App
+
+
+SOURCE_INFO_PREFIX: typing.Final[PurePosixPath] = PurePosixPath("_sources")
+
+# Renditions shared by every source with the same contents
+CONTENT_ADDRESSED_PREFIX: typing.Final[PurePosixPath] = PurePosixPath("_cas")
+
+# Target metadata recording which version of the source a thumbnail was
+# generated from
+SOURCE_VERSION_METADATA: typing.Final[str] = "source-version"
+
+DEFAULT_CACHE_SIZE: typing.Final[int] = 10_000
+
+# Seconds, when the cache is on by default (with canonical specs)
+DEFAULT_CACHE_TTL: typing.Final[float] = 60.0
+
+
+def source_digest(buffer: bytes) -> str:
+    return hashlib.sha256(buffer).hexdigest()
+
+
+@dataclasses.dataclass
+class SourceInfo:
+    # sha256 of the source bytes
+    digest: str
+    # Version reported by the storage backend (the ETag on S3)
+    version: typing.Optional[str] = None
+    # Tiny blurry version of the image as a data URI, for inlining in HTML
+    # while the real thumbnail loads
+    placeholder: typing.Optional[str] = None
+    # Dimensions after applying the orientation, used to find equivalent specs
+    width: typing.Optional[int] = None
+    height: typing.Optional[int] = None
+
+    @classmethod
+    def from_json(cls, data: bytes) -> "SourceInfo":
+        fields = {field.name for field in dataclasses.fields(cls)}
+        # Ignore unknown keys, sidecars could have been written by a newer version
+        return cls(**{k: v for k, v in json.loads(data).items() if k in fields})
+
+    def to_json(self) -> bytes:
+        return json.dumps(dataclasses.asdict(self)).encode()
+
+
+def get_source_info_path(path: str) -> PurePosixPath:
+    return SOURCE_INFO_PREFIX / f"{path}.json"
+
+
+def read_source_info(app: "App", path: str) -> typing.Optional[SourceInfo]:
+    data = app.storage_backend._read_target(get_source_info_path(path))
+
+    if data is None:
+        return None
+
+    # Corrupt sidecars are treated as missing, they'll be overwritten
+    try:
+        return SourceInfo.from_json(data)
+    except (ValueError, TypeError):
+        return None
+
+
+def write_source_info(app: "App", path: str, info: SourceInfo) -> None:
+    app.storage_backend._write_target(
+        get_source_info_path(path), info.to_json(), content_type="application/json"
+    )
+
+
+@dataclasses.dataclass
+class SourceInfoCache:
+    """Recently used sidecars, saves a round trip on every request
+
+    Sidecars change when a source is replaced. Entries expire so that a
+    change made by another execution environment is eventually seen
+    """
+
+    # Seconds
+    ttl: float
+
+    _: dataclasses.KW_ONLY
+
+    max_size: int = DEFAULT_CACHE_SIZE
+
+    _entries: "collections.OrderedDict[str, tuple[float, SourceInfo]]" = (
+        dataclasses.field(init=False, default_factory=collections.OrderedDict)
+    )
+    _lock: threading.Lock = dataclasses.field(
+        init=False, default_factory=threading.Lock
+    )
+
+    def get(self, path: str) -> typing.Optional[SourceInfo]:
+        with self._lock:
+            entry = self._entries.get(path)
+
+            if entry is None:
+                return None
+
+            expires, info = entry
+
+            if expires < time.monotonic():
+                del self._entries[path]
+                return None
+
+            self._entries.move_to_end(path)
+
+        return info
+
+    def set(self, path: str, info: SourceInfo) -> None:
+        with self._lock:
+            self._entries[path] = time.monotonic() + self.ttl, info
+            self._entries.move_to_end(path)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
@@ -0,0 +1,211 @@
+# Persist generated thumbnails without making the client wait for the upload
+# Wraps another storage backend, reads go straight through and writes are
+# handed to a worker thread
+
+# The queue is bounded, if the worker can't keep up we drop the write
+# That's fine, thumbnails are regenerated on the next miss
+
+import dataclasses
+import logging
+import queue
+import threading
+import typing
+from pathlib import PurePath
+
+from tiny_thumbnail_engine.storage.protocol import StorageObject
+from tiny_thumbnail_engine.storage.protocol import StorageProtocol
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_QUEUE_SIZE: typing.Final[int] = 32
+
+
+@dataclasses.dataclass
+class BackgroundWriteStats:
+    queued: int = 0
+    written: int = 0
+    failed: int = 0
+    dropped: int = 0
+
+
+class _PendingWrite(typing.NamedTuple):
+    path: PurePath
+    contents: bytes
+    content_type: str
+    metadata: typing.Optional[dict[str, str]]
+
+
+@dataclasses.dataclass
+class BackgroundBackend:
+    backend: StorageProtocol
+
+    _: dataclasses.KW_ONLY
+
+    queue_size: int = DEFAULT_QUEUE_SIZE
+
+    stats: BackgroundWriteStats = dataclasses.field(
+        default_factory=BackgroundWriteStats
+    )
+
+    _queue: "queue.Queue[_PendingWrite]" = dataclasses.field(init=False)
+    # Writes which haven't made it to the backend yet
+    # Consulted on reads so a thumbnail isn't generated twice in a row
+    _pending: dict[PurePath, _PendingWrite] = dataclasses.field(
+        init=False, default_factory=dict
+    )
+    _lock: threading.Lock = dataclasses.field(
+        init=False, default_factory=threading.Lock
+    )
+    _worker: typing.Optional[threading.Thread] = dataclasses.field(
+        init=False, default=None
+    )
+    # Stats as of the last flush, only the difference is logged
+    _reported: BackgroundWriteStats = dataclasses.field(
+        init=False, default_factory=BackgroundWriteStats
+    )
+
+    def __post_init__(self) -> None:
+        self._queue = queue.Queue(maxsize=self.queue_size)
+
+    def _read_source(self, path: PurePath) -> bytes:
+        return self.backend._read_source(path)
+
+    def _read_source_with_version(self, path: PurePath) -> tuple[bytes, str]:
+        return self.backend._read_source_with_version(path)
+
+    def _list_sources(self, prefix: str) -> typing.Iterator[StorageObject]:
+        return self.backend._list_sources(prefix)
+
+    def _read_target(self, path: PurePath) -> typing.Optional[bytes]:
+        with self._lock:
+            pending = self._pending.get(path)
+
+        if pending is not None:
+            return pending.contents
+
+        return self.backend._read_target(path)
+
+    def _read_target_metadata(self, path: PurePath) -> typing.Optional[dict[str, str]]:
+        with self._lock:
+            pending = self._pending.get(path)
+
+        if pending is not None:
+            return dict(pending.metadata or {})
+
+        return self.backend._read_target_metadata(path)
+
+    def _list_targets(self, prefix: str) -> typing.Iterator[StorageObject]:
+        return self.backend._list_targets(prefix)
+
+    def _write_target(
+        self,
+        path: PurePath,
+        contents: bytes,
+        content_type: str,
+        metadata: typing.Optional[dict[str, str]] = None,
+    ) -> None:
+        write = _PendingWrite(path, contents, content_type, metadata)
+
+        with self._lock:
+            self._start_worker()
+
+            try:
+                self._queue.put_nowait(write)
+            except queue.Full:
+                self.stats.dropped += 1
+                logger.warning("Dropped background write of %s, queue is full", path)
+                return
+
+            self.stats.queued += 1
+            self._pending[path] = write
+
+    def _write_target_stream(
+        self,
+        path: PurePath,
+        chunks: typing.Iterable[bytes],
+        content_type: str,
+        metadata: typing.Optional[dict[str, str]] = None,
+    ) -> None:
+        # Streaming uploads already happen in parallel with the response
+        # Buffering them here would defeat the point
+        self.backend._write_target_stream(
+            path, chunks, content_type=content_type, metadata=metadata
+        )
+
+    def _delete_targets(self, paths: typing.Iterable[PurePath]) -> None:
+        self.backend._delete_targets(paths)
+
+    def _start_worker(self) -> None:
+        # Lazily started so that importing/constructing is cheap
+        # Must hold the lock
+        if self._worker is not None:
+            return
+
+        self._worker = threading.Thread(
+            target=self._run, name="tiny-thumbnail-engine-writer", daemon=True
+        )
+        self._worker.start()
+
+    def _run(self) -> None:
+        while True:
+            write = self._queue.get()
+
+            try:
+                self.backend._write_target(
+                    write.path,
+                    write.contents,
+                    content_type=write.content_type,
+                    metadata=write.metadata,
+                )
+            except Exception:
+                with self._lock:
+                    self.stats.failed += 1
+                logger.exception("Background write of %s failed", write.path)
+            else:
+                with self._lock:
+                    self.stats.written += 1
+            finally:
+                with self._lock:
+                    # Could have been replaced by a newer write for the same path
+                    if self._pending.get(write.path) is write:
+                        del self._pending[write.path]
+                self._queue.task_done()
+
+    def flush(self) -> None:
+        """Block until all queued writes have been attempted
+
+        Call on shutdown, or on lambda before the execution environment
+        is frozen
+        """
+        self._queue.join()
+        self._report()
+
+    def _report(self) -> None:
+        # Logged as counts since the last flush, so a log metric filter can
+        # sum them up
+        with self._lock:
+            current = dataclasses.replace(self.stats)
+            reported, self._reported = self._reported, current
+
+        counts = {
+            field.name: getattr(current, field.name) - getattr(reported, field.name)
+            for field in dataclasses.fields(current)
+        }
+
+        if not any(counts.values()):
+            return
+
+        # Lost uploads mean the thumbnail is generated again on the next miss
+        level = (
+            logging.WARNING if counts["failed"] or counts["dropped"] else logging.INFO
+        )
+        logger.log(
+            level,
+            "Background writes queued=%d written=%d failed=%d dropped=%d",
+            counts["queued"],
+            counts["written"],
+            counts["failed"],
+            counts["dropped"],
+        )
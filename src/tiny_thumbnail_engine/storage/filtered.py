@@ -0,0 +1,290 @@
+# Know which thumbnails definitely don't exist, without asking storage
+# Wraps another storage backend, see tiny_thumbnail_engine.bloom
+
+# Every execution environment has its own copy of the filter, refreshed
+# every so often. Thumbnails written by other environments since then are
+# missing from it, so a thumbnail that isn't in the filter can't be assumed
+# to be missing. Thumbnail.get_or_generate still looks it up, but reads the
+# source at the same time so the render doesn't wait for the lookup. A stale
+# filter costs a wasted source read, never a wrong miss.
+
+# What each environment adds is published as a delta object of its own,
+# never rewritten, and every environment merges all of the deltas on
+# refresh. Only build-filter rewrites the filter itself (and drops the
+# deltas it has caught up with). Deleted thumbnails stay in the filter until
+# it's rebuilt, which only costs a normal lookup.
+
+# Until a filter has been built (build-filter command) every thumbnail
+# might exist
+
+import dataclasses
+import hashlib
+import logging
+import threading
+import time
+import typing
+from pathlib import PurePath
+
+from tiny_thumbnail_engine.bloom import BloomFilter
+from tiny_thumbnail_engine.bloom import is_filtered
+from tiny_thumbnail_engine.bloom import list_filter_deltas
+from tiny_thumbnail_engine.bloom import read_filter_delta
+from tiny_thumbnail_engine.bloom import read_target_filter
+from tiny_thumbnail_engine.bloom import write_filter_delta
+from tiny_thumbnail_engine.storage.protocol import StorageObject
+from tiny_thumbnail_engine.storage.protocol import StorageProtocol
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_REFRESH_INTERVAL: typing.Final[float] = 5 * 60
+
+
+@dataclasses.dataclass
+class FilterStats:
+    # Thumbnails which weren't in the filter, looked up alongside a source read
+    definite_misses: int = 0
+    # Thumbnails which might exist, looked up first
+    possible_hits: int = 0
+    # Weren't in the filter but did exist, written elsewhere since the refresh
+    stale: int = 0
+
+
+@dataclasses.dataclass
+class FilteredBackend:
+    backend: StorageProtocol
+
+    _: dataclasses.KW_ONLY
+
+    # Seconds between publishing our additions and merging everyone else's
+    refresh_interval: float = DEFAULT_REFRESH_INTERVAL
+
+    stats: FilterStats = dataclasses.field(default_factory=FilterStats)
+
+    # None until loaded, or if no filter has been built
+    _filter: typing.Optional[BloomFilter] = dataclasses.field(init=False, default=None)
+    # Of the stored filter _filter was loaded from, to notice a rebuild
+    _filter_digest: typing.Optional[bytes] = dataclasses.field(init=False, default=None)
+    # Deltas already merged into _filter, including our own
+    _merged: set[str] = dataclasses.field(init=False, default_factory=set)
+    # Added since we last published
+    _recent: set[str] = dataclasses.field(init=False, default_factory=set)
+    # Starts out due, loaded in the background on the first lookup
+    _last_refresh: typing.Optional[float] = dataclasses.field(init=False, default=None)
+    _lock: threading.Lock = dataclasses.field(
+        init=False, default_factory=threading.Lock
+    )
+    # Only one refresh at a time
+    _refresh_lock: threading.Lock = dataclasses.field(
+        init=False, default_factory=threading.Lock
+    )
+
+    def _read_source(self, path: PurePath) -> bytes:
+        return self.backend._read_source(path)
+
+    def _read_source_with_version(self, path: PurePath) -> tuple[bytes, str]:
+        return self.backend._read_source_with_version(path)
+
+    def _list_sources(self, prefix: str) -> typing.Iterator[StorageObject]:
+        return self.backend._list_sources(prefix)
+
+    def _read_target(self, path: PurePath) -> typing.Optional[bytes]:
+        data = self.backend._read_target(path)
+
+        if data is not None and is_filtered(path):
+            key = path.as_posix()
+
+            with self._lock:
+                if self._filter is not None and key not in self._filter:
+                    self.stats.stale += 1
+                    # Already published by whoever wrote it
+                    self._filter.add(key)
+
+        return data
+
+    def _read_target_metadata(self, path: PurePath) -> typing.Optional[dict[str, str]]:
+        # Not filtered, callers take None to mean it needs to be generated
+        return self.backend._read_target_metadata(path)
+
+    def _list_targets(self, prefix: str) -> typing.Iterator[StorageObject]:
+        return self.backend._list_targets(prefix)
+
+    def _write_target(
+        self,
+        path: PurePath,
+        contents: bytes,
+        content_type: str,
+        metadata: typing.Optional[dict[str, str]] = None,
+    ) -> None:
+        self.backend._write_target(
+            path, contents, content_type=content_type, metadata=metadata
+        )
+        self._add(path)
+
+    def _write_target_stream(
+        self,
+        path: PurePath,
+        chunks: typing.Iterable[bytes],
+        content_type: str,
+        metadata: typing.Optional[dict[str, str]] = None,
+    ) -> None:
+        self.backend._write_target_stream(
+            path, chunks, content_type=content_type, metadata=metadata
+        )
+        self._add(path)
+
+    def _delete_targets(self, paths: typing.Iterable[PurePath]) -> None:
+        # Can't remove keys from a bloom filter, they're dropped on the next
+        # rebuild
+        self.backend._delete_targets(paths)
+
+    def _might_exist(self, path: PurePath) -> bool:
+        """Whether the thumbnail could be in storage
+
+        False only means it wasn't when the filter was last refreshed
+        """
+        if not is_filtered(path):
+            return True
+
+        self._maybe_refresh()
+
+        key = path.as_posix()
+
+        with self._lock:
+            might_exist = self._filter is None or key in self._filter
+
+            if might_exist:
+                self.stats.possible_hits += 1
+            else:
+                self.stats.definite_misses += 1
+
+        return might_exist
+
+    def _add(self, path: PurePath) -> None:
+        if not is_filtered(path):
+            return
+
+        key = path.as_posix()
+
+        with self._lock:
+            self._recent.add(key)
+            if self._filter is not None:
+                self._filter.add(key)
+
+    def _is_due(self) -> bool:
+        # Must hold the lock
+        return (
+            self._last_refresh is None
+            or time.monotonic() - self._last_refresh >= self.refresh_interval
+        )
+
+    def _maybe_refresh(self) -> None:
+        with self._lock:
+            if not self._is_due():
+                return
+            # Claim it, lookups keep using the current filter meanwhile
+            self._last_refresh = time.monotonic()
+
+        # Could be a lot of deltas for a new execution environment, don't
+        # hold up the request
+        threading.Thread(
+            target=self._refresh_in_background,
+            name="tiny-thumbnail-engine-filter",
+            daemon=True,
+        ).start()
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception("Could not refresh the target filter")
+
+    def refresh(self) -> None:
+        """Publish what we've added, then reload the filter and merge deltas"""
+        with self._refresh_lock:
+            with self._lock:
+                self._last_refresh = time.monotonic()
+
+            self._refresh()
+
+    def _refresh(self) -> None:
+        try:
+            stored = read_target_filter(self.backend)
+        except ValueError:
+            logger.warning("Ignoring unreadable target filter")
+            stored = None
+
+        if stored is None:
+            # Never built, don't start treating thumbnails as missing based on
+            # just what this process has written
+            with self._lock:
+                self._filter = None
+                self._filter_digest = None
+                self._recent.clear()
+            return
+
+        digest = hashlib.blake2b(stored.bits, digest_size=16).digest()
+
+        with self._lock:
+            rebuilt = digest != self._filter_digest
+
+            if rebuilt:
+                # Start over from the new build, it has all the deltas it
+                # deleted and the rest are merged again below
+                self._merged = set()
+            else:
+                # Has our additions and everything merged so far
+                stored = typing.cast(BloomFilter, self._filter)
+
+            recent, self._recent = self._recent, set()
+            merged = set(self._merged)
+
+        keys = set(recent)
+
+        for delta in list_filter_deltas(self.backend):
+            name = delta.path.as_posix()
+
+            if name in merged:
+                continue
+
+            # Deleted by a rebuild since the listing
+            delta_keys = read_filter_delta(self.backend, delta.path) or []
+            keys.update(delta_keys)
+            merged.add(name)
+
+        # Published after reading, so we don't read it back
+        if recent:
+            try:
+                merged.add(write_filter_delta(self.backend, recent).as_posix())
+            except Exception:
+                # Try again next time
+                with self._lock:
+                    self._recent.update(recent)
+                raise
+
+        with self._lock:
+            # Anything added while we were busy is in _recent, add it too
+            for key in keys | self._recent:
+                stored.add(key)
+
+            self._filter = stored
+            self._filter_digest = digest
+            self._merged = merged
+
+    def flush(self) -> None:
+        """Publish our additions if due, and flush the backend"""
+        with self._lock:
+            due = self._is_due() and bool(self._recent)
+
+            if due:
+                self._last_refresh = time.monotonic()
+
+        # Synchronously, lambda may freeze the environment after this
+        if due:
+            self.refresh()
+
+        flush = getattr(self.backend, "flush", None)
+
+        if flush is not None:
+            flush()
@@ -0,0 +1,153 @@
+# In-process stand-in for S3
+# Useful for load testing and for trying things out locally without a bucket
+# Everything is lost when the process exits
+
+import dataclasses
+import hashlib
+import threading
+import time
+import typing
+from pathlib import PurePath
+from pathlib import PurePosixPath
+
+from tiny_thumbnail_engine.storage.protocol import StorageObject
+
+
+def _version(contents: bytes) -> str:
+    # Same as the ETag of a (non-multipart) S3 upload
+    return hashlib.md5(contents).hexdigest()  # noqa: S324
+
+
+@dataclasses.dataclass
+class _StoredObject:
+    contents: bytes
+    content_type: str
+    last_modified: float
+    metadata: dict[str, str] = dataclasses.field(default_factory=dict)
+
+    def as_storage_object(self, path: str) -> StorageObject:
+        return StorageObject(
+            path=PurePosixPath(path),
+            version=_version(self.contents),
+            last_modified=self.last_modified,
+        )
+
+
+@dataclasses.dataclass
+class MemoryBackend:
+    # Keyed on posix paths, same as S3 keys
+    sources: dict[str, _StoredObject] = dataclasses.field(default_factory=dict)
+    targets: dict[str, _StoredObject] = dataclasses.field(default_factory=dict)
+
+    _: dataclasses.KW_ONLY
+
+    # Simulated round trip time in seconds, S3 is usually somewhere around
+    # 10-30ms for small objects
+    latency: float = 0.0
+
+    _lock: threading.Lock = dataclasses.field(
+        init=False, default_factory=threading.Lock
+    )
+
+    def _round_trip(self) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add_source(self, path: str, contents: bytes) -> None:
+        with self._lock:
+            self.sources[path] = _StoredObject(
+                contents=contents,
+                content_type="application/octet-stream",
+                last_modified=time.time(),
+            )
+
+    def _read_source(self, path: PurePath) -> bytes:
+        contents, __ = self._read_source_with_version(path)
+
+        return contents
+
+    def _read_source_with_version(self, path: PurePath) -> tuple[bytes, str]:
+        self._round_trip()
+
+        with self._lock:
+            # KeyError, same failure mode as boto3 raising on a missing key
+            stored = self.sources[path.as_posix()]
+
+        return stored.contents, _version(stored.contents)
+
+    def _list(
+        self, objects: dict[str, _StoredObject], prefix: str
+    ) -> typing.Iterator[StorageObject]:
+        self._round_trip()
+
+        with self._lock:
+            listing = [
+                stored.as_storage_object(path)
+                for path, stored in sorted(objects.items())
+                if path.startswith(prefix)
+            ]
+
+        yield from listing
+
+    def _list_sources(self, prefix: str) -> typing.Iterator[StorageObject]:
+        return self._list(self.sources, prefix)
+
+    def _read_target(self, path: PurePath) -> typing.Optional[bytes]:
+        self._round_trip()
+
+        with self._lock:
+            stored = self.targets.get(path.as_posix())
+
+        if stored is None:
+            return None
+
+        return stored.contents
+
+    def _read_target_metadata(self, path: PurePath) -> typing.Optional[dict[str, str]]:
+        self._round_trip()
+
+        with self._lock:
+            stored = self.targets.get(path.as_posix())
+
+        if stored is None:
+            return None
+
+        return dict(stored.metadata)
+
+    def _list_targets(self, prefix: str) -> typing.Iterator[StorageObject]:
+        return self._list(self.targets, prefix)
+
+    def _write_target(
+        self,
+        path: PurePath,
+        contents: bytes,
+        content_type: str,
+        metadata: typing.Optional[dict[str, str]] = None,
+    ) -> None:
+        self._round_trip()
+
+        with self._lock:
+            self.targets[path.as_posix()] = _StoredObject(
+                contents=contents,
+                content_type=content_type,
+                last_modified=time.time(),
+                metadata=dict(metadata or {}),
+            )
+
+    def _delete_targets(self, paths: typing.Iterable[PurePath]) -> None:
+        self._round_trip()
+
+        with self._lock:
+            for path in paths:
+                self.targets.pop(path.as_posix(), None)
+
+    def _write_target_stream(
+        self,
+        path: PurePath,
+        chunks: typing.Iterable[bytes],
+        content_type: str,
+        metadata: typing.Optional[dict[str, str]] = None,
+    ) -> None:
+        self._write_target(
+            path, b"".join(chunks), content_type=content_type, metadata=metadata
+        )
@@ -1,13 +1,60 @@
+import dataclasses
 import typing
 from pathlib import PurePath
+from pathlib import PurePosixPath
+
+
+@dataclasses.dataclass
+class StorageObject:
+    """An entry in a storage listing"""
+
+    path: PurePosixPath
+    # Changes whenever the contents change (the ETag on S3)
+    version: typing.Optional[str] = None
+    # Unix timestamp
+    last_modified: typing.Optional[float] = None
 
 
 class StorageProtocol(typing.Protocol):
     def _read_source(self, path: PurePath) -> bytes:
         ...
 
+    # Same as _read_source, also returns the current version of the source
+    def _read_source_with_version(self, path: PurePath) -> tuple[bytes, str]:
+        ...
+
+    def _list_sources(self, prefix: str) -> typing.Iterator[StorageObject]:
+        ...
+
     def _read_target(self, path: PurePath) -> typing.Optional[bytes]:
         ...
 
-    def _write_target(self, path: PurePath, contents: bytes, content_type: str) -> None:
+    # None if the target doesn't exist
+    def _read_target_metadata(self, path: PurePath) -> typing.Optional[dict[str, str]]:
+        ...
+
+    def _list_targets(self, prefix: str) -> typing.Iterator[StorageObject]:
+        ...
+
+    def _write_target(
+        self,
+        path: PurePath,
+        contents: bytes,
+        content_type: str,
+        metadata: typing.Optional[dict[str, str]] = None,
+    ) -> None:
+        ...
+
+    def _delete_targets(self, paths: typing.Iterable[PurePath]) -> None:
+        ...
+
+    # Contents are consumed as they are produced, the full object is never
+    # handed over in one piece
+    def _write_target_stream(
+        self,
+        path: PurePath,
+        chunks: typing.Iterable[bytes],
+        content_type: str,
+        metadata: typing.Optional[dict[str, str]] = None,
+    ) -> None:
         ...
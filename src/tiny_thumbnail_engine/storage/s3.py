@@ -6,11 +6,14 @@ import dataclasses
 import io
 import typing
 from pathlib import Path
+from pathlib import PurePath
+from pathlib import PurePosixPath
 
 import boto3
 from botocore.exceptions import ClientError
 
 from tiny_thumbnail_engine.environ import EnvironFactory
+from tiny_thumbnail_engine.storage.protocol import StorageObject
 
 
 ENVIRON_PREFIX = "TINY_THUMBNAIL_ENGINE"
@@ -20,13 +23,58 @@ DEFAULT_TIME_TO_LIVE: typing.Final[int] = (
 )  # 180 days, kind of bonkers. That's what Google says
 
 
+# HEAD responses have no body, so only the status code comes back
+_NOT_FOUND_CODES: typing.Final[frozenset[str]] = frozenset(
+    {"404", "NoSuchKey", "NotFound"}
+)
+
+
+class _ChunkReader(io.RawIOBase):
+    """Read-only file object over an iterable of bytes
+
+    Lets boto3 upload data which is still being produced
+    """
+
+    def __init__(self, chunks: typing.Iterable[bytes]) -> None:
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: typing.Any) -> int:
+        while not self._pending:
+            try:
+                self._pending = next(self._chunks)
+            except StopIteration:
+                return 0
+
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+
+        return size
+
+
+def _as_storage_object(item: dict[str, typing.Any]) -> StorageObject:
+    return StorageObject(
+        path=PurePosixPath(item["Key"]),
+        version=item["ETag"].strip('"'),
+        last_modified=item["LastModified"].timestamp(),
+    )
+
+
 @dataclasses.dataclass
 class S3Backend:
     source_bucket: str = dataclasses.field(
-        factory=EnvironFactory("SOURCE_BUCKET", "tiny_thumbnail_engine.s3.S3Backend")
+        default_factory=EnvironFactory(
+            "SOURCE_BUCKET", "tiny_thumbnail_engine.s3.S3Backend"
+        )
     )
     target_bucket: str = dataclasses.field(
-        factory=EnvironFactory("TARGET_BUCKET", "tiny_thumbnail_engine.s3.S3Backend")
+        default_factory=EnvironFactory(
+            "TARGET_BUCKET", "tiny_thumbnail_engine.s3.S3Backend"
+        )
     )
 
     # boto3 s3 client
@@ -36,13 +84,28 @@ class S3Backend:
         self.client = boto3.client("s3")
 
     def _read_source(self, path: Path) -> bytes:
+        body, __ = self._read_source_with_version(path)
+
+        return body
+
+    def _read_source_with_version(self, path: Path) -> tuple[bytes, str]:
         key = path.as_posix()
         data = self.client.get_object(Bucket=self.source_bucket, Key=key)
 
         # Not sure why boto3-stubs is suggesting this is typing.Any
         body: bytes = data["Body"].read()
 
-        return body
+        return body, data["ETag"].strip('"')
+
+    def _list(self, bucket: str, prefix: str) -> typing.Iterator[StorageObject]:
+        paginator = self.client.get_paginator("list_objects_v2")
+
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                yield _as_storage_object(item)
+
+    def _list_sources(self, prefix: str) -> typing.Iterator[StorageObject]:
+        return self._list(self.source_bucket, prefix)
 
     # Function can fail
     # Probably should raise a wrapped file not found exceptions instead
@@ -50,7 +113,7 @@ class S3Backend:
         key = path.as_posix()
 
         try:
-            data = self.client.get_object(Bucket=self.source_bucket, Key=key)
+            data = self.client.get_object(Bucket=self.target_bucket, Key=key)
         # Catches more exceptions than "NoSuchKey"
         # Probably fine failure mode
         except ClientError:
@@ -61,15 +124,81 @@ class S3Backend:
 
         return body
 
-    def _write_target(self, path: Path, contents: bytes, content_type: str) -> None:
+    def _read_target_metadata(self, path: Path) -> typing.Optional[dict[str, str]]:
+        key = path.as_posix()
+
+        try:
+            data = self.client.head_object(Bucket=self.target_bucket, Key=key)
+        # Unlike reads, a missing object has to be told apart from throttling,
+        # permissions, etc. or the sweep regenerates everything it can't check
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in _NOT_FOUND_CODES:
+                return None
+            raise
+
+        metadata: dict[str, str] = data.get("Metadata", {})
+
+        return metadata
+
+    def _list_targets(self, prefix: str) -> typing.Iterator[StorageObject]:
+        return self._list(self.target_bucket, prefix)
+
+    def _get_extra_args(
+        self, content_type: str, metadata: typing.Optional[dict[str, str]]
+    ) -> dict[str, typing.Any]:
+        extra_args: dict[str, typing.Any] = {
+            "ContentType": content_type,
+            "CacheControl": f"public, max-age={DEFAULT_TIME_TO_LIVE}",
+        }
+
+        if metadata:
+            extra_args["Metadata"] = metadata
+
+        return extra_args
+
+    def _write_target(
+        self,
+        path: Path,
+        contents: bytes,
+        content_type: str,
+        metadata: typing.Optional[dict[str, str]] = None,
+    ) -> None:
         key = path.as_posix()
         f = io.BytesIO(contents)
         self.client.upload_fileobj(
             f,
             self.target_bucket,
             key,
-            ExtraArgs={
-                "ContentType": content_type,
-                "CacheControl": f"public, max-age={DEFAULT_TIME_TO_LIVE}",
-            },
+            ExtraArgs=self._get_extra_args(content_type, metadata),
+        )
+
+    def _delete_targets(self, paths: typing.Iterable[PurePath]) -> None:
+        keys = [path.as_posix() for path in paths]
+
+        # delete_objects takes at most 1000 keys
+        for start in range(0, len(keys), 1000):
+            self.client.delete_objects(
+                Bucket=self.target_bucket,
+                Delete={
+                    "Objects": [{"Key": key} for key in keys[start : start + 1000]],
+                    "Quiet": True,
+                },
+            )
+
+    def _write_target_stream(
+        self,
+        path: Path,
+        chunks: typing.Iterable[bytes],
+        content_type: str,
+        metadata: typing.Optional[dict[str, str]] = None,
+    ) -> None:
+        key = path.as_posix()
+        # upload_fileobj switches to a multipart upload for large objects, so
+        # parts are sent while the rest of the image is still being encoded
+        f = io.BufferedReader(_ChunkReader(chunks))
+        self.client.upload_fileobj(
+            f,
+            self.target_bucket,
+            key,
+            ExtraArgs=self._get_extra_args(content_type, metadata),
         )
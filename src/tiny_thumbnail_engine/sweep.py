@@ -0,0 +1,223 @@
+"""Regenerate thumbnails whose source has been replaced.
+
+Every thumbnail records the version of the source it was generated from
+(see SOURCE_VERSION_METADATA). The sweep lists the sources and their
+existing renditions and regenerates only the ones which are out of date.
+"""
+
+import dataclasses
+import logging
+import posixpath
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePosixPath
+
+from tiny_thumbnail_engine.exceptions import UrlError
+from tiny_thumbnail_engine.model import Thumbnail
+from tiny_thumbnail_engine.model import ThumbnailSpec
+from tiny_thumbnail_engine.sharding import is_sharded
+from tiny_thumbnail_engine.sharding import list_sharded_targets
+from tiny_thumbnail_engine.sharding import unshard_path
+from tiny_thumbnail_engine.sources import CONTENT_ADDRESSED_PREFIX
+from tiny_thumbnail_engine.sources import SOURCE_VERSION_METADATA
+from tiny_thumbnail_engine.sources import read_source_info
+from tiny_thumbnail_engine.storage.protocol import StorageObject
+
+
+# Avoid circular dependency unless type checking
+if typing.TYPE_CHECKING:
+    from tiny_thumbnail_engine.app import App
+
+
+logger = logging.getLogger(__name__)
+
+
+T = typing.TypeVar("T")
+
+
+def run_bounded(
+    func: typing.Callable[[T], None],
+    items: typing.Iterable[T],
+    *,
+    concurrency: int,
+) -> int:
+    """Call func for every item on a thread pool
+
+    Listings can be huge, so don't queue up more work than there are workers
+    (or hold on to a future per item). Exceptions are logged, returns how
+    many items failed
+    """
+    slots = threading.BoundedSemaphore(concurrency)
+    lock = threading.Lock()
+    failed = 0
+
+    def call(item: T) -> None:
+        nonlocal failed
+
+        try:
+            func(item)
+        except Exception:
+            logger.exception("Failed on %r", item)
+
+            with lock:
+                failed += 1
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for item in items:
+            slots.acquire()
+            executor.submit(call, item)
+
+    return failed
+
+
+@dataclasses.dataclass
+class SweepResult:
+    checked: int = 0
+    stale: int = 0
+    regenerated: int = 0
+    # Stale thumbnails at their unsharded key, with sharding on
+    deleted: int = 0
+    failed: int = 0
+
+    _lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock, repr=False, compare=False
+    )
+
+    def add(self, **counts: int) -> None:
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+
+def _is_internal(path: PurePosixPath) -> bool:
+    # Sidecars, content addressed renditions, etc.
+    return path.parts[0].startswith("_")
+
+
+def _regenerate(
+    result: SweepResult,
+    thumbnail: Thumbnail,
+    checked_path: typing.Optional[PurePosixPath],
+) -> None:
+    try:
+        thumbnail._generate(checked_path, rerender=True)
+    except Exception:
+        logger.exception("Could not regenerate %s", thumbnail._get_thumbnail_path())
+        result.add(failed=1)
+    else:
+        result.add(regenerated=1)
+
+
+def _sweep_paths(
+    app: "App", prefix: str, *, concurrency: int, result: SweepResult
+) -> None:
+    versions = {
+        source.path.as_posix(): source.version
+        for source in app.storage_backend._list_sources(prefix)
+    }
+
+    def targets() -> typing.Iterator[StorageObject]:
+        # Renditions live under the source path, so the same prefix works
+        for target in app.storage_backend._list_targets(prefix):
+            if not _is_internal(target.path):
+                yield target
+
+        # Old keys are still listed above, they can be served until
+        # migrate-shards has moved them
+        if app.sharded_targets:
+            yield from list_sharded_targets(app.storage_backend, prefix)
+
+    def thumbnails() -> typing.Iterator[tuple[Thumbnail, PurePosixPath]]:
+        for target in targets():
+            try:
+                thumbnail = Thumbnail.from_path(
+                    unshard_path(target.path).as_posix(), app=app
+                )
+            except UrlError:
+                continue
+
+            # Source was deleted, nothing to regenerate from
+            if thumbnail.path in versions:
+                yield thumbnail, target.path
+
+    def check(item: tuple[Thumbnail, PurePosixPath]) -> None:
+        thumbnail, target_path = item
+        metadata = app.storage_backend._read_target_metadata(target_path) or {}
+
+        result.add(checked=1)
+
+        if metadata.get(SOURCE_VERSION_METADATA) == versions[thumbnail.path]:
+            return
+
+        result.add(stale=1)
+
+        # Generating writes to the sharded key, this one would stay stale
+        # (and be copied over by the fallback). Generated again on a miss
+        if app.sharded_targets and not is_sharded(target_path):
+            app.storage_backend._delete_targets([target_path])
+            result.add(deleted=1)
+            return
+
+        _regenerate(result, thumbnail, target_path)
+
+    # Couldn't be checked, e.g. throttled
+    result.add(failed=run_bounded(check, thumbnails(), concurrency=concurrency))
+
+
+def _sweep_content_addressed(
+    app: "App", prefix: str, *, concurrency: int, result: SweepResult
+) -> None:
+    # Renditions are shared between sources, so staleness is tracked per
+    # source in the sidecar instead of on the renditions
+    def check(source: StorageObject) -> None:
+        path = source.path.as_posix()
+        info = read_source_info(app, path)
+
+        # Never generated
+        if info is None:
+            return
+
+        result.add(checked=1)
+
+        if info.version == source.version:
+            return
+
+        result.add(stale=1)
+
+        # Render the same specs for the new contents
+        old_prefix = CONTENT_ADDRESSED_PREFIX / info.digest[:2] / info.digest
+
+        for rendition in app.storage_backend._list_targets(f"{old_prefix}/"):
+            spec, output_format = posixpath.splitext(rendition.path.name)
+
+            thumbnail = Thumbnail(
+                path,
+                ThumbnailSpec.from_string(spec),
+                typing.cast(typing.Any, output_format),
+                app=app,
+            )
+
+            _regenerate(result, thumbnail, rendition.path)
+
+    failed = run_bounded(
+        check, app.storage_backend._list_sources(prefix), concurrency=concurrency
+    )
+    result.add(failed=failed)
+
+
+def sweep(app: "App", prefix: str = "", *, concurrency: int = 8) -> SweepResult:
+    """Regenerate thumbnails generated from an older version of their source"""
+    result = SweepResult()
+
+    if app.content_addressed:
+        _sweep_content_addressed(app, prefix, concurrency=concurrency, result=result)
+    else:
+        _sweep_paths(app, prefix, concurrency=concurrency, result=result)
+
+    # Background uploads
+    app.flush()
+
+    return result
@@ -0,0 +1,139 @@
+"""Runtime settings for libvips.
+
+libvips keeps a cache of recent operations (and the files they opened)
+and sizes its thread pool from the number of cores. The defaults are tuned
+for desktop image editors which re-run the same operations, not for a
+service which processes every image once.
+
+These settings are process wide, they are applied when the App is created.
+"""
+
+import dataclasses
+import logging
+import os
+import typing
+
+from tiny_thumbnail_engine.environ import ENVIRON_PREFIX
+from tiny_thumbnail_engine.environ import environ_int
+from tiny_thumbnail_engine.exceptions import ImproperlyConfiguredError
+
+
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+
+logger = logging.getLogger(__name__)
+
+
+# "sequential" lets libvips stream the image top to bottom through the pipeline
+# instead of decoding it all up front. Not every operation supports it, see
+# Thumbnail._get_access
+AccessMode: typing.TypeAlias = typing.Literal["random", "sequential"]
+
+_MEGABYTE: typing.Final[int] = 1024 * 1024
+
+
+@dataclasses.dataclass(frozen=True)
+class VipsConfig:
+    # Operation cache limits
+    # Every request is (usually) a different image, so the cache rarely hits
+    # and mostly just holds on to memory
+    cache_max_mem: int
+    cache_max: int
+    cache_max_files: int
+
+    _: dataclasses.KW_ONLY
+
+    # Number of worker threads per pipeline, 0 means libvips picks
+    concurrency: int = 0
+    access: AccessMode = "sequential"
+
+    def apply(self) -> None:
+        # Nothing to do on the client side
+        if pyvips is None:
+            return
+
+        pyvips.cache_set_max_mem(self.cache_max_mem)
+        pyvips.cache_set_max(self.cache_max)
+        pyvips.cache_set_max_files(self.cache_max_files)
+
+        if self.concurrency:
+            _set_concurrency(self.concurrency)
+
+
+def _set_concurrency(concurrency: int) -> None:
+    # Not exposed as a helper in every version of pyvips, but the C function
+    # is always there
+    set_concurrency = getattr(pyvips, "concurrency_set", None)
+
+    if set_concurrency is None:
+        set_concurrency = getattr(pyvips.vips_lib, "vips_concurrency_set", None)
+
+    if set_concurrency is None:
+        logger.warning(
+            "Could not set libvips concurrency, set VIPS_CONCURRENCY=%d instead",
+            concurrency,
+        )
+        return
+
+    set_concurrency(concurrency)
+
+
+PRESETS: typing.Final[dict[str, VipsConfig]] = {
+    # One or two vCPUs and a small memory allowance
+    # Every invocation is a different image, so keep the cache tiny
+    "lambda": VipsConfig(
+        cache_max_mem=16 * _MEGABYTE,
+        cache_max=50,
+        cache_max_files=0,
+        concurrency=2,
+    ),
+    # Long running worker on a big box, lots of threads per pipeline
+    # Still bound the cache so memory doesn't creep up over time
+    "render": VipsConfig(
+        cache_max_mem=256 * _MEGABYTE,
+        cache_max=500,
+        cache_max_files=20,
+        concurrency=os.cpu_count() or 0,
+    ),
+}
+
+
+def get_vips_config() -> typing.Optional[VipsConfig]:
+    """Read libvips settings from the environment
+
+    Start from a preset (defaults to "lambda" when running on lambda) and
+    override individual values. Returns None to leave libvips alone.
+    """
+    preset_name = os.environ.get(f"{ENVIRON_PREFIX}_VIPS_PRESET", "")
+
+    if not preset_name and "AWS_LAMBDA_FUNCTION_NAME" in os.environ:
+        preset_name = "lambda"
+
+    if not preset_name:
+        return None
+
+    try:
+        preset = PRESETS[preset_name]
+    except KeyError as e:
+        raise ImproperlyConfiguredError(
+            f"Unknown {ENVIRON_PREFIX}_VIPS_PRESET {preset_name!r}, "
+            f"choose from {', '.join(PRESETS)}."
+        ) from e
+
+    access = os.environ.get(f"{ENVIRON_PREFIX}_VIPS_ACCESS", preset.access)
+
+    if access not in {"random", "sequential"}:
+        raise ImproperlyConfiguredError(
+            f"{ENVIRON_PREFIX}_VIPS_ACCESS must be 'random' or 'sequential'."
+        )
+
+    return VipsConfig(
+        cache_max_mem=environ_int("VIPS_CACHE_MAX_MEM", preset.cache_max_mem),
+        cache_max=environ_int("VIPS_CACHE_MAX", preset.cache_max),
+        cache_max_files=environ_int("VIPS_CACHE_MAX_FILES", preset.cache_max_files),
+        concurrency=environ_int("VIPS_CONCURRENCY", preset.concurrency),
+        access=typing.cast(AccessMode, access),
+    )
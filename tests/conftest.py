@@ -0,0 +1,105 @@
+"""Fixtures shared by the test suite."""
+
+import typing
+from types import ModuleType
+
+import pytest
+import pyvips
+
+from tiny_thumbnail_engine import App
+from tiny_thumbnail_engine.environ import ENVIRON_PREFIX
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+
+
+SECRET_KEY: typing.Final[str] = "x" * 256
+
+# 4:3, small enough to render quickly
+SOURCE_PATH: typing.Final[str] = "products/shoe.jpg"
+SOURCE_WIDTH: typing.Final[int] = 64
+SOURCE_HEIGHT: typing.Final[int] = 48
+
+
+class AppFactory(typing.Protocol):
+    def __call__(self, **kwargs: typing.Any) -> App:
+        ...
+
+
+class Fetch(typing.Protocol):
+    def __call__(self, app: App, path: str) -> bytes:
+        ...
+
+
+@pytest.fixture
+def source() -> bytes:
+    image = pyvips.Image.black(SOURCE_WIDTH, SOURCE_HEIGHT)
+    return typing.cast(bytes, image.write_to_buffer(".jpg"))
+
+
+@pytest.fixture
+def backend(source: bytes) -> MemoryBackend:
+    backend = MemoryBackend()
+    backend.add_source(SOURCE_PATH, source)
+    return backend
+
+
+@pytest.fixture
+def make_app(backend: MemoryBackend) -> AppFactory:
+    """App using the in-memory backend, settings from kwargs not the environ"""
+
+    def make_app(**kwargs: typing.Any) -> App:
+        kwargs.setdefault("storage_backend", backend)
+        kwargs.setdefault("vips_config", None)
+        kwargs.setdefault("pregenerate", {})
+        return App(SECRET_KEY, **kwargs)
+
+    return make_app
+
+
+@pytest.fixture
+def app(make_app: AppFactory) -> App:
+    return make_app()
+
+
+@pytest.fixture
+def fetch() -> Fetch:
+    """Request a thumbnail by path, the way the lambda handler would"""
+
+    def fetch(app: App, path: str) -> bytes:
+        thumbnail = app.get_thumbnail(path)
+        __, signature = thumbnail.url.split("?signature=")
+        return thumbnail.get_or_generate(signature=signature)
+
+    return fetch
+
+
+@pytest.fixture
+def forbid_source_reads(
+    backend: MemoryBackend, monkeypatch: pytest.MonkeyPatch
+) -> typing.Callable[[], None]:
+    """Make any further read of a source fail the test"""
+
+    def read_source(*args: typing.Any) -> typing.NoReturn:
+        raise AssertionError("Source was read")
+
+    def forbid() -> None:
+        monkeypatch.setattr(backend, "_read_source_with_version", read_source)
+
+    return forbid
+
+
+@pytest.fixture
+def aws(app: App, monkeypatch: pytest.MonkeyPatch) -> ModuleType:
+    """The lambda handlers, serving from the app fixture"""
+    # Read when the module is first imported
+    monkeypatch.setenv("CLOUDFRONT_VERIFY", "")
+    monkeypatch.setenv(f"{ENVIRON_PREFIX}_SECRET_KEY", SECRET_KEY)
+    monkeypatch.setenv(
+        f"{ENVIRON_PREFIX}_STORAGE_BACKEND",
+        "tiny_thumbnail_engine.storage.memory.MemoryBackend",
+    )
+
+    from tiny_thumbnail_engine.server import aws
+
+    monkeypatch.setattr(aws, "app", app)
+
+    return aws
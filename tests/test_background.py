@@ -0,0 +1,117 @@
+"""Thumbnails persisted by a background thread."""
+
+import logging
+import threading
+import typing
+from pathlib import PurePosixPath
+
+import pytest
+
+from tiny_thumbnail_engine.storage.background import BackgroundBackend
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+
+from .conftest import AppFactory
+from .conftest import Fetch
+
+
+class SlowBackend(MemoryBackend):
+    """Writes wait until released"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def _write_target(self, *args: typing.Any, **kwargs: typing.Any) -> None:
+        self.writing.set()
+        self.release.wait(timeout=5)
+        super()._write_target(*args, **kwargs)
+
+
+def _write(backend: BackgroundBackend, path: str) -> None:
+    backend._write_target(PurePosixPath(path), path.encode(), content_type="image/jpeg")
+
+
+def test_pending_writes_are_readable() -> None:
+    slow = SlowBackend()
+    backend = BackgroundBackend(slow)
+
+    _write(backend, "a.jpg/32/a.jpg")
+
+    # Not stored yet, but a second request doesn't render it again
+    assert backend._read_target(PurePosixPath("a.jpg/32/a.jpg")) == b"a.jpg/32/a.jpg"
+    assert "a.jpg/32/a.jpg" not in slow.targets
+
+    slow.release.set()
+    backend.flush()
+
+    assert slow.targets["a.jpg/32/a.jpg"].contents == b"a.jpg/32/a.jpg"
+    assert backend.stats.written == 1
+
+
+def test_drops_writes_when_full(caplog: pytest.LogCaptureFixture) -> None:
+    slow = SlowBackend()
+    backend = BackgroundBackend(slow, queue_size=1)
+
+    _write(backend, "a.jpg/32/a.jpg")
+    # Taken off the queue by the worker
+    assert slow.writing.wait(timeout=5)
+
+    _write(backend, "b.jpg/32/b.jpg")
+    _write(backend, "c.jpg/32/c.jpg")
+
+    slow.release.set()
+
+    with caplog.at_level(logging.INFO):
+        backend.flush()
+
+    assert set(slow.targets) == {"a.jpg/32/a.jpg", "b.jpg/32/b.jpg"}
+    assert (backend.stats.queued, backend.stats.written, backend.stats.dropped) == (
+        2,
+        2,
+        1,
+    )
+    # Dropped writes are worth a warning
+    assert caplog.records[-1].levelno == logging.WARNING
+    assert "dropped=1" in caplog.records[-1].getMessage()
+
+
+def test_failed_writes_are_counted(
+    monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture
+) -> None:
+    memory = MemoryBackend()
+    backend = BackgroundBackend(memory)
+
+    def fail(*args: typing.Any, **kwargs: typing.Any) -> typing.NoReturn:
+        raise ConnectionError
+
+    monkeypatch.setattr(memory, "_write_target", fail)
+
+    _write(backend, "a.jpg/32/a.jpg")
+    backend.flush()
+
+    assert backend.stats.failed == 1
+    # Not served from memory forever
+    assert backend._read_target(PurePosixPath("a.jpg/32/a.jpg")) is None
+
+    # Only the change since the last flush is logged
+    caplog.clear()
+    backend.flush()
+    assert not caplog.records
+
+
+def test_thumbnail_is_returned_before_it_is_stored(
+    backend: MemoryBackend, make_app: AppFactory, fetch: Fetch
+) -> None:
+    slow = SlowBackend()
+    slow.sources = backend.sources
+    app = make_app(storage_backend=BackgroundBackend(slow))
+
+    data = fetch(app, "products/shoe.jpg/32/shoe.jpg")
+
+    assert "products/shoe.jpg/32/shoe.jpg" not in slow.targets
+
+    slow.release.set()
+    app.flush()
+
+    assert slow.targets["products/shoe.jpg/32/shoe.jpg"].contents == data
@@ -0,0 +1,89 @@
+"""Encoding thumbnails within a byte budget."""
+
+import logging
+from pathlib import PurePosixPath
+
+import pytest
+import pyvips
+
+from tiny_thumbnail_engine import App
+from tiny_thumbnail_engine.model import DEFAULT_QUALITY
+from tiny_thumbnail_engine.model import ENCODE_ATTEMPTS_METADATA
+from tiny_thumbnail_engine.model import MIN_QUALITY
+from tiny_thumbnail_engine.model import QUALITY_METADATA
+from tiny_thumbnail_engine.model import Thumbnail
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+
+from .conftest import SOURCE_PATH
+from .conftest import Fetch
+
+
+@pytest.fixture
+def noise() -> pyvips.Image:
+    # Compresses badly, so quality makes a real difference to the size
+    return pyvips.Image.gaussnoise(64, 64, sigma=60, mean=128).cast("uchar")
+
+
+@pytest.fixture
+def thumbnail(app: App) -> Thumbnail:
+    return app.get_thumbnail(f"{SOURCE_PATH}/64/shoe.jpg")
+
+
+def _size(thumbnail: Thumbnail, image: pyvips.Image, quality: int) -> int:
+    kwargs = {**thumbnail._get_write_kwargs(), "Q": quality}
+    return len(image.write_to_buffer(thumbnail.format, **kwargs))
+
+
+def test_fits_without_reduction(thumbnail: Thumbnail, noise: pyvips.Image) -> None:
+    data, quality, attempts = thumbnail._encode_within_budget(
+        noise, _size(thumbnail, noise, DEFAULT_QUALITY), PurePosixPath("a")
+    )
+
+    assert (quality, attempts) == (DEFAULT_QUALITY, 1)
+    assert len(data) == _size(thumbnail, noise, DEFAULT_QUALITY)
+
+
+def test_highest_quality_that_fits(thumbnail: Thumbnail, noise: pyvips.Image) -> None:
+    budget = (
+        _size(thumbnail, noise, MIN_QUALITY) + _size(thumbnail, noise, DEFAULT_QUALITY)
+    ) // 2
+
+    data, quality, attempts = thumbnail._encode_within_budget(
+        noise, budget, PurePosixPath("a")
+    )
+
+    assert MIN_QUALITY < quality < DEFAULT_QUALITY
+    assert len(data) <= budget
+    assert attempts > 1
+
+    # Starting from last time's quality takes a single encode
+    assert thumbnail._encode_within_budget(
+        noise, budget, PurePosixPath("a"), hint=quality
+    ) == (data, quality, 1)
+
+
+def test_over_budget_at_min_quality(
+    thumbnail: Thumbnail, noise: pyvips.Image, caplog: pytest.LogCaptureFixture
+) -> None:
+    with caplog.at_level(logging.WARNING):
+        data, quality, __ = thumbnail._encode_within_budget(
+            noise, 100, PurePosixPath("a")
+        )
+
+    # Served anyway, the budget is a target rather than a limit
+    assert quality == MIN_QUALITY
+    assert len(data) == _size(thumbnail, noise, MIN_QUALITY)
+    assert "does not fit in 100 bytes" in caplog.text
+
+
+def test_quality_is_stored(
+    backend: MemoryBackend, app: App, fetch: Fetch, noise: pyvips.Image
+) -> None:
+    backend.add_source("products/noise.jpg", noise.write_to_buffer(".jpg", Q=95))
+
+    data = fetch(app, "products/noise.jpg/64b1000/noise.jpg")
+
+    assert len(data) <= 1000
+    metadata = backend.targets["products/noise.jpg/64b1000/noise.jpg"].metadata
+    assert MIN_QUALITY <= int(metadata[QUALITY_METADATA]) <= DEFAULT_QUALITY
+    assert int(metadata[ENCODE_ATTEMPTS_METADATA]) >= 1
@@ -0,0 +1,72 @@
+"""Equivalent specs stored under one canonical spec."""
+
+import typing
+
+import pytest
+
+from tiny_thumbnail_engine.model import ThumbnailSpec
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+
+from .conftest import AppFactory
+from .conftest import Fetch
+
+
+@pytest.mark.parametrize(
+    ("spec", "canonical"),
+    [
+        ("32", "32x24"),
+        ("x24", "32x24"),
+        ("32x24u", "32x24"),
+        ("100x100", "64x48"),
+        ("100x100c", "64x48"),
+        ("20x20c", "20x20c"),
+        ("100x100p", "100x100p"),
+    ],
+)
+def test_canonicalize(spec: str, canonical: str) -> None:
+    assert ThumbnailSpec.from_string(spec).canonicalize(64, 48).to_string() == (
+        canonical
+    )
+
+
+def test_equivalent_specs_are_stored_once(
+    backend: MemoryBackend, make_app: AppFactory, fetch: Fetch
+) -> None:
+    app = make_app(canonical_specs=True)
+
+    assert fetch(app, "products/shoe.jpg/32/shoe.jpg") == fetch(
+        app, "products/shoe.jpg/x24/shoe.jpg"
+    )
+    assert "products/shoe.jpg/32x24/shoe.jpg" in backend.targets
+    assert "products/shoe.jpg/32/shoe.jpg" not in backend.targets
+
+
+def test_stored_before_canonical_specs(
+    make_app: AppFactory,
+    fetch: Fetch,
+    forbid_source_reads: typing.Callable[[], None],
+) -> None:
+    data = fetch(make_app(), "products/shoe.jpg/32/shoe.jpg")
+
+    app = make_app(canonical_specs=True)
+
+    # No sidecar with dimensions yet, found under the requested spec
+    forbid_source_reads()
+
+    assert fetch(app, "products/shoe.jpg/32/shoe.jpg") == data
+
+
+def test_stored_before_canonical_specs_is_copied(
+    backend: MemoryBackend, make_app: AppFactory, fetch: Fetch
+) -> None:
+    data = fetch(make_app(), "products/shoe.jpg/32/shoe.jpg")
+
+    app = make_app(canonical_specs=True)
+
+    # Records the dimensions, stored under 32x24
+    fetch(app, "products/shoe.jpg/x24/shoe.jpg")
+    del backend.targets["products/shoe.jpg/32x24/shoe.jpg"]
+
+    # Canonical key misses, found under the requested spec and copied
+    assert fetch(app, "products/shoe.jpg/32/shoe.jpg") == data
+    assert backend.targets["products/shoe.jpg/32x24/shoe.jpg"].contents == data
@@ -0,0 +1,94 @@
+"""Renditions shared by sources with the same contents."""
+
+import typing
+
+import pytest
+import pyvips
+
+from tiny_thumbnail_engine.environ import ENVIRON_PREFIX
+from tiny_thumbnail_engine.model import Thumbnail
+from tiny_thumbnail_engine.sources import read_source_info
+from tiny_thumbnail_engine.sources import source_digest
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+
+from .conftest import AppFactory
+from .conftest import Fetch
+
+
+def _stored(backend: MemoryBackend) -> set[str]:
+    return {path for path in backend.targets if path.startswith("_cas/")}
+
+
+def test_duplicate_sources_share_renditions(
+    backend: MemoryBackend,
+    source: bytes,
+    make_app: AppFactory,
+    fetch: Fetch,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    backend.add_source("products/copy.jpg", source)
+    app = make_app(content_addressed=True)
+
+    data = fetch(app, "products/shoe.jpg/32/shoe.jpg")
+
+    digest = source_digest(source)
+    assert _stored(backend) == {f"_cas/{digest[:2]}/{digest}/32.jpg"}
+
+    def render(*args: typing.Any, **kwargs: typing.Any) -> typing.NoReturn:
+        raise AssertionError("Rendered again")
+
+    monkeypatch.setattr(Thumbnail, "_render", render)
+
+    # Read and hashed to find out it's a duplicate, but not rendered
+    assert fetch(app, "products/copy.jpg/32/copy.jpg") == data
+
+    info = read_source_info(app, "products/copy.jpg")
+    assert info is not None
+    assert info.digest == digest
+
+
+def test_hits_do_not_read_the_source(
+    make_app: AppFactory,
+    fetch: Fetch,
+    forbid_source_reads: typing.Callable[[], None],
+) -> None:
+    app = make_app(content_addressed=True)
+    data = fetch(app, "products/shoe.jpg/32/shoe.jpg")
+
+    forbid_source_reads()
+
+    # Found through the sidecar
+    assert fetch(make_app(content_addressed=True), "products/shoe.jpg/32/shoe.jpg") == (
+        data
+    )
+
+
+def test_different_contents_are_not_shared(
+    backend: MemoryBackend, make_app: AppFactory, fetch: Fetch
+) -> None:
+    other = pyvips.Image.black(48, 64).write_to_buffer(".jpg")
+    backend.add_source("products/boot.jpg", other)
+    app = make_app(content_addressed=True)
+
+    fetch(app, "products/shoe.jpg/32/shoe.jpg")
+    data = fetch(app, "products/boot.jpg/32/boot.jpg")
+
+    assert len(_stored(backend)) == 2
+
+    thumbnail = pyvips.Image.new_from_buffer(data, "")
+    assert (thumbnail.width, thumbnail.height) == (32, 43)
+
+
+def test_sidecars_are_not_cached_by_default(
+    make_app: AppFactory, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.delenv(f"{ENVIRON_PREFIX}_SOURCE_INFO_CACHE_TTL", raising=False)
+
+    # A replaced source would keep its old renditions until the entry expires
+    assert make_app(content_addressed=True)._source_info_cache is None
+    # Every hit reads the sidecar, worth the risk
+    assert make_app(canonical_specs=True)._source_info_cache is not None
+
+    monkeypatch.setenv(f"{ENVIRON_PREFIX}_SOURCE_INFO_CACHE_TTL", "30")
+
+    assert make_app(content_addressed=True)._source_info_cache is not None
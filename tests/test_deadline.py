@@ -0,0 +1,108 @@
+"""Giving up on renders which would run past the deadline."""
+
+import typing
+from types import ModuleType
+
+import pytest
+import pyvips
+
+from tiny_thumbnail_engine import App
+from tiny_thumbnail_engine.deadline import Deadline
+from tiny_thumbnail_engine.exceptions import DeadlineExceededError
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+
+from .conftest import SOURCE_PATH
+from .conftest import AppFactory
+
+
+THUMBNAIL: typing.Final[str] = f"{SOURCE_PATH}/32/shoe.jpg"
+
+
+class PassedDuringRender(Deadline):
+    """Passes every check between stages, then runs out while evaluating"""
+
+    def check(self, stage: str) -> None:
+        pass
+
+    def expired(self) -> bool:
+        return True
+
+
+class LambdaContext:
+    invoked_function_arn = "arn:aws:lambda:eu-west-1:123456789012:function:thumbnails"
+
+    def __init__(self, remaining: int) -> None:
+        self.remaining = remaining
+
+    def get_remaining_time_in_millis(self) -> int:
+        return self.remaining
+
+
+def _generate(app: App, deadline: Deadline, path: str = THUMBNAIL) -> bytes:
+    thumbnail = app.get_thumbnail(path)
+    __, signature = thumbnail.url.split("?signature=")
+    return thumbnail.get_or_generate(signature=signature, deadline=deadline)
+
+
+def _event(app: App) -> dict[str, typing.Any]:
+    __, signature = app.get_thumbnail(THUMBNAIL).url.split("?signature=")
+
+    return {
+        "httpMethod": "GET",
+        "path": f"/{THUMBNAIL}",
+        "multiValueQueryStringParameters": {"signature": [signature]},
+        "multiValueHeaders": {},
+        "body": "",
+        "isBase64Encoded": False,
+    }
+
+
+def test_passed_before_reading_the_source(
+    backend: MemoryBackend,
+    app: App,
+    forbid_source_reads: typing.Callable[[], None],
+) -> None:
+    forbid_source_reads()
+
+    with pytest.raises(DeadlineExceededError, match="before reading the source"):
+        _generate(app, Deadline.after(-1))
+
+    assert not backend.targets
+
+
+@pytest.mark.parametrize("placeholders", [False, True])
+def test_evaluation_is_killed(
+    backend: MemoryBackend, make_app: AppFactory, placeholders: bool
+) -> None:
+    # libvips is only told to stop between tiles, there's nothing to stop
+    # in a tiny thumbnail which fits in one
+    noise = pyvips.Image.gaussnoise(1000, 1000).cast("uchar")
+    backend.add_source("products/noise.jpg", noise.write_to_buffer(".jpg"))
+    app = make_app(placeholders=placeholders)
+
+    with pytest.raises(DeadlineExceededError):
+        _generate(app, PassedDuringRender(0), "products/noise.jpg/800/noise.jpg")
+
+    # Neither the thumbnail nor the sidecar
+    assert not backend.targets
+
+
+def test_in_time(backend: MemoryBackend, app: App) -> None:
+    data = _generate(app, Deadline.after(60))
+
+    assert backend.targets[THUMBNAIL].contents == data
+
+
+def test_service_unavailable(backend: MemoryBackend, app: App, aws: ModuleType) -> None:
+    # Less than the margin kept back to respond
+    response = aws.lambda_handler(_event(app), LambdaContext(remaining=10))
+
+    assert response["statusCode"] == 503
+    assert response["headers"]["Retry-After"] == str(aws.RETRY_AFTER)
+    assert response["headers"]["Cache-Control"] == "no-store"
+    assert not backend.targets
+
+    response = aws.lambda_handler(_event(app), LambdaContext(remaining=60_000))
+
+    assert response["statusCode"] == 200
+    assert THUMBNAIL in backend.targets
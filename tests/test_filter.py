@@ -0,0 +1,112 @@
+"""Target filter shared by several execution environments."""
+
+import typing
+from pathlib import PurePosixPath
+
+import pytest
+
+from tiny_thumbnail_engine.bloom import BloomFilter
+from tiny_thumbnail_engine.bloom import delete_filter_deltas
+from tiny_thumbnail_engine.bloom import list_filter_deltas
+from tiny_thumbnail_engine.bloom import write_target_filter
+from tiny_thumbnail_engine.model import Thumbnail
+from tiny_thumbnail_engine.storage.filtered import FilteredBackend
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+
+from .conftest import AppFactory
+from .conftest import Fetch
+
+
+THUMBNAIL: typing.Final[str] = "products/shoe.jpg/32/shoe.jpg"
+
+
+@pytest.fixture(autouse=True)
+def empty_filter(backend: MemoryBackend) -> None:
+    write_target_filter(backend, BloomFilter.with_capacity(1000, 0.01))
+
+
+def _environment(backend: MemoryBackend) -> FilteredBackend:
+    filtered = FilteredBackend(backend)
+    filtered.refresh()
+    return filtered
+
+
+def _write(filtered: FilteredBackend, path: str) -> None:
+    filtered._write_target(PurePosixPath(path), b"thumbnail", content_type="image/jpeg")
+
+
+def test_refreshes_merge_every_environment(backend: MemoryBackend) -> None:
+    first = _environment(backend)
+    second = _environment(backend)
+
+    _write(first, "a.jpg/32/a.jpg")
+    _write(second, "b.jpg/32/b.jpg")
+
+    # Each publishes its own delta, neither overwrites the other
+    first.refresh()
+    second.refresh()
+    first.refresh()
+
+    for filtered in (first, second, _environment(backend)):
+        assert filtered._might_exist(PurePosixPath("a.jpg/32/a.jpg"))
+        assert filtered._might_exist(PurePosixPath("b.jpg/32/b.jpg"))
+        assert not filtered._might_exist(PurePosixPath("c.jpg/32/c.jpg"))
+
+    assert len(list_filter_deltas(backend)) == 2
+
+
+def test_rebuild_deletes_deltas(backend: MemoryBackend) -> None:
+    filtered = _environment(backend)
+    _write(filtered, "a.jpg/32/a.jpg")
+    filtered.refresh()
+
+    rebuilt = BloomFilter.with_capacity(1000, 0.01)
+    rebuilt.add("a.jpg/32/a.jpg")
+    write_target_filter(backend, rebuilt)
+
+    assert delete_filter_deltas(backend, before=float("inf")) == 1
+
+    filtered.refresh()
+
+    assert filtered._might_exist(PurePosixPath("a.jpg/32/a.jpg"))
+    assert not list_filter_deltas(backend)
+
+
+def test_stale_miss_is_still_looked_up(
+    backend: MemoryBackend,
+    make_app: AppFactory,
+    fetch: Fetch,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    first = _environment(backend)
+    second = _environment(backend)
+
+    data = fetch(make_app(storage_backend=first), THUMBNAIL)
+
+    # Not published yet, the second environment thinks it's missing
+    assert not second._might_exist(PurePosixPath(THUMBNAIL))
+
+    def render(*args: typing.Any, **kwargs: typing.Any) -> typing.NoReturn:
+        raise AssertionError("Rendered again")
+
+    monkeypatch.setattr(Thumbnail, "_render", render)
+
+    assert fetch(make_app(storage_backend=second), THUMBNAIL) == data
+    assert second.stats.stale == 1
+    assert second._might_exist(PurePosixPath(THUMBNAIL))
+
+
+def test_metadata_reads_are_not_filtered(backend: MemoryBackend) -> None:
+    first = _environment(backend)
+    second = _environment(backend)
+
+    first._write_target(
+        PurePosixPath(THUMBNAIL),
+        b"thumbnail",
+        content_type="image/jpeg",
+        metadata={"source-version": "etag"},
+    )
+
+    assert second._read_target_metadata(PurePosixPath(THUMBNAIL)) == {
+        "source-version": "etag"
+    }
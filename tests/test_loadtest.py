@@ -0,0 +1,74 @@
+"""Load-test harness."""
+
+from pathlib import Path
+from types import ModuleType
+
+from tiny_thumbnail_engine import App
+from tiny_thumbnail_engine.loadtest import load_access_log
+from tiny_thumbnail_engine.loadtest import run_load_test
+from tiny_thumbnail_engine.loadtest import synthetic_access_log
+
+from .conftest import SOURCE_PATH
+
+
+def test_load_access_log(tmp_path: Path) -> None:
+    log = tmp_path / "access.log"
+    log.write_text(
+        "# comment\n"
+        '1.2.3.4 - - [19/Oct/2026:13:00:00 +0000] "GET /a.jpg/200/a.webp'
+        '?signature=s HTTP/1.1" 200 1234\n'
+        "\n"
+        "/b.jpg/x300/b.jpg?signature=t\n"
+    )
+
+    assert load_access_log(log) == [
+        "/a.jpg/200/a.webp?signature=s",
+        "/b.jpg/x300/b.jpg?signature=t",
+    ]
+
+
+def test_synthetic_access_log_is_skewed(app: App) -> None:
+    urls = synthetic_access_log(
+        app,
+        [SOURCE_PATH],
+        ["32", "16x16c", "x24"],
+        [".jpg", ".webp"],
+        count=500,
+        seed=1,
+    )
+
+    assert len(urls) == 500
+    assert (
+        synthetic_access_log(
+            app,
+            [SOURCE_PATH],
+            ["32", "16x16c", "x24"],
+            [".jpg", ".webp"],
+            count=500,
+            seed=1,
+        )
+        == urls
+    )
+
+    counts = sorted((urls.count(url) for url in set(urls)), reverse=True)
+
+    # The most popular thumbnail gets a lot more traffic than the least
+    assert counts[0] > 3 * counts[-1]
+
+
+def test_run_load_test(app: App, aws: ModuleType) -> None:
+    urls = synthetic_access_log(
+        app, [SOURCE_PATH], ["32", "16x16c"], [".jpg"], count=20, seed=1
+    )
+    thumbnails = len(set(urls))
+    # Looked up, but turned away instead of generated
+    urls.append(f"{SOURCE_PATH}/x24/shoe.jpg?signature=nope")
+
+    result = run_load_test(aws.lambda_handler, app, urls)
+
+    assert result.status_codes == {200: 20, 403: 1}
+    # Sidecars and the like aren't counted, only thumbnail lookups
+    assert result.target_misses == thumbnails + 1
+    assert result.target_hits == 20 - thumbnails
+    assert len(result.latencies) == 21
+    assert "requests:     21" in result.report()
@@ -0,0 +1,81 @@
+"""Placeholders recorded in the source sidecar."""
+
+import typing
+from pathlib import PurePath
+
+import pytest
+
+from tiny_thumbnail_engine import model
+from tiny_thumbnail_engine.sources import SOURCE_INFO_PREFIX
+from tiny_thumbnail_engine.sources import read_source_info
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+
+from .conftest import SOURCE_PATH
+from .conftest import AppFactory
+from .conftest import Fetch
+
+
+def _count_sidecar_writes(
+    backend: MemoryBackend, monkeypatch: pytest.MonkeyPatch
+) -> list[PurePath]:
+    writes: list[PurePath] = []
+    write_target = backend._write_target
+
+    def counting(path: PurePath, *args: typing.Any, **kwargs: typing.Any) -> None:
+        if path.parts[0] == SOURCE_INFO_PREFIX.name:
+            writes.append(path)
+        write_target(path, *args, **kwargs)
+
+    monkeypatch.setattr(backend, "_write_target", counting)
+
+    return writes
+
+
+def test_get_placeholders(make_app: AppFactory, fetch: Fetch) -> None:
+    app = make_app(placeholders=True)
+
+    # Cropped, doesn't show the whole source
+    fetch(app, f"{SOURCE_PATH}/16x16c/shoe.jpg")
+    assert app.get_placeholders([SOURCE_PATH]) == {SOURCE_PATH: None}
+
+    fetch(app, f"{SOURCE_PATH}/32/shoe.jpg")
+
+    placeholders = app.get_placeholders([SOURCE_PATH, "products/boot.jpg"])
+    assert placeholders["products/boot.jpg"] is None
+    assert (placeholders[SOURCE_PATH] or "").startswith("data:image/")
+
+
+def test_first_render_writes_the_sidecar_once(
+    backend: MemoryBackend,
+    make_app: AppFactory,
+    fetch: Fetch,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    writes = _count_sidecar_writes(backend, monkeypatch)
+    app = make_app(placeholders=True, content_addressed=True, canonical_specs=True)
+
+    fetch(app, f"{SOURCE_PATH}/32/shoe.jpg")
+
+    assert len(writes) == 1
+    info = read_source_info(app, SOURCE_PATH)
+    assert info is not None
+    assert info.placeholder is not None
+    assert (info.width, info.height) == (64, 48)
+
+    # Nothing new to record
+    fetch(app, f"{SOURCE_PATH}/16/shoe.jpg")
+    assert len(writes) == 1
+
+
+def test_known_version_is_not_hashed_again(
+    make_app: AppFactory, fetch: Fetch, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    app = make_app(placeholders=True)
+    fetch(app, f"{SOURCE_PATH}/32/shoe.jpg")
+
+    def source_digest(buffer: bytes) -> typing.NoReturn:
+        raise AssertionError("Hashed again")
+
+    monkeypatch.setattr(model, "source_digest", source_digest)
+
+    fetch(app, f"{SOURCE_PATH}/16/shoe.jpg")
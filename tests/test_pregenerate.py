@@ -0,0 +1,182 @@
+"""Pre-generation from S3 notifications, against the in-memory backend."""
+
+import hashlib
+import typing
+from types import ModuleType
+
+import pytest
+import pyvips
+
+from tiny_thumbnail_engine import App
+from tiny_thumbnail_engine.pregenerate import SourceUpload
+from tiny_thumbnail_engine.pregenerate import get_renditions
+from tiny_thumbnail_engine.pregenerate import parse_s3_event
+from tiny_thumbnail_engine.pregenerate import pregenerate
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+
+from .conftest import SOURCE_PATH
+from .conftest import AppFactory
+
+
+def _event(
+    *keys: str, event_name: str = "ObjectCreated:Put", etag: str = "etag"
+) -> dict[str, typing.Any]:
+    return {
+        "Records": [
+            {
+                "eventSource": "aws:s3",
+                "eventName": event_name,
+                "s3": {"object": {"key": key, "eTag": etag}},
+            }
+            for key in keys
+        ]
+    }
+
+
+@pytest.fixture
+def app(make_app: AppFactory) -> App:
+    return make_app(
+        pregenerate={
+            "": ["100.jpg"],
+            "products/": ["20x20c.webp", "32.jpg"],
+        },
+    )
+
+
+def _version(backend: MemoryBackend, path: str) -> str:
+    return hashlib.md5(backend.sources[path].contents).hexdigest()  # noqa: S324
+
+
+def test_parse_s3_event_dedupes() -> None:
+    event = _event("products/shoe.jpg", "products/shoe.jpg", "products/hat.jpg")
+
+    assert parse_s3_event(event) == [
+        SourceUpload("products/shoe.jpg", "etag"),
+        SourceUpload("products/hat.jpg", "etag"),
+    ]
+
+
+def test_parse_s3_event_unquotes_keys() -> None:
+    event = _event("products/red+shoe%21.jpg")
+
+    assert parse_s3_event(event) == [SourceUpload("products/red shoe!.jpg", "etag")]
+
+
+def test_parse_s3_event_skips_other_events() -> None:
+    assert not parse_s3_event(_event("products/shoe.jpg", event_name="ObjectRemoved:*"))
+    assert not parse_s3_event({"Records": [{"eventSource": "aws:sqs"}]})
+
+
+def test_parse_s3_event_skips_internal_and_thumbnail_keys() -> None:
+    event = _event(
+        "_sources/products/shoe.jpg.json",
+        "products/shoe.jpg/32/shoe.jpg",
+        "products/shoe.jpg/20x20c/shoe.webp",
+    )
+
+    assert parse_s3_event(event) == []
+
+
+def test_parse_s3_event_keeps_sources_shaped_like_thumbnails() -> None:
+    event = _event("gallery/2024/gallery.jpg")
+
+    assert parse_s3_event(event) == [SourceUpload("gallery/2024/gallery.jpg", "etag")]
+
+
+def test_get_renditions_longest_prefix_wins(app: App) -> None:
+    assert [spec.to_string() for spec, __ in get_renditions(app, "products/a.jpg")] == [
+        "20x20c",
+        "32",
+    ]
+    assert [spec.to_string() for spec, __ in get_renditions(app, "other.jpg")] == [
+        "100"
+    ]
+
+
+def test_pregenerate(app: App, backend: MemoryBackend) -> None:
+    version = _version(backend, "products/shoe.jpg")
+
+    result = pregenerate(app, SourceUpload("products/shoe.jpg", version))
+
+    assert (result.generated, result.skipped, result.failed) == (2, 0, 0)
+    assert set(backend.targets) >= {
+        "products/shoe.jpg/20x20c/shoe.webp",
+        "products/shoe.jpg/32/shoe.jpg",
+    }
+
+    thumbnail = pyvips.Image.new_from_buffer(
+        backend.targets["products/shoe.jpg/20x20c/shoe.webp"].contents, ""
+    )
+    assert (thumbnail.width, thumbnail.height) == (20, 20)
+
+
+def test_pregenerate_skips_duplicate_events(
+    app: App,
+    backend: MemoryBackend,
+    forbid_source_reads: typing.Callable[[], None],
+) -> None:
+    version = _version(backend, "products/shoe.jpg")
+    event = _event("products/shoe.jpg", "products/shoe.jpg", etag=version)
+
+    uploads = parse_s3_event(event)
+    assert len(uploads) == 1
+
+    pregenerate(app, uploads[0])
+    targets = dict(backend.targets)
+
+    # Redelivered, everything is already there so the source isn't read
+    forbid_source_reads()
+
+    result = pregenerate(app, uploads[0])
+
+    assert (result.generated, result.skipped, result.failed) == (0, 2, 0)
+    assert backend.targets == targets
+
+
+def test_pregenerate_replaced_source(app: App, backend: MemoryBackend) -> None:
+    pregenerate(app, SourceUpload("products/shoe.jpg"))
+
+    backend.add_source(
+        "products/shoe.jpg", pyvips.Image.black(48, 64).write_to_buffer(".jpg")
+    )
+    version = _version(backend, "products/shoe.jpg")
+
+    result = pregenerate(app, SourceUpload("products/shoe.jpg", version))
+
+    assert (result.generated, result.skipped, result.failed) == (2, 0, 0)
+
+
+def test_pregenerate_missing_source(app: App) -> None:
+    # Deleted before the notification was handled, not worth a retry
+    result = pregenerate(app, SourceUpload("products/gone.jpg", "etag"))
+
+    assert (result.generated, result.skipped, result.failed) == (0, 2, 0)
+
+
+def test_pregenerate_unreadable_source(
+    backend: MemoryBackend, app: App, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    def fail(*args: typing.Any, **kwargs: typing.Any) -> typing.NoReturn:
+        raise ConnectionError
+
+    monkeypatch.setattr(backend, "_read_source_with_version", fail)
+
+    result = pregenerate(app, SourceUpload(SOURCE_PATH, "etag"))
+
+    assert (result.generated, result.skipped, result.failed) == (0, 0, 2)
+
+
+def test_s3_event_handler_retries_failures(
+    backend: MemoryBackend, aws: ModuleType, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    # Nothing to retry
+    assert aws.lambda_handler(_event("products/gone.jpg"), None)["skipped"] == 2
+
+    def fail(*args: typing.Any, **kwargs: typing.Any) -> typing.NoReturn:
+        raise ConnectionError
+
+    monkeypatch.setattr(backend, "_read_source_with_version", fail)
+
+    # Raising makes lambda retry the invocation
+    with pytest.raises(RuntimeError, match="Could not generate 2 thumbnails"):
+        aws.lambda_handler(_event(SOURCE_PATH), None)
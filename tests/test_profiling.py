@@ -0,0 +1,93 @@
+"""Profiled renders, asked for with a signed header."""
+
+import typing
+from types import ModuleType
+
+import pytest
+
+from tiny_thumbnail_engine import App
+from tiny_thumbnail_engine.profiling import PROFILE_PREFIX
+from tiny_thumbnail_engine.signing import BadSignatureError
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+
+from .conftest import SOURCE_PATH
+
+
+THUMBNAIL: typing.Final[str] = f"{SOURCE_PATH}/32/shoe.jpg"
+
+
+def _signature(app: App, path: str) -> str:
+    __, signature = app.get_thumbnail(path).url.split("?signature=")
+    return signature
+
+
+def _event(app: App, profile_signature: str) -> dict[str, typing.Any]:
+    return {
+        "httpMethod": "GET",
+        "path": f"/{THUMBNAIL}",
+        "multiValueQueryStringParameters": {"signature": [_signature(app, THUMBNAIL)]},
+        "multiValueHeaders": {"x-thumbnail-profile": [profile_signature]},
+        "body": "",
+        "isBase64Encoded": False,
+    }
+
+
+def test_generate_profiled(backend: MemoryBackend, app: App) -> None:
+    thumbnail = app.get_thumbnail(THUMBNAIL)
+
+    data, report_path = thumbnail.generate_profiled(
+        signature=_signature(app, THUMBNAIL),
+        profile_signature=thumbnail.get_profile_signature(),
+    )
+
+    assert backend.targets[THUMBNAIL].contents == data
+    assert report_path.parent == PROFILE_PREFIX
+    assert b"read source" in backend.targets[report_path.as_posix()].contents
+
+
+@pytest.mark.parametrize(
+    "profile_signature",
+    [
+        "nope",
+        "123.nope",
+        # Long expired
+        "expired",
+        # Signed for another thumbnail
+        "other",
+        # A thumbnail URL signature of the profile value isn't a profile grant
+        "url",
+    ],
+)
+def test_bad_profile_signature(app: App, profile_signature: str) -> None:
+    thumbnail = app.get_thumbnail(THUMBNAIL)
+    expires = 2_000_000_000
+
+    profile_signature = {
+        "expired": thumbnail.get_profile_signature(max_age=-60),
+        "other": app.get_thumbnail(
+            f"{SOURCE_PATH}/16/shoe.jpg"
+        ).get_profile_signature(),
+        "url": (
+            f"{expires}."
+            + app._sign(value=f"profile:{expires}:{thumbnail._get_thumbnail_path()}")
+        ),
+    }.get(profile_signature, profile_signature)
+
+    with pytest.raises(BadSignatureError):
+        thumbnail.generate_profiled(
+            signature=_signature(app, THUMBNAIL), profile_signature=profile_signature
+        )
+
+
+def test_profiled_response(app: App, aws: ModuleType) -> None:
+    thumbnail = app.get_thumbnail(THUMBNAIL)
+
+    response = aws.lambda_handler(_event(app, thumbnail.get_profile_signature()), None)
+
+    assert response["statusCode"] == 200
+    assert response["headers"]["Cache-Control"] == "no-store"
+    assert response["headers"]["X-Thumbnail-Profile"].startswith(str(PROFILE_PREFIX))
+
+    response = aws.lambda_handler(_event(app, "123.nope"), None)
+
+    assert response["statusCode"] == 403
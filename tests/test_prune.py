@@ -0,0 +1,114 @@
+"""Access records and pruning of cold thumbnails."""
+
+import json
+import time
+from pathlib import PurePosixPath
+
+from tiny_thumbnail_engine.access import ACCESS_LOG_PREFIX
+from tiny_thumbnail_engine.access import AccessRecorder
+from tiny_thumbnail_engine.prune import COMPACTED_ACCESS_LOG
+from tiny_thumbnail_engine.prune import prune
+from tiny_thumbnail_engine.sharding import shard_path
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+
+from .conftest import AppFactory
+
+
+DAY = 24 * 60 * 60
+
+
+def _access_logs(backend: MemoryBackend) -> list[str]:
+    return [
+        path
+        for path in backend.targets
+        if path.startswith(f"{ACCESS_LOG_PREFIX}/")
+        and path != COMPACTED_ACCESS_LOG.as_posix()
+    ]
+
+
+def _add(backend: MemoryBackend, path: str, age: float) -> None:
+    backend._write_target(PurePosixPath(path), b"", content_type="image/jpeg")
+    backend.targets[path].last_modified = time.time() - age
+
+
+def test_records_are_written_in_batches() -> None:
+    backend = MemoryBackend()
+    recorder = AccessRecorder(backend, sample_rate=1, max_batch=3)
+
+    for name in ("a", "b"):
+        recorder.record(PurePosixPath(f"{name}.jpg/32/{name}.jpg"))
+
+    # Nothing written per request
+    assert not _access_logs(backend)
+
+    for name in ("c", "d"):
+        recorder.record(PurePosixPath(f"{name}.jpg/32/{name}.jpg"))
+
+    recorder.flush()
+
+    # One full batch, and the rest on flush
+    logs = sorted(
+        (json.loads(backend.targets[path].contents) for path in _access_logs(backend)),
+        key=len,
+    )
+    assert [sorted(log) for log in logs] == [
+        ["d.jpg/32/d.jpg"],
+        ["a.jpg/32/a.jpg", "b.jpg/32/b.jpg", "c.jpg/32/c.jpg"],
+    ]
+
+
+def test_prune_by_age(backend: MemoryBackend, make_app: AppFactory) -> None:
+    app = make_app()
+    _add(backend, "products/shoe.jpg/32/shoe.jpg", age=10 * DAY)
+    _add(backend, "products/shoe.jpg/16/shoe.jpg", age=10 * DAY)
+    _add(backend, "products/shoe.jpg/64/shoe.jpg", age=0)
+    # Internal, never pruned
+    _add(backend, "_sources/products/shoe.jpg.json", age=10 * DAY)
+
+    recorder = AccessRecorder(backend, sample_rate=1)
+    recorder.record(PurePosixPath("products/shoe.jpg/16/shoe.jpg"))
+    recorder.flush()
+
+    result = prune(app, max_age=7 * DAY, dry_run=True)
+    assert (result.scanned, result.evicted_by_age) == (3, 1)
+    assert "products/shoe.jpg/32/shoe.jpg" in backend.targets
+
+    prune(app, max_age=7 * DAY)
+
+    assert "products/shoe.jpg/32/shoe.jpg" not in backend.targets
+    assert "products/shoe.jpg/16/shoe.jpg" in backend.targets
+    assert "_sources/products/shoe.jpg.json" in backend.targets
+
+    # Merged into the compacted log
+    assert not _access_logs(backend)
+    compacted = json.loads(backend.targets[COMPACTED_ACCESS_LOG.as_posix()].contents)
+    assert list(compacted) == ["products/shoe.jpg/16/shoe.jpg"]
+
+    # Still counts on the next run
+    assert prune(app, max_age=7 * DAY).evicted_by_age == 0
+
+
+def test_prune_per_source(backend: MemoryBackend, make_app: AppFactory) -> None:
+    app = make_app()
+    # Both layouts of the same source share a budget
+    _add(backend, "products/shoe.jpg/32/shoe.jpg", age=3 * DAY)
+    _add(
+        backend,
+        shard_path(PurePosixPath("products/shoe.jpg/16/shoe.jpg")).as_posix(),
+        age=DAY,
+    )
+    _add(backend, "products/boot.jpg/32/boot.jpg", age=3 * DAY)
+    _add(backend, "_cas/ab/abcd/32.jpg", age=2 * DAY)
+    _add(backend, "_cas/ab/abcd/16.jpg", age=DAY)
+
+    result = prune(app, max_age=7 * DAY, per_source=1)
+
+    assert (result.scanned, result.evicted_by_age, result.evicted_by_budget) == (
+        5,
+        0,
+        2,
+    )
+    # The least recently used of each group
+    assert "products/shoe.jpg/32/shoe.jpg" not in backend.targets
+    assert "_cas/ab/abcd/32.jpg" not in backend.targets
+    assert "products/boot.jpg/32/boot.jpg" in backend.targets
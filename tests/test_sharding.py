@@ -0,0 +1,136 @@
+"""Thumbnails stored under a hash of their path."""
+
+import typing
+from pathlib import PurePosixPath
+
+import pytest
+import pyvips
+
+from tiny_thumbnail_engine.exceptions import ImproperlyConfiguredError
+from tiny_thumbnail_engine.sharding import migrate
+from tiny_thumbnail_engine.sharding import shard_path
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+from tiny_thumbnail_engine.sweep import sweep
+
+from .conftest import SOURCE_PATH
+from .conftest import AppFactory
+from .conftest import Fetch
+
+
+THUMBNAIL: typing.Final[str] = f"{SOURCE_PATH}/32/shoe.jpg"
+SHARDED: typing.Final[str] = shard_path(PurePosixPath(THUMBNAIL)).as_posix()
+
+
+def test_stored_under_the_sharded_key(
+    backend: MemoryBackend, make_app: AppFactory, fetch: Fetch
+) -> None:
+    data = fetch(make_app(sharded_targets=True), THUMBNAIL)
+
+    assert SHARDED.startswith("_shards/")
+    assert set(backend.targets) == {SHARDED}
+    assert backend.targets[SHARDED].contents == data
+
+
+def test_fallback_to_the_old_key(
+    backend: MemoryBackend,
+    make_app: AppFactory,
+    fetch: Fetch,
+    forbid_source_reads: typing.Callable[[], None],
+) -> None:
+    data = fetch(make_app(), THUMBNAIL)
+    forbid_source_reads()
+
+    # Copied over instead of generated again
+    assert fetch(make_app(sharded_targets=True), THUMBNAIL) == data
+    assert backend.targets[SHARDED].contents == data
+    assert THUMBNAIL in backend.targets
+
+
+def test_no_fallback(
+    backend: MemoryBackend,
+    make_app: AppFactory,
+    fetch: Fetch,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    fetch(make_app(), THUMBNAIL)
+    reads = 0
+    read_source = backend._read_source_with_version
+
+    def counting(path: PurePosixPath) -> tuple[bytes, str]:
+        nonlocal reads
+        reads += 1
+        return read_source(path)
+
+    monkeypatch.setattr(backend, "_read_source_with_version", counting)
+
+    fetch(make_app(sharded_targets=True, sharded_fallback=False), THUMBNAIL)
+
+    assert reads == 1
+
+
+def test_migrate(backend: MemoryBackend, make_app: AppFactory, fetch: Fetch) -> None:
+    fetch(make_app(placeholders=True), THUMBNAIL)
+    fetch(make_app(), f"{SOURCE_PATH}/16/shoe.jpg")
+    app = make_app(sharded_targets=True)
+
+    result = migrate(app)
+    assert (result.copied, result.skipped, result.deleted) == (2, 0, 0)
+    assert backend.targets[SHARDED].contents == backend.targets[THUMBNAIL].contents
+
+    result = migrate(app, delete=True)
+    assert (result.copied, result.skipped, result.deleted) == (0, 2, 2)
+
+    # Sidecars stay where they are
+    assert {path.split("/")[0] for path in backend.targets} == {"_shards", "_sources"}
+
+
+def test_migrate_needs_sharding(
+    backend: MemoryBackend, make_app: AppFactory, fetch: Fetch
+) -> None:
+    fetch(make_app(), THUMBNAIL)
+
+    with pytest.raises(ImproperlyConfiguredError):
+        migrate(make_app(), delete=True)
+
+    assert set(backend.targets) == {THUMBNAIL}
+
+
+def test_sweep(backend: MemoryBackend, make_app: AppFactory, fetch: Fetch) -> None:
+    fetch(make_app(), THUMBNAIL)
+    app = make_app(sharded_targets=True)
+    fetch(app, f"{SOURCE_PATH}/16/shoe.jpg")
+
+    backend.add_source(SOURCE_PATH, pyvips.Image.black(48, 64).write_to_buffer(".jpg"))
+
+    result = sweep(app, "products/")
+
+    assert (result.checked, result.stale, result.regenerated, result.deleted) == (
+        2,
+        2,
+        1,
+        1,
+    )
+    # Generated again at the sharded key on the next request
+    assert THUMBNAIL not in backend.targets
+    assert sweep(app, "products/").stale == 0
+
+
+def test_sweep_without_sharding(
+    backend: MemoryBackend,
+    make_app: AppFactory,
+    fetch: Fetch,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    fetch(make_app(sharded_targets=True), THUMBNAIL)
+    listed: list[str] = []
+    list_targets = backend._list_targets
+
+    def counting(prefix: str) -> typing.Iterator[typing.Any]:
+        listed.append(prefix)
+        return list_targets(prefix)
+
+    monkeypatch.setattr(backend, "_list_targets", counting)
+
+    # Not served, so not looked at either
+    assert sweep(make_app(), "products/").checked == 0
+    assert listed == ["products/"]
@@ -0,0 +1,94 @@
+"""Spec grammar, crop strategies and focal points."""
+
+import pytest
+import pyvips
+
+from tiny_thumbnail_engine import App
+from tiny_thumbnail_engine.model import ThumbnailSpec
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+
+from .conftest import Fetch
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        "200",
+        "x300",
+        "200x300",
+        "200x300p",
+        "200u",
+        "200x300c",
+        "200x300cc",
+        "200x300ca",
+        "200x300cf25,40",
+        "200x300ucf0,100",
+        "800b50000",
+        "200x300cab12000",
+    ],
+)
+def test_round_trip(spec: str) -> None:
+    assert ThumbnailSpec.from_string(spec).to_string() == spec
+
+
+def test_entropy_is_implied() -> None:
+    spec = ThumbnailSpec.from_string("200x300ce")
+
+    assert spec.crop_strategy == "entropy"
+    # Same signature as before crop strategies existed
+    assert spec.to_string() == "200x300c"
+
+
+def test_focal_point_and_budget() -> None:
+    spec = ThumbnailSpec.from_string("200x300cf25,40b9000")
+
+    assert spec.focal_point == (25, 40)
+    assert spec.max_bytes == 9000
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        # Strategy without the crop flag
+        "200x300a",
+        "200x300f10,10",
+        # Only one dimension, to_string would drop the strategy
+        "200cc",
+        "x300cf10,10",
+        # Out of range
+        "200x300cf101,0",
+        "200x300cf10",
+        "200x300cx",
+    ],
+)
+def test_invalid(spec: str) -> None:
+    with pytest.raises(ValueError):
+        ThumbnailSpec.from_string(spec)
+
+
+@pytest.fixture
+def half_white(backend: MemoryBackend) -> None:
+    # White on the left, black on the right
+    image = pyvips.Image.black(64, 48).draw_rect(255, 0, 0, 32, 48, fill=True)
+    backend.add_source("products/half.jpg", image.write_to_buffer(".jpg"))
+
+
+@pytest.mark.parametrize(("focal_x", "mean"), [(0, 255), (100, 0)])
+@pytest.mark.usefixtures("half_white")
+def test_focal_point_crop(app: App, fetch: Fetch, focal_x: int, mean: int) -> None:
+    data = fetch(app, f"products/half.jpg/16x48cf{focal_x},50/half.webp")
+
+    thumbnail = pyvips.Image.new_from_buffer(data, "")
+
+    # Not scaled, the window is moved to the edge nearest the focal point
+    assert (thumbnail.width, thumbnail.height) == (16, 48)
+    assert thumbnail.avg() == pytest.approx(mean, abs=8)
+
+
+@pytest.mark.parametrize("strategy", ["c", "cc", "ca"])
+def test_crop_strategies(app: App, fetch: Fetch, strategy: str) -> None:
+    data = fetch(app, f"products/shoe.jpg/20x20{strategy}/shoe.jpg")
+
+    thumbnail = pyvips.Image.new_from_buffer(data, "")
+
+    assert (thumbnail.width, thumbnail.height) == (20, 20)
@@ -0,0 +1,106 @@
+"""Streamed responses, written to the client and uploaded at the same time."""
+
+import io
+import json
+import typing
+from types import ModuleType
+
+import pytest
+import pyvips
+
+from tiny_thumbnail_engine import App
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+
+from .conftest import Fetch
+
+
+THUMBNAIL: typing.Final[str] = "products/shoe.jpg/32/shoe.webp"
+
+
+class ResponseStream(io.BytesIO):
+    closed_by_handler = False
+
+    def close(self) -> None:
+        # Keep the contents readable
+        self.closed_by_handler = True
+
+    def prelude(self) -> dict[str, typing.Any]:
+        prelude, __, __ = self.getvalue().partition(b"\x00" * 8)
+        return typing.cast(dict[str, typing.Any], json.loads(prelude))
+
+    def body(self) -> bytes:
+        __, __, body = self.getvalue().partition(b"\x00" * 8)
+        return body
+
+
+def _event(path: str, signature: str) -> dict[str, typing.Any]:
+    return {
+        "requestContext": {"http": {"method": "GET"}},
+        "rawPath": f"/{path}",
+        "queryStringParameters": {"signature": signature},
+        "headers": {},
+    }
+
+
+def _signature(app: App, path: str) -> str:
+    __, signature = app.get_thumbnail(path).url.split("?signature=")
+    return signature
+
+
+def test_streamed_miss_is_stored(
+    app: App, aws: ModuleType, backend: MemoryBackend, fetch: Fetch
+) -> None:
+    response_stream = ResponseStream()
+
+    aws.streaming_lambda_handler(
+        _event(THUMBNAIL, _signature(app, THUMBNAIL)), response_stream, None
+    )
+
+    assert response_stream.prelude()["statusCode"] == 200
+    assert response_stream.closed_by_handler
+    assert backend.targets[THUMBNAIL].contents == response_stream.body()
+
+    thumbnail = pyvips.Image.new_from_buffer(response_stream.body(), "")
+    assert (thumbnail.width, thumbnail.height) == (32, 24)
+
+    # And a hit is streamed from storage
+    assert fetch(app, THUMBNAIL) == response_stream.body()
+
+
+def test_bad_signature(app: App, aws: ModuleType, backend: MemoryBackend) -> None:
+    response_stream = ResponseStream()
+
+    aws.streaming_lambda_handler(_event(THUMBNAIL, "nope"), response_stream, None)
+
+    assert response_stream.prelude()["statusCode"] == 403
+    assert THUMBNAIL not in backend.targets
+
+
+def test_stream_closed_on_unexpected_errors(app: App, aws: ModuleType) -> None:
+    path = "products/gone.jpg/32/gone.webp"
+    response_stream = ResponseStream()
+
+    # Missing source
+    with pytest.raises(KeyError):
+        aws.streaming_lambda_handler(
+            _event(path, _signature(app, path)), response_stream, None
+        )
+
+    assert response_stream.closed_by_handler
+
+
+# pyvips reports the exception raised in its write callback as unraisable
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnraisableExceptionWarning")
+def test_failed_encode_is_not_stored(app: App, backend: MemoryBackend) -> None:
+    thumbnail = app.get_thumbnail(THUMBNAIL)
+
+    def write(chunk: bytes) -> None:
+        raise ConnectionResetError
+
+    with pytest.raises(pyvips.Error):
+        thumbnail.get_or_generate_stream(
+            signature=_signature(app, THUMBNAIL), write=write
+        )
+
+    # Not a truncated thumbnail
+    assert THUMBNAIL not in backend.targets
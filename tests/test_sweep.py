@@ -0,0 +1,93 @@
+"""Regenerating thumbnails whose source has been replaced."""
+
+from pathlib import PurePosixPath
+
+import pyvips
+
+from tiny_thumbnail_engine.sources import SOURCE_VERSION_METADATA
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+from tiny_thumbnail_engine.sweep import run_bounded
+from tiny_thumbnail_engine.sweep import sweep
+
+from .conftest import SOURCE_PATH
+from .conftest import AppFactory
+from .conftest import Fetch
+
+
+def _replace_source(backend: MemoryBackend) -> None:
+    backend.add_source(SOURCE_PATH, pyvips.Image.black(48, 64).write_to_buffer(".jpg"))
+
+
+def _size(data: bytes) -> tuple[int, int]:
+    image = pyvips.Image.new_from_buffer(data, "")
+    return image.width, image.height
+
+
+def test_run_bounded_counts_failures() -> None:
+    done = []
+
+    def func(item: int) -> None:
+        if item % 3 == 0:
+            raise ValueError(item)
+        done.append(item)
+
+    assert run_bounded(func, range(10), concurrency=2) == 4
+    assert sorted(done) == [1, 2, 4, 5, 7, 8]
+
+
+def test_sweep(backend: MemoryBackend, make_app: AppFactory, fetch: Fetch) -> None:
+    app = make_app()
+    fetch(app, "products/shoe.jpg/32/shoe.jpg")
+    fetch(app, "products/shoe.jpg/16/shoe.webp")
+    backend.add_source("products/gone.jpg", backend.sources[SOURCE_PATH].contents)
+    fetch(app, "products/gone.jpg/32/gone.jpg")
+    del backend.sources["products/gone.jpg"]
+
+    # Nothing has changed
+    result = sweep(app, "products/")
+    assert (result.checked, result.stale, result.regenerated, result.failed) == (
+        2,
+        0,
+        0,
+        0,
+    )
+
+    _replace_source(backend)
+
+    result = sweep(app, "products/")
+    assert (result.checked, result.stale, result.regenerated, result.failed) == (
+        2,
+        2,
+        2,
+        0,
+    )
+
+    stored = backend.targets["products/shoe.jpg/32/shoe.jpg"]
+    __, version = backend._read_source_with_version(PurePosixPath(SOURCE_PATH))
+    assert _size(stored.contents) == (32, 43)
+    assert stored.metadata[SOURCE_VERSION_METADATA] == version
+
+    # Up to date again
+    assert sweep(app, "products/").stale == 0
+
+
+def test_sweep_content_addressed(
+    backend: MemoryBackend, make_app: AppFactory, fetch: Fetch
+) -> None:
+    app = make_app(content_addressed=True, source_info_cache_ttl=0)
+    fetch(app, "products/shoe.jpg/32/shoe.jpg")
+
+    assert sweep(app, "products/").stale == 0
+
+    _replace_source(backend)
+
+    result = sweep(app, "products/")
+    assert (result.checked, result.stale, result.regenerated, result.failed) == (
+        1,
+        1,
+        1,
+        0,
+    )
+
+    # The sidecar points at the renditions of the new contents
+    assert _size(fetch(app, "products/shoe.jpg/32/shoe.jpg")) == (32, 43)
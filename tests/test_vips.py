@@ -0,0 +1,88 @@
+"""libvips settings and sequential access."""
+
+import pytest
+import pyvips
+
+from tiny_thumbnail_engine.environ import ENVIRON_PREFIX
+from tiny_thumbnail_engine.exceptions import ImproperlyConfiguredError
+from tiny_thumbnail_engine.storage.memory import MemoryBackend
+from tiny_thumbnail_engine.vips import PRESETS
+from tiny_thumbnail_engine.vips import get_vips_config
+
+from .conftest import AppFactory
+from .conftest import Fetch
+
+
+@pytest.fixture(autouse=True)
+def clean_environ(monkeypatch: pytest.MonkeyPatch) -> None:
+    for name in ("AWS_LAMBDA_FUNCTION_NAME", f"{ENVIRON_PREFIX}_VIPS_PRESET"):
+        monkeypatch.delenv(name, raising=False)
+
+
+def test_left_alone_by_default() -> None:
+    assert get_vips_config() is None
+
+
+def test_lambda_preset_on_lambda(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "thumbnails")
+
+    assert get_vips_config() == PRESETS["lambda"]
+
+
+def test_overrides(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv(f"{ENVIRON_PREFIX}_VIPS_PRESET", "render")
+    monkeypatch.setenv(f"{ENVIRON_PREFIX}_VIPS_CACHE_MAX", "7")
+    monkeypatch.setenv(f"{ENVIRON_PREFIX}_VIPS_ACCESS", "random")
+
+    config = get_vips_config()
+
+    assert config is not None
+    assert config.cache_max == 7
+    assert config.access == "random"
+    assert config.cache_max_mem == PRESETS["render"].cache_max_mem
+
+
+@pytest.mark.parametrize(
+    ("name", "value"),
+    [("VIPS_PRESET", "desktop"), ("VIPS_ACCESS", "sometimes")],
+)
+def test_invalid(monkeypatch: pytest.MonkeyPatch, name: str, value: str) -> None:
+    monkeypatch.setenv(f"{ENVIRON_PREFIX}_VIPS_PRESET", "lambda")
+    monkeypatch.setenv(f"{ENVIRON_PREFIX}_{name}", value)
+
+    with pytest.raises(ImproperlyConfiguredError):
+        get_vips_config()
+
+
+@pytest.mark.parametrize(
+    ("spec", "access"),
+    [
+        ("200", "sequential"),
+        ("200x200c", "random"),
+        ("200x200ca", "random"),
+        ("200x200cc", "sequential"),
+        ("200x200cf10,10", "sequential"),
+    ],
+)
+def test_access(make_app: AppFactory, spec: str, access: str) -> None:
+    app = make_app(vips_config=PRESETS["lambda"])
+    thumbnail = app.get_thumbnail(f"products/shoe.jpg/{spec}/shoe.jpg")
+
+    # Smart crops need the whole image
+    assert thumbnail._get_access() == access
+
+
+def test_rotated_source_with_sequential_access(
+    backend: MemoryBackend, make_app: AppFactory, fetch: Fetch
+) -> None:
+    # Portrait once rotated
+    image = pyvips.Image.black(64, 48).copy()
+    image.set_type(pyvips.GValue.gint_type, "orientation", 6)
+    backend.add_source("products/rotated.jpg", image.write_to_buffer(".jpg"))
+
+    app = make_app(vips_config=PRESETS["lambda"])
+    data = fetch(app, "products/rotated.jpg/24/rotated.jpg")
+
+    thumbnail = pyvips.Image.new_from_buffer(data, "")
+
+    assert (thumbnail.width, thumbnail.height) == (24, 32)